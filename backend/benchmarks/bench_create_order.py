@@ -0,0 +1,74 @@
+"""
+Benchmark de POST /orders/ para órdenes de 1, 10 y 50 ítems.
+
+Corre la app en proceso (httpx + ASGITransport) contra una base SQLite
+temporal, salvo que DATABASE_URL apunte a otra base.
+
+    python benchmarks/bench_create_order.py [--repeticiones 200]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_orders.db")
+
+import httpx  # noqa: E402
+
+import farmacia  # noqa: E402
+
+# Sin lifespan (ASGITransport no lo ejecuta): se crea el esquema a mano
+farmacia.init_database()
+
+TAMANOS = (1, 10, 50)
+
+
+def sembrar_productos(cantidad: int):
+    db = farmacia.SessionLocal()
+    for i in range(cantidad):
+        db.add(farmacia.ProductDB(name=f"Producto bench {i}", stock=10_000_000, price=1000 + i))
+    db.commit()
+    ids = [p.id for p in db.query(farmacia.ProductDB.id).all()]
+    db.close()
+    return ids
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+async def medir(repeticiones: int):
+    ids = sembrar_productos(max(TAMANOS))
+    transport = httpx.ASGITransport(app=farmacia.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        r = await client.post("/token", data={"username": "admin", "password": "fasapisecrets"})
+        headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+        for tamano in TAMANOS:
+            payload = {"items": [{"product_id": pid, "quantity": 1} for pid in ids[:tamano]]}
+            latencias = []
+            for _ in range(repeticiones):
+                inicio = time.perf_counter()
+                r = await client.post("/orders/", json=payload, headers=headers)
+                latencias.append((time.perf_counter() - inicio) * 1000)
+                assert r.status_code == 200, r.text
+            print(
+                f"{tamano:>3} ítems: p50={statistics.median(latencias):7.2f} ms  "
+                f"p95={percentil(latencias, 0.95):7.2f} ms  "
+                f"media={statistics.mean(latencias):7.2f} ms  (n={repeticiones})"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=200)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(medir(args.repeticiones))
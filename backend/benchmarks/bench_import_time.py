@@ -0,0 +1,80 @@
+"""
+Costo de importar farmacia.py (arranque de cada worker).
+
+Importa el módulo en un proceso nuevo con `python -X importtime`, varias
+veces, y reporta la mediana del tiempo total y los módulos más caros.
+También avisa si alguna dependencia pesada (selenium, boto3, stripe, PIL)
+se carga al importar en vez de en su primer uso.
+
+    python benchmarks/bench_import_time.py [--repeticiones 5] [--top 15] [--max-ms 1500]
+
+Con --max-ms el script termina con código 1 si la mediana supera el límite.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PESADOS = ("selenium", "boto3", "botocore", "stripe", "PIL")
+SONDA = "import sys, farmacia; print(','.join(m for m in {pesados!r} if m in sys.modules))"
+
+
+def importar_una_vez():
+    env = dict(os.environ)
+    env.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_import.db")
+    proceso = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", SONDA.format(pesados=PESADOS)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True, check=True,
+    )
+    modulos = {}
+    for linea in proceso.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not linea.startswith("import time:") or "|" not in linea:
+            continue
+        _, acumulado, nombre = linea.split("|")
+        try:
+            modulos[nombre.strip()] = int(acumulado)
+        except ValueError:
+            continue  # encabezado
+    cargados = [m for m in proceso.stdout.strip().split(",") if m]
+    return modulos, cargados
+
+
+def medir(repeticiones: int, top: int):
+    totales = []
+    por_modulo = {}
+    cargados = []
+    for _ in range(repeticiones):
+        modulos, cargados = importar_una_vez()
+        totales.append(modulos["farmacia"] / 1000)
+        for nombre, micros in modulos.items():
+            # Solo dependencias de primer nivel (sin puntos) para un resumen legible
+            if "." not in nombre and nombre != "farmacia":
+                por_modulo.setdefault(nombre, []).append(micros / 1000)
+
+    mediana = statistics.median(totales)
+    print(f"import farmacia: p50={mediana:.1f} ms  min={min(totales):.1f} ms  max={max(totales):.1f} ms  (n={repeticiones})")
+    print("\nMódulos de primer nivel más caros (mediana acumulada):")
+    ranking = sorted(((statistics.median(v), k) for k, v in por_modulo.items()), reverse=True)
+    for ms, nombre in ranking[:top]:
+        print(f"  {nombre:<24} {ms:8.1f} ms")
+    if cargados:
+        print(f"\nAVISO: dependencias pesadas cargadas al importar: {', '.join(cargados)}")
+    else:
+        print("\nOK: selenium, boto3, stripe y PIL se cargan en su primer uso")
+    return mediana
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+    mediana = medir(args.repeticiones, args.top)
+    if args.max_ms is not None and mediana > args.max_ms:
+        print(f"ERROR: la mediana ({mediana:.1f} ms) supera el límite de {args.max_ms:.1f} ms")
+        sys.exit(1)
@@ -0,0 +1,101 @@
+"""
+Costo de serializar listados grandes (productos y movimientos de stock).
+
+Compara, sobre los mismos datos, tres caminos de codificación a JSON:
+
+    orm       objetos ORM -> jsonable_encoder -> json.dumps (respuesta por defecto de FastAPI)
+    pydantic  objetos ORM -> TypeAdapter(List[Modelo]).dump_json (validación + encode en Rust)
+    filas     filas (RowMapping) -> orjson.dumps (camino de paginate_rows/rows_response)
+
+Cada variante incluye la consulta, para que cuente la hidratación de objetos ORM:
+
+    python benchmarks/bench_serialization.py [--filas 10000] [--repeticiones 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_serialization.db")
+
+import orjson  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from sqlalchemy import insert, select  # noqa: E402
+
+import farmacia  # noqa: E402
+
+CARGAS = (
+    ("productos", farmacia.ProductDB, farmacia.ProductOut),
+    ("movimientos", farmacia.StockMovementDB, farmacia.StockMovement),
+)
+
+
+def sembrar(filas: int):
+    ahora = datetime.utcnow().replace(microsecond=0)
+    with farmacia.engine.begin() as conn:
+        conn.execute(insert(farmacia.ProductDB), [
+            {"name": f"Producto {i}", "stock": 100 + i, "price": 1000.0 + i, "image_filename": f"producto-{i}.png"}
+            for i in range(filas)
+        ])
+        conn.execute(insert(farmacia.StockMovementDB), [
+            {"product_id": 1 + i % filas, "timestamp": ahora - timedelta(minutes=i), "change": -(i % 5) - 1,
+             "description": f"Orden {i}"}
+            for i in range(filas)
+        ])
+
+
+def via_orm(db, modelo_db, modelo):
+    objetos = db.execute(select(modelo_db).order_by(modelo_db.id)).scalars().all()
+    return json.dumps(jsonable_encoder(objetos)).encode()
+
+
+def via_pydantic(db, modelo_db, modelo):
+    objetos = db.execute(select(modelo_db).order_by(modelo_db.id)).scalars().all()
+    return TypeAdapter(List[modelo]).dump_json(objetos)
+
+
+def via_filas(db, modelo_db, modelo):
+    filas = db.execute(select(*modelo_db.__table__.columns).order_by(modelo_db.id)).mappings().all()
+    return orjson.dumps([dict(fila) for fila in filas])
+
+
+VARIANTES = (("orm", via_orm), ("pydantic", via_pydantic), ("filas", via_filas))
+
+
+def medir(repeticiones: int):
+    db = farmacia.SessionLocal()
+    try:
+        for nombre, modelo_db, modelo in CARGAS:
+            print(f"\n{nombre}:")
+            base = None
+            for variante, funcion in VARIANTES:
+                tiempos = []
+                for _ in range(repeticiones):
+                    db.expunge_all()  # sin identity map caliente: cada corrida hidrata de cero
+                    inicio = time.perf_counter()
+                    cuerpo = funcion(db, modelo_db, modelo)
+                    tiempos.append((time.perf_counter() - inicio) * 1000)
+                mediana = statistics.median(tiempos)
+                base = base or mediana
+                print(f"  {variante:<9} p50={mediana:8.1f} ms  min={min(tiempos):8.1f} ms  "
+                      f"{len(cuerpo) / 1024:8.0f} KiB  x{base / mediana:4.1f}")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--filas", type=int, default=10_000)
+    parser.add_argument("--repeticiones", type=int, default=5)
+    args = parser.parse_args()
+    farmacia.init_database()
+    sembrar(args.filas)
+    medir(args.repeticiones)
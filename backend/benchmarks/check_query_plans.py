@@ -0,0 +1,135 @@
+"""
+Verifica con EXPLAIN que las consultas calientes usan índices.
+
+Ejecuta EXPLAIN (MySQL) o EXPLAIN QUERY PLAN (SQLite) sobre las consultas de
+los endpoints más usados y termina con código 1 si alguna recorre una tabla
+completa. Antes aplica la migración de índices (create_missing_indexes) y, si
+la base está vacía, siembra datos con datos.py para que el optimizador tenga
+cardinalidades realistas; luego actualiza estadísticas (ANALYZE).
+
+    python benchmarks/check_query_plans.py [--verbose]
+
+Por defecto usa una base SQLite temporal. Para MySQL se exporta DATABASE_URL.
+tests/test_query_plans.py corre las mismas consultas en cada ejecución de pytest.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/check_query_plans.db")
+
+from sqlalchemy import delete, func, select, update  # noqa: E402
+
+import farmacia  # noqa: E402
+import datos  # noqa: E402
+from farmacia import (  # noqa: E402
+    ExternalPrice, FinancialMovementDB, OrderDB, OrderItemDB, ProductDB, StockMovementDB, StripeEventDB, UserDB,
+)
+
+LIMITE = 51  # limit + 1 de paginate/paginate_rows
+
+
+def consultas_calientes():
+    """(nombre, sentencia) de las consultas que deben resolverse con un índice."""
+    desde = datetime.utcnow() - timedelta(days=7)
+    hasta = datetime.utcnow()
+    return [
+        ("login: usuario por nombre", select(UserDB).where(UserDB.username == "cliente1")),
+        ("list_orders: órdenes del cliente",
+         select(*OrderDB.__table__.columns).where(OrderDB.client_id == 2).order_by(OrderDB.id).limit(LIMITE)),
+        ("list_orders: por estado",
+         select(*OrderDB.__table__.columns).where(OrderDB.status == "pending").order_by(OrderDB.id).limit(LIMITE)),
+        ("list_orders: por fecha",
+         select(*OrderDB.__table__.columns).where(OrderDB.created_at >= desde, OrderDB.created_at < hasta)),
+        ("list_orders?include=items: ítems por lote",
+         select(OrderItemDB).where(OrderItemDB.order_id.in_([1, 2, 3, 4, 5]))),
+        ("webhook Stripe: orden por payment intent",
+         update(OrderDB).where(OrderDB.payment_status != "paid", OrderDB.stripe_payment_intent_id == "pi_123")
+         .values(payment_status="paid")),
+        ("delete_out_of_stock_products", delete(ProductDB).where(ProductDB.stock == 0)),
+        ("financial_movements: por orden",
+         select(*FinancialMovementDB.__table__.columns).where(FinancialMovementDB.order_id == 10)
+         .order_by(FinancialMovementDB.id).limit(LIMITE)),
+        ("financial_movements: por fecha",
+         select(*FinancialMovementDB.__table__.columns)
+         .where(FinancialMovementDB.timestamp >= desde, FinancialMovementDB.timestamp < hasta)),
+        ("stock_movements: por producto",
+         select(*StockMovementDB.__table__.columns).where(StockMovementDB.product_id == 10)
+         .order_by(StockMovementDB.id).limit(LIMITE)),
+        ("stock_movements: por fecha",
+         select(*StockMovementDB.__table__.columns)
+         .where(StockMovementDB.timestamp >= desde, StockMovementDB.timestamp < hasta)),
+        ("stock-at: ledger del producto hasta un instante",
+         select(func.coalesce(func.sum(StockMovementDB.change), 0), func.count(StockMovementDB.id))
+         .where(StockMovementDB.product_id == 10, StockMovementDB.timestamp <= hasta)),
+        ("comparación de precios: precio más reciente",
+         select(ExternalPrice).where(ExternalPrice.product_id == 10)
+         .order_by(ExternalPrice.updated_at.desc()).limit(1)),
+        ("worker Stripe: eventos pendientes",
+         select(StripeEventDB.id)
+         .where(StripeEventDB.processed_at.is_(None), StripeEventDB.attempts < farmacia.STRIPE_EVENT_MAX_ATTEMPTS)
+         .order_by(StripeEventDB.received_at)),
+    ]
+
+
+def explicar(conn, stmt):
+    """Devuelve (detalle legible, recorridos completos) del plan de la sentencia."""
+    dialecto = conn.dialect.name
+    compilada = stmt.compile(dialect=conn.dialect, compile_kwargs={"render_postcompile": True})
+    parametros = compilada.construct_params()
+    if compilada.positional:
+        parametros = tuple(parametros[nombre] for nombre in compilada.positiontup)
+    prefijo = "EXPLAIN QUERY PLAN" if dialecto == "sqlite" else "EXPLAIN"
+    filas = conn.exec_driver_sql(f"{prefijo} {compilada}", parametros).mappings().all()
+    if dialecto == "sqlite":
+        lineas = [fila["detail"] for fila in filas]
+        # "SCAN orders" recorre la tabla; "SEARCH ... USING INDEX" o "SCAN ... USING INDEX" no
+        completos = [linea for linea in lineas if linea.startswith("SCAN") and "INDEX" not in linea]
+    else:
+        lineas = [f"{fila['table']}: type={fila['type']} key={fila['key']} rows={fila['rows']}" for fila in filas]
+        # type=ALL es un recorrido de tabla; type=index recorre el índice completo
+        completos = [linea for linea, fila in zip(lineas, filas) if fila["type"] in ("ALL", "index")]
+    return lineas, completos
+
+
+def actualizar_estadisticas(conn):
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("ANALYZE")
+    else:
+        for tabla in farmacia.Base.metadata.sorted_tables:
+            conn.exec_driver_sql(f"ANALYZE TABLE {tabla.name}")
+
+
+def verificar(verbose: bool) -> bool:
+    """Imprime el plan de cada consulta caliente; True si alguna recorre una tabla completa."""
+    farmacia.init_database()
+    with farmacia.engine.connect() as conn:
+        vacia = not conn.execute(select(func.count(ProductDB.id))).scalar()
+    if vacia:
+        datos.sembrar(semilla=42, productos=2000, usuarios=200, ordenes=5000)
+    fallas = 0
+    with farmacia.engine.begin() as conn:
+        actualizar_estadisticas(conn)
+        for nombre, stmt in consultas_calientes():
+            lineas, completos = explicar(conn, stmt)
+            fallas += bool(completos)
+            print(f"{'FULL SCAN' if completos else 'ok':<9} {nombre}")
+            if verbose or completos:
+                for linea in lineas:
+                    print(f"            {linea}")
+    print(f"\n{fallas} consulta(s) con recorrido completo ({farmacia.engine.dialect.name})")
+    return fallas > 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--verbose", action="store_true", help="muestra el plan de todas las consultas")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    if verificar(args.verbose):
+        sys.exit(1)
@@ -0,0 +1,120 @@
+"""
+Generador de datos sembrados para los benchmarks.
+
+Con la misma semilla produce siempre el mismo catálogo, usuarios, órdenes y
+movimientos, de modo que las corridas de distintos commits sean comparables.
+Inserta por lotes con el motor síncrono de farmacia (SQLite o MySQL).
+"""
+import random
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, insert, func, select, update
+
+import farmacia
+
+PASSWORD_USUARIOS = "bench-clave"
+LOTE = 1000
+STOCK_INICIAL = 1_000_000
+PRINCIPIOS = (
+    "Acetaminofén", "Ibuprofeno", "Loratadina", "Omeprazol", "Amoxicilina", "Losartán",
+    "Metformina", "Atorvastatina", "Naproxeno", "Cetirizina", "Diclofenaco", "Salbutamol",
+)
+PRESENTACIONES = ("tabletas", "cápsulas", "jarabe", "gotas", "crema", "suspensión")
+
+
+def insertar_por_lotes(conn, modelo, filas):
+    for i in range(0, len(filas), LOTE):
+        conn.execute(insert(modelo), filas[i:i + LOTE])
+
+
+def sembrar(semilla: int, productos: int, usuarios: int, ordenes: int) -> dict:
+    """Siembra la base y devuelve los ids y credenciales que usan los escenarios."""
+    rng = random.Random(semilla)
+    ahora = datetime.utcnow().replace(microsecond=0)
+
+    with farmacia.engine.begin() as conn:
+        if conn.execute(select(func.count(farmacia.ProductDB.id))).scalar():
+            raise RuntimeError("La base ya tiene productos; usa --reiniciar o una base vacía")
+
+        insertar_por_lotes(conn, farmacia.ProductDB, [
+            {
+                "name": f"{rng.choice(PRINCIPIOS)} {rng.choice((50, 100, 200, 400, 500))} mg "
+                        f"{rng.choice(PRESENTACIONES)} #{i}",
+                "stock": STOCK_INICIAL,
+                "price": rng.randrange(1_000, 120_000, 100),
+                "image_filename": f"producto-{i}.png",
+            }
+            for i in range(productos)
+        ])
+        precios = dict(conn.execute(select(farmacia.ProductDB.id, farmacia.ProductDB.price)).all())
+        ids_productos = sorted(precios)
+
+        rol_cliente = conn.execute(select(farmacia.RoleDB.id).where(farmacia.RoleDB.name == "cliente")).scalar()
+        # Un solo hash para todos: bcrypt por usuario haría la siembra muy lenta
+        hash_compartido = farmacia.get_password_hash(PASSWORD_USUARIOS)
+        insertar_por_lotes(conn, farmacia.UserDB, [
+            {"username": f"cliente{i}", "hashed_password": hash_compartido, "role_id": rol_cliente}
+            for i in range(usuarios)
+        ])
+        ids_clientes = conn.execute(select(farmacia.UserDB.id).where(farmacia.UserDB.role_id == rol_cliente)).scalars().all()
+
+        # Mismas reglas que la app: el alta deja el saldo inicial en el ledger, las
+        # órdenes descuentan stock al crearse y solo las confirmadas van al ledger
+        inicio_ledger = ahora - timedelta(days=181)
+        filas_stock = [
+            {"product_id": p, "timestamp": inicio_ledger, "change": STOCK_INICIAL, "description": "Stock inicial"}
+            for p in ids_productos
+        ]
+        vendidos = dict.fromkeys(ids_productos, 0)
+        filas_ordenes, filas_items, filas_financieros = [], [], []
+        siguiente_orden = (conn.execute(select(func.max(farmacia.OrderDB.id))).scalar() or 0) + 1
+        for orden_id in range(siguiente_orden, siguiente_orden + ordenes):
+            creada = ahora - timedelta(minutes=rng.randrange(0, 180 * 24 * 60))
+            items = rng.sample(ids_productos, rng.randint(1, min(5, len(ids_productos))))
+            cantidades = [rng.randint(1, 3) for _ in items]
+            total = sum(precios[p] * q for p, q in zip(items, cantidades))
+            confirmada = rng.random() < 0.8
+            pagada = confirmada and rng.random() < 0.7
+            filas_ordenes.append({
+                "id": orden_id,
+                "client_id": rng.choice(ids_clientes),
+                "status": "confirmed" if confirmada else "pending",
+                "total": total,
+                "created_at": creada,
+                "stripe_payment_intent_id": f"pi_seed_{orden_id}" if pagada else None,
+                "payment_status": "paid" if pagada else "unpaid",
+            })
+            for producto_id, cantidad in zip(items, cantidades):
+                filas_items.append({"order_id": orden_id, "product_id": producto_id, "quantity": cantidad})
+                vendidos[producto_id] += cantidad
+                if confirmada:
+                    filas_stock.append({
+                        "product_id": producto_id, "timestamp": creada, "change": -cantidad,
+                        "description": f"Orden {orden_id}",
+                    })
+            if confirmada:
+                filas_financieros.append({
+                    "order_id": orden_id, "timestamp": creada, "amount": total,
+                    "description": f"Pago orden {orden_id}",
+                })
+        insertar_por_lotes(conn, farmacia.OrderDB, filas_ordenes)
+        insertar_por_lotes(conn, farmacia.OrderItemDB, filas_items)
+        insertar_por_lotes(conn, farmacia.FinancialMovementDB, filas_financieros)
+        filas_stock.sort(key=lambda fila: fila["timestamp"])
+        insertar_por_lotes(conn, farmacia.StockMovementDB, filas_stock)
+        conn.execute(
+            update(farmacia.ProductDB).where(farmacia.ProductDB.id == bindparam("pid")).values(stock=bindparam("restante")),
+            [{"pid": p, "restante": STOCK_INICIAL - n} for p, n in vendidos.items()],
+        )
+
+    db = farmacia.SessionLocal()
+    try:
+        farmacia.backfill_rollups(db)
+    finally:
+        db.close()
+
+    return {
+        "productos": ids_productos,
+        "clientes": [f"cliente{i}" for i in range(usuarios)],
+        "movimientos": {"financieros": len(filas_financieros), "stock": len(filas_stock)},
+    }
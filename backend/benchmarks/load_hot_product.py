@@ -0,0 +1,88 @@
+"""
+Prueba de carga sobre un único producto "caliente".
+
+Lanza más pedidos concurrentes que unidades en stock y verifica que no
+haya sobreventa: pedidos aceptados == stock inicial y stock final == 0.
+Reporta el throughput de POST /orders/.
+
+    python benchmarks/load_hot_product.py [--stock 200] [--pedidos 400] [--concurrencia 32]
+
+Para medir contra MySQL basta con exportar DATABASE_URL.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_hot.db")
+
+import httpx  # noqa: E402
+
+import farmacia  # noqa: E402
+
+# Sin lifespan (ASGITransport no lo ejecuta): se crea el esquema a mano
+farmacia.init_database()
+
+
+def sembrar_producto(stock: int) -> int:
+    db = farmacia.SessionLocal()
+    product = farmacia.ProductDB(name=f"Producto caliente {time.time_ns()}", stock=stock, price=1000)
+    db.add(product)
+    db.commit()
+    product_id = product.id
+    db.close()
+    return product_id
+
+
+def stock_actual(product_id: int) -> int:
+    db = farmacia.SessionLocal()
+    stock = db.get(farmacia.ProductDB, product_id).stock
+    db.close()
+    return stock
+
+
+async def ejecutar(stock: int, pedidos: int, concurrencia: int):
+    product_id = sembrar_producto(stock)
+    transport = httpx.ASGITransport(app=farmacia.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://load", timeout=60) as client:
+        r = await client.post("/token", data={"username": "admin", "password": "fasapisecrets"})
+        headers = {"Authorization": f"Bearer {r.json()['access_token']}"}
+        payload = {"items": [{"product_id": product_id, "quantity": 1}]}
+        codigos = {}
+        semaforo = asyncio.Semaphore(concurrencia)
+
+        async def pedir():
+            async with semaforo:
+                r = await client.post("/orders/", json=payload, headers=headers)
+                codigos[r.status_code] = codigos.get(r.status_code, 0) + 1
+
+        inicio = time.perf_counter()
+        await asyncio.gather(*(pedir() for _ in range(pedidos)))
+        duracion = time.perf_counter() - inicio
+
+    aceptados = codigos.get(200, 0)
+    final = stock_actual(product_id)
+    print(f"códigos de respuesta: {dict(sorted(codigos.items()))}")
+    print(f"aceptados={aceptados} stock_inicial={stock} stock_final={final}")
+    print(f"throughput={pedidos / duracion:.1f} pedidos/s ({duracion:.2f} s, concurrencia={concurrencia})")
+
+    sobreventa = aceptados > stock or final < 0 or aceptados + final != stock
+    if sobreventa:
+        print("ERROR: sobreventa o inventario inconsistente")
+        sys.exit(1)
+    print("OK: sin sobreventa")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stock", type=int, default=200)
+    parser.add_argument("--pedidos", type=int, default=400)
+    parser.add_argument("--concurrencia", type=int, default=32)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(ejecutar(args.stock, args.pedidos, args.concurrencia))
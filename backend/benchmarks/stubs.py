@@ -0,0 +1,105 @@
+"""
+Sustitutos en proceso de los servicios externos (Lambda, S3, Stripe, Selenium).
+
+Los benchmarks miden la app, no la red: cada stub responde al instante con
+una forma de respuesta compatible con la que espera farmacia.py.
+"""
+import itertools
+from types import SimpleNamespace
+
+import farmacia
+
+
+async def lambda_post(url: str, payload: dict):
+    return 200, {"data": {}}
+
+
+class S3Stub:
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"https://s3.bench.local/{Params['Bucket']}/{Params['Key']}?expira={ExpiresIn}"
+
+    def head_object(self, Bucket, Key):
+        return {}
+
+    def get_object(self, Bucket, Key):
+        raise FileNotFoundError(Key)
+
+    def put_object(self, **kwargs):
+        return {}
+
+
+class StripeError(Exception):
+    pass
+
+
+class InvalidRequestError(StripeError):
+    pass
+
+
+class SignatureVerificationError(StripeError):
+    pass
+
+
+class PaymentIntentStub:
+    _ids = itertools.count(1)
+    _intents = {}
+
+    @classmethod
+    def create(cls, amount, currency, metadata, idempotency_key=None):
+        if idempotency_key in cls._intents:
+            return cls._intents[idempotency_key]
+        n = next(cls._ids)
+        intent = SimpleNamespace(
+            id=f"pi_bench_{n}", status="requires_payment_method", amount=amount,
+            client_secret=f"pi_bench_{n}_secret", metadata=metadata,
+        )
+        cls._intents[idempotency_key] = cls._intents[intent.id] = intent
+        return intent
+
+    @classmethod
+    def retrieve(cls, intent_id):
+        if intent_id not in cls._intents:
+            raise InvalidRequestError(intent_id)
+        return cls._intents[intent_id]
+
+    @classmethod
+    def modify(cls, intent_id, amount):
+        intent = cls.retrieve(intent_id)
+        intent.amount = amount
+        return intent
+
+
+stripe_stub = SimpleNamespace(
+    PaymentIntent=PaymentIntentStub,
+    StripeError=StripeError,
+    InvalidRequestError=InvalidRequestError,
+    SignatureVerificationError=SignatureVerificationError,
+)
+
+
+class ElementoStub:
+    text = "$ 12.345"
+
+    def is_displayed(self):
+        return True
+
+
+class WebDriverStub:
+    current_url = "about:blank"
+
+    def get(self, url):
+        self.current_url = url
+
+    def find_element(self, by, value):
+        return ElementoStub()
+
+    def quit(self):
+        pass
+
+
+def instalar():
+    """Reemplaza los clientes externos de farmacia por los stubs."""
+    farmacia.lambda_validator.post = lambda_post
+    farmacia.s3_client = S3Stub()
+    farmacia.get_stripe = lambda: stripe_stub
+    farmacia.webdriver_pool._create = WebDriverStub
@@ -0,0 +1,235 @@
+"""
+Suite de benchmarks de farmacia:app en proceso (httpx + ASGITransport).
+
+Siembra datos reproducibles (ver datos.py), reemplaza Lambda/S3/Stripe/Selenium
+por stubs (ver stubs.py) y ejecuta los escenarios:
+
+    login          ráfaga de POST /token
+    catalogo       GET /products/ (snapshot, páginas y detalle)
+    pedidos        POST /orders/ con 1 a 5 ítems
+    confirmacion   POST /orders/{id}/confirm sobre órdenes pendientes
+    libros         GET /financial_movements/ y /stock_movements/ paginados
+
+Reporta p50/p95/p99 y throughput, y los guarda en JSON para comparar commits:
+
+    python benchmarks/suite.py --salida baseline.json
+    python benchmarks/suite.py --comparar baseline.json [--tolerancia 0.15]
+
+Por defecto usa una base SQLite temporal. Para MySQL local (p. ej. el
+contenedor de docker-compose) se exporta DATABASE_URL y se pasa --reiniciar,
+que borra y recrea el esquema de esa base.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_suite.db")
+
+import httpx  # noqa: E402
+
+import farmacia  # noqa: E402
+import datos  # noqa: E402
+import stubs  # noqa: E402
+
+ESCENARIOS = ("login", "catalogo", "pedidos", "confirmacion", "libros")
+
+
+def percentil(valores, p):
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(len(ordenados) * p))]
+
+
+async def correr(peticion, total: int, concurrencia: int, esperados=(200,)) -> dict:
+    """Ejecuta `total` peticiones con a lo sumo `concurrencia` en vuelo."""
+    latencias = []
+    codigos = {}
+    semaforo = asyncio.Semaphore(concurrencia)
+
+    async def una(i):
+        async with semaforo:
+            inicio = time.perf_counter()
+            r = await peticion(i)
+            latencias.append((time.perf_counter() - inicio) * 1000)
+            codigos[r.status_code] = codigos.get(r.status_code, 0) + 1
+
+    inicio = time.perf_counter()
+    await asyncio.gather(*(una(i) for i in range(total)))
+    duracion = time.perf_counter() - inicio
+    return {
+        "peticiones": total,
+        "concurrencia": concurrencia,
+        "errores": sum(n for codigo, n in codigos.items() if codigo not in esperados),
+        "codigos": {str(k): v for k, v in sorted(codigos.items())},
+        "p50_ms": round(percentil(latencias, 0.50), 3),
+        "p95_ms": round(percentil(latencias, 0.95), 3),
+        "p99_ms": round(percentil(latencias, 0.99), 3),
+        "media_ms": round(statistics.mean(latencias), 3),
+        "throughput_rps": round(total / duracion, 2),
+        "duracion_s": round(duracion, 3),
+    }
+
+
+async def token(client, username, password) -> dict:
+    r = await client.post("/token", data={"username": username, "password": password})
+    r.raise_for_status()
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+async def escenario_login(client, ctx, rng, total, concurrencia):
+    usuarios = [rng.choice(ctx["clientes"]) for _ in range(total)]
+    return await correr(
+        lambda i: client.post("/token", data={"username": usuarios[i], "password": datos.PASSWORD_USUARIOS}),
+        total, concurrencia,
+    )
+
+
+async def escenario_catalogo(client, ctx, rng, total, concurrencia):
+    ids = ctx["productos"]
+    rutas = []
+    for _ in range(total):
+        tipo = rng.random()
+        if tipo < 0.3:
+            rutas.append("/products/")
+        elif tipo < 0.7:
+            rutas.append(f"/products/?limit=50&after={rng.choice(ids)}")
+        else:
+            rutas.append(f"/products/{rng.choice(ids)}")
+    return await correr(lambda i: client.get(rutas[i]), total, concurrencia)
+
+
+async def escenario_pedidos(client, ctx, rng, total, concurrencia):
+    cuerpos = [
+        {"items": [{"product_id": p, "quantity": rng.randint(1, 3)}
+                   for p in rng.sample(ctx["productos"], rng.randint(1, 5))]}
+        for _ in range(total)
+    ]
+    headers = ctx["cliente"]
+    return await correr(lambda i: client.post("/orders/", json=cuerpos[i], headers=headers), total, concurrencia)
+
+
+async def escenario_confirmacion(client, ctx, rng, total, concurrencia):
+    # Preparación fuera de la medición: una orden pendiente por petición
+    ordenes = []
+    for _ in range(total):
+        cuerpo = {"items": [{"product_id": rng.choice(ctx["productos"]), "quantity": 1}]}
+        r = await client.post("/orders/", json=cuerpo, headers=ctx["cliente"])
+        r.raise_for_status()
+        ordenes.append(r.json()["order_id"])
+    headers = ctx["admin"]
+    return await correr(lambda i: client.post(f"/orders/{ordenes[i]}/confirm", headers=headers), total, concurrencia)
+
+
+async def escenario_libros(client, ctx, rng, total, concurrencia):
+    rutas = []
+    for _ in range(total):
+        recurso = rng.choice(("financial_movements", "stock_movements"))
+        limite = ctx["movimientos"]["financieros" if recurso == "financial_movements" else "stock"]
+        rutas.append(f"/{recurso}/?limit=100&after={rng.randint(0, max(limite - 100, 0))}")
+    headers = ctx["admin"]
+    return await correr(lambda i: client.get(rutas[i], headers=headers), total, concurrencia)
+
+
+async def ejecutar(args) -> dict:
+    if args.reiniciar:
+        farmacia.Base.metadata.drop_all(bind=farmacia.engine)
+    farmacia.init_database()
+    inicio = time.perf_counter()
+    ctx = datos.sembrar(args.semilla, args.productos, args.usuarios, args.ordenes)
+    print(f"siembra: {len(ctx['productos'])} productos, {len(ctx['clientes'])} clientes, {args.ordenes} órdenes, "
+          f"{sum(ctx['movimientos'].values())} movimientos ({time.perf_counter() - inicio:.1f} s)")
+    stubs.instalar()
+
+    resultados = {}
+    transport = httpx.ASGITransport(app=farmacia.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=120) as client:
+        ctx["admin"] = await token(client, "admin", "fasapisecrets")
+        ctx["cliente"] = await token(client, ctx["clientes"][0], datos.PASSWORD_USUARIOS)
+        for nombre in args.escenarios:
+            funcion = globals()[f"escenario_{nombre}"]
+            # Cada escenario tiene su propio generador: agregar uno no altera a los demás
+            rng = random.Random(f"{args.semilla}-{nombre}")
+            total = args.logins if nombre == "login" else args.peticiones
+            resultados[nombre] = r = await funcion(client, ctx, rng, total, args.concurrencia)
+            print(f"{nombre:<13} p50={r['p50_ms']:8.2f} ms  p95={r['p95_ms']:8.2f} ms  p99={r['p99_ms']:8.2f} ms  "
+                  f"{r['throughput_rps']:8.1f} req/s  errores={r['errores']}")
+    await farmacia.async_engine.dispose()
+    return resultados
+
+
+def commit_actual():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(actual: dict, base: dict, tolerancia: float) -> bool:
+    """Imprime las diferencias con la línea base; True si hay regresiones."""
+    print(f"\nComparación con {base['meta'].get('commit')} (tolerancia {tolerancia:.0%}):")
+    regresion = False
+    for nombre, r in actual["escenarios"].items():
+        b = base["escenarios"].get(nombre)
+        if b is None:
+            print(f"  {nombre:<13} sin línea base")
+            continue
+        cambios = []
+        for clave in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            delta = (r[clave] - b[clave]) / b[clave] if b[clave] else 0.0
+            cambios.append(f"{clave}={r[clave]:.2f} ({delta:+.1%})")
+        peor = r["p95_ms"] > b["p95_ms"] * (1 + tolerancia) or r["throughput_rps"] < b["throughput_rps"] * (1 - tolerancia)
+        regresion |= peor
+        print(f"  {nombre:<13} {'REGRESIÓN ' if peor else ''}{'  '.join(cambios)}")
+    return regresion
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--semilla", type=int, default=42)
+    parser.add_argument("--productos", type=int, default=2000)
+    parser.add_argument("--usuarios", type=int, default=500)
+    parser.add_argument("--ordenes", type=int, default=5000)
+    parser.add_argument("--peticiones", type=int, default=500, help="peticiones por escenario")
+    parser.add_argument("--logins", type=int, default=100, help="peticiones del escenario login (bcrypt es caro)")
+    parser.add_argument("--concurrencia", type=int, default=16)
+    parser.add_argument("--escenarios", nargs="+", choices=ESCENARIOS, default=list(ESCENARIOS))
+    parser.add_argument("--salida", help="archivo JSON donde guardar los resultados")
+    parser.add_argument("--comparar", help="JSON de una corrida anterior (línea base)")
+    parser.add_argument("--tolerancia", type=float, default=0.15)
+    parser.add_argument("--reiniciar", action="store_true", help="borra y recrea el esquema antes de sembrar")
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    resultado = {
+        "meta": {
+            "commit": commit_actual(),
+            "fecha": datetime.utcnow().isoformat(timespec="seconds"),
+            "base_de_datos": farmacia.engine.dialect.name,
+            "python": platform.python_version(),
+            "semilla": args.semilla,
+            "datos": {"productos": args.productos, "usuarios": args.usuarios, "ordenes": args.ordenes},
+            "concurrencia": args.concurrencia,
+        },
+        "escenarios": asyncio.run(ejecutar(args)),
+    }
+    if args.salida:
+        with open(args.salida, "w") as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+        print(f"\nresultados guardados en {args.salida}")
+    if args.comparar:
+        with open(args.comparar) as f:
+            if comparar(resultado, json.load(f), args.tolerancia):
+                sys.exit(1)
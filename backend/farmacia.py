@@ -1,35 +1,225 @@
 import os
-from datetime import datetime, timedelta
-from typing import List, Optional
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import datetime, timedelta, date
+from typing import List, Optional, NamedTuple, Union
+from collections import OrderedDict, Counter, defaultdict
 from dotenv import load_dotenv
 from fastapi import FastAPI, Depends, HTTPException, status, Request, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from passlib.context import CryptContext
-from pydantic import BaseModel, constr, conint
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Float
+from pydantic import BaseModel, Field, constr, conint
+from sqlalchemy import create_engine, inspect, Column, Integer, String, Text, Boolean, ForeignKey, DateTime, Date, Float, Index, func, literal, select, delete, insert, update, or_
+from sqlalchemy.exc import OperationalError, IntegrityError
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship, joinedload
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, selectinload
+from starlette.concurrency import run_in_threadpool
+from starlette.datastructures import Headers, MutableHeaders
 import jwt
-import boto3
-from selenium import webdriver
-from selenium.webdriver import Remote
-from selenium.webdriver.firefox.options import Options as FirefoxOptions
-from selenium.webdriver.common.by import By
 import time
+import threading
+import queue
+from contextlib import contextmanager, asynccontextmanager
 import urllib.parse
-import stripe
-import requests
+import httpx
 import json
 import re
-from rapidfuzz import fuzz
-from cryptography.fernet import Fernet, InvalidToken
-from fastapi.responses import JSONResponse
+from rapidfuzz import fuzz, process
+import unicodedata
+from cryptography.fernet import Fernet, MultiFernet, InvalidToken
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+import orjson
+import hashlib
+import io
 import secrets
+import random
 import logging
+import contextvars
+import atexit
+import copy
+import sys
+import uuid
+import socket
+import logging.handlers
+import itertools
+import prometheus_client as prom
+from prometheus_client import multiprocess as prom_multiprocess
+from prometheus_client.core import GaugeMetricFamily, CounterMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 load_dotenv()
 
+# -----------------------------
+# Logging
+# -----------------------------
+# Los handlers escriben en un hilo aparte (QueueListener): en la petición solo
+# se encola el registro. LOG_FORMAT=text da una salida legible para desarrollo.
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# Fracción de los eventos DEBUG que se conservan (los de INFO en adelante, todos)
+LOG_DEBUG_SAMPLE_RATE = float(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1.0"))
+
+request_id_var: contextvars.ContextVar = contextvars.ContextVar("request_id", default=None)
+
+class RequestContextFilter(logging.Filter):
+    """Agrega el id de la petición en curso; corre en el hilo que emite el log."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get() or "-"
+        return True
+
+class DebugSamplingFilter(logging.Filter):
+    """Descarta al azar eventos DEBUG antes de encolarlos."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.DEBUG or self.rate >= 1 or random.random() < self.rate
+
+class StructuredQueueHandler(logging.handlers.QueueHandler):
+    """Encola el mensaje ya resuelto y el traceback como texto aparte (exc_text)."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.utcfromtimestamp(record.created).isoformat(timespec="milliseconds") + "Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if getattr(record, "request_id", "-") != "-":
+            entry["request_id"] = record.request_id
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return orjson.dumps(entry).decode()
+
+def route_uvicorn_logs():
+    """uvicorn instala sus propios StreamHandlers sin propagar: se quitan para que
+    sus líneas (incluido el access log) pasen por la cola con el request_id."""
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+def setup_logging() -> logging.handlers.QueueListener:
+    output = logging.StreamHandler(sys.stderr)
+    if LOG_FORMAT == "json":
+        output.setFormatter(JsonFormatter())
+    else:
+        output.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+    log_queue = queue.SimpleQueue()
+    handler = StructuredQueueHandler(log_queue)
+    handler.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE))
+    handler.addFilter(RequestContextFilter())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(LOG_LEVEL)
+    route_uvicorn_logs()
+    listener = logging.handlers.QueueListener(log_queue, output, respect_handler_level=True)
+    listener.start()
+    # Al salir se vacía la cola antes de cerrar el proceso
+    atexit.register(listener.stop)
+    return listener
+
+log_listener = setup_logging()
+
+# -----------------------------
+# Métricas (Prometheus)
+# -----------------------------
+# Con varios workers, PROMETHEUS_MULTIPROC_DIR hace que /metrics agregue
+# los valores de todos los procesos (ver prometheus_client multiprocess).
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+
+HTTP_REQUEST_SECONDS = prom.Histogram(
+    "http_request_duration_seconds", "Latencia por ruta", ["method", "route", "status"],
+)
+DB_QUERIES_PER_REQUEST = prom.Histogram(
+    "db_queries_per_request", "Consultas SQL por petición", ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100, 250),
+)
+DB_QUERY_SECONDS = prom.Histogram("db_query_duration_seconds", "Duración de cada consulta SQL")
+DB_POOL_CHECKOUT_WAIT = prom.Histogram(
+    "db_pool_checkout_wait_seconds", "Espera para obtener una conexión del pool",
+    buckets=(0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+N_PLUS_ONE_TOTAL = prom.Counter(
+    "db_n_plus_one_total", "Peticiones que repiten la misma consulta N veces o más", ["route"],
+)
+EXTERNAL_CALL_SECONDS = prom.Histogram(
+    "external_call_duration_seconds", "Duración de llamadas salientes", ["service", "outcome"],
+)
+
+class RequestStats:
+    """Consultas SQL hechas durante una petición."""
+
+    __slots__ = ("queries", "db_seconds", "statements", "writes")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.statements = Counter()
+        self.writes = 0  # INSERT/UPDATE/DELETE ejecutados
+
+request_stats: contextvars.ContextVar = contextvars.ContextVar("request_stats", default=None)
+
+@contextmanager
+def external_call(service: str):
+    """Mide una llamada saliente (lambda, s3, selenium, stripe)."""
+    start = time.perf_counter()
+    outcome = "error"
+    try:
+        yield
+        outcome = "ok"
+    finally:
+        EXTERNAL_CALL_SECONDS.labels(service, outcome).observe(time.perf_counter() - start)
+
+def instrument_engine(sync_engine):
+    """Cuenta y cronometra cada consulta del motor en la petición en curso."""
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        DB_QUERY_SECONDS.observe(elapsed)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+            stats.statements[statement] += 1
+            if context.isinsert or context.isupdate or context.isdelete:
+                stats.writes += 1
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    """Pool que mide cuánto espera cada checkout por una conexión."""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            DB_POOL_CHECKOUT_WAIT.observe(time.perf_counter() - start)
+
 # -----------------------------
 # Configuración de la base de datos (MySQL)
 # -----------------------------
@@ -37,30 +227,174 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise RuntimeError("DATABASE_URL no configurada en el entorno")
 
-engine = create_engine(
-    DATABASE_URL,
-    pool_pre_ping=True,
-    pool_size=10,
-    max_overflow=20
-)
+def get_async_database_url(url: str) -> str:
+    """Traduce la URL síncrona a su equivalente con driver asíncrono."""
+    scheme, rest = url.split("://", 1)
+    if scheme.startswith("mysql"):
+        return f"mysql+aiomysql://{rest}"
+    if scheme.startswith("sqlite"):
+        # aiosqlite se usa como sustituto local de MySQL en pruebas
+        return f"sqlite+aiosqlite://{rest}"
+    return url
+
+def engine_options(url: str) -> dict:
+    """Opciones del pool; SQLite no admite pool_size/max_overflow."""
+    if url.startswith("sqlite"):
+        return {}
+    return {"pool_pre_ping": True, "pool_size": 10, "max_overflow": 20}
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or get_async_database_url(DATABASE_URL)
+
+# Motor síncrono: solo para crear el esquema y los datos iniciales
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+# Motor asíncrono: lo usan todos los endpoints para no bloquear el event loop
+async_engine_options = engine_options(ASYNC_DATABASE_URL)
+if async_engine_options:  # pool de tamaño fijo (MySQL): se mide la espera del checkout
+    async_engine_options["poolclass"] = TimedAsyncQueuePool
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **async_engine_options)
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = sessionmaker(
+    bind=async_engine,
+    class_=AsyncSession,
+    autoflush=False,
+    expire_on_commit=False,
+)
+
+# Réplicas de lectura opcionales (URLs separadas por coma, mismo formato que DATABASE_URL)
+DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv("DATABASE_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_HEALTH_INTERVAL = float(os.getenv("REPLICA_HEALTH_INTERVAL", "5"))  # segundos entre chequeos
+REPLICA_HEALTH_TIMEOUT = float(os.getenv("REPLICA_HEALTH_TIMEOUT", "2"))
+# Tras escribir, un cliente lee del primario durante esta ventana (retraso de replicación)
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "10"))
+
+class ReplicaPool:
+    """Réplicas de solo lectura con selección round-robin entre las sanas."""
+
+    def __init__(self, urls: List[str]):
+        self.engines = []
+        for url in urls:
+            async_url = get_async_database_url(url)
+            options = engine_options(async_url)
+            if options:
+                options["poolclass"] = TimedAsyncQueuePool
+            replica = create_async_engine(async_url, **options)
+            instrument_engine(replica.sync_engine)
+            self.engines.append(replica)
+        self.healthy = list(self.engines)
+        self._counter = itertools.count()
+
+    def pick(self):
+        """Siguiente réplica sana, o None si no hay (se lee del primario)."""
+        healthy = self.healthy
+        if not healthy:
+            return None
+        return healthy[next(self._counter) % len(healthy)]
+
+    def mark_down(self, replica):
+        if replica in self.healthy:
+            self.healthy = [e for e in self.healthy if e is not replica]
+            logging.warning("Réplica %s fuera de rotación", replica.url.render_as_string(hide_password=True))
+
+    async def _ping(self, replica) -> bool:
+        try:
+            async with replica.connect() as conn:
+                await conn.execute(select(literal(1)))
+            return True
+        except Exception:
+            return False
+
+    async def check(self):
+        """SELECT 1 contra cada réplica; las que fallan salen de la rotación hasta responder."""
+        healthy = []
+        for replica in self.engines:
+            try:
+                ok = await asyncio.wait_for(self._ping(replica), REPLICA_HEALTH_TIMEOUT)
+            except asyncio.TimeoutError:
+                ok = False
+            if ok:
+                if replica not in self.healthy:
+                    logging.info("Réplica %s de vuelta en rotación", replica.url.render_as_string(hide_password=True))
+                healthy.append(replica)
+            else:
+                self.mark_down(replica)
+        self.healthy = healthy
+
+    async def dispose(self):
+        for replica in self.engines:
+            await replica.dispose()
+
+replicas = ReplicaPool(DATABASE_REPLICA_URLS)
+
 Base = declarative_base()
 
 # -----------------------------
 # Seguridad: Hashing y cifrado (Fernet)
 # -----------------------------
-# Genera una nueva clave segura
-key = Fernet.generate_key()
-secret = secrets.token_urlsafe(32)
+# Las claves salen de la configuración para que todos los workers y hosts
+# compartan las mismas. Formato de llavero (la primera es la activa):
+#   FERNET_KEYS=<clave nueva>,<clave anterior>
+#   JWT_KEYS=<kid nuevo>:<secreto>,<kid anterior>:<secreto>
+# Para rotar se antepone la clave nueva y se retira la vieja cuando ya no
+# quedan tokens ni hashes que dependan de ella.
+IS_PRODUCTION = os.getenv("ENV") == "production"
+# Workers de uvicorn (lee la misma variable que uvicorn --workers)
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+# Con DB_INIT_ON_STARTUP=false el esquema se gestiona aparte (migraciones,
+# un solo proceso de despliegue) y los workers arrancan sin tocar la base
+DB_INIT_ON_STARTUP = os.getenv("DB_INIT_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+def split_keys(value: Optional[str]) -> List[str]:
+    return [item.strip() for item in (value or "").split(",") if item.strip()]
+
+def check_temporary_key(name: str):
+    """Una clave temporal solo sirve si un único proceso cifra, firma y verifica.
+
+    Con varios workers, o con la base inicializada en un proceso aparte (el
+    admin sembrado quedaría cifrado con una clave que ningún worker tiene),
+    cada proceso generaría la suya: se exige configurarla.
+    """
+    if IS_PRODUCTION:
+        reason = "ENV=production"
+    elif WEB_CONCURRENCY > 1:
+        reason = f"WEB_CONCURRENCY={WEB_CONCURRENCY}"
+    elif not DB_INIT_ON_STARTUP:
+        reason = "DB_INIT_ON_STARTUP=false"
+    else:
+        logging.warning("%s no configurada: se usa una clave temporal (solo desarrollo, un solo proceso)", name)
+        return
+    raise RuntimeError(f"{name} no configurada; es obligatoria con {reason}")
+
+def load_fernet_keys() -> List[bytes]:
+    keys = split_keys(os.getenv("FERNET_KEYS")) or split_keys(os.getenv("FERNET_KEY"))
+    if keys:
+        return [k.encode() for k in keys]
+    check_temporary_key("FERNET_KEYS")
+    return [Fernet.generate_key()]
+
+def load_jwt_keys() -> "OrderedDict[str, str]":
+    keys = OrderedDict()
+    for item in split_keys(os.getenv("JWT_KEYS")):
+        kid, sep, secret = item.partition(":")
+        if not sep or not kid or not secret:
+            raise RuntimeError("JWT_KEYS debe tener el formato kid:secreto[,kid:secreto...]")
+        keys[kid] = secret
+    if not keys and os.getenv("SECRET_KEY"):
+        keys["default"] = os.getenv("SECRET_KEY")
+    if not keys:
+        check_temporary_key("JWT_KEYS")
+        keys["dev"] = secrets.token_urlsafe(32)
+    return keys
+
 # Contexto bcrypt para hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
-# Clave de cifrado Fernet
-FERNET_KEY = key
-if not FERNET_KEY:
-    raise RuntimeError("FERNET_KEY no configurada")
-cipher_suite = Fernet(FERNET_KEY)
+# Llavero Fernet: cifra con la primera clave y descifra con cualquiera
+FERNET_KEYS = load_fernet_keys()
+primary_cipher = Fernet(FERNET_KEYS[0])
+cipher_suite = MultiFernet([Fernet(k) for k in FERNET_KEYS])
 
 # Funciones de hashing + cifrado de contraseñas
 
@@ -81,10 +415,86 @@ def verify_password(plain_password: str, token_hash: str) -> bool:
     # 2) compara con bcrypt
     return pwd_context.verify(plain_password, decrypted.decode())
 
+def rotate_password_token(token_hash: str) -> Optional[str]:
+    """Recifra con la clave activa un hash guardado con una clave anterior."""
+    try:
+        primary_cipher.decrypt(token_hash.encode())
+        return None
+    except InvalidToken:
+        return cipher_suite.rotate(token_hash.encode()).decode()
+
+# -----------------------------
+# Pool de hashing de contraseñas
+# -----------------------------
+# bcrypt y Fernet son costosos en CPU: se ejecutan fuera del event loop,
+# en un pool acotado que rechaza trabajo (503) cuando está saturado.
+PASSWORD_HASH_EXECUTOR = os.getenv("PASSWORD_HASH_EXECUTOR", "thread")  # "thread" o "process"
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "32"))
+
+class PasswordHasherPool:
+    """Pool dedicado para hashing/verificación con control de admisión y métricas."""
+
+    def __init__(self, kind: str, workers: int, max_pending: int):
+        executor_cls = ProcessPoolExecutor if kind == "process" else ThreadPoolExecutor
+        self.kind = kind
+        self.workers = workers
+        self.executor = executor_cls(max_workers=workers)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Servicio de autenticación saturado, intenta de nuevo",
+                headers={"Retry-After": "1"},
+            )
+        self.pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, func, *args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.pending -= 1
+            self.completed += 1
+            self.total_latency += elapsed
+            self.max_latency = max(self.max_latency, elapsed)
+
+    def metrics(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "queue_depth": self.pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_latency_ms": (self.total_latency / self.completed * 1000) if self.completed else 0.0,
+            "max_latency_ms": self.max_latency * 1000,
+        }
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+password_hasher = PasswordHasherPool(PASSWORD_HASH_EXECUTOR, PASSWORD_HASH_WORKERS, PASSWORD_HASH_MAX_PENDING)
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
+async def verify_password_async(plain_password: str, token_hash: str) -> bool:
+    return await password_hasher.run(verify_password, plain_password, token_hash)
+
 # -----------------------------
 # Configuración JWT
 # -----------------------------
-SECRET_KEY = secret
+JWT_KEYS = load_jwt_keys()
+JWT_ACTIVE_KID = next(iter(JWT_KEYS))
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
@@ -105,22 +515,28 @@ class UserDB(Base):
     role_id = Column(Integer, ForeignKey("roles.id"))
     role = relationship("RoleDB")
 
+class TokenVersionDB(Base):
+    """Versión vigente de los tokens de un usuario: revocarlos es incrementarla."""
+    __tablename__ = "token_versions"
+    user_id = Column(Integer, primary_key=True)  # sin FK: sobrevive al borrado del usuario
+    version = Column(Integer, nullable=False, default=0)
+
 class ProductDB(Base):
     __tablename__ = "products"
     id = Column(Integer, primary_key=True, index=True)
     name = Column(String(100), unique=True)
-    stock = Column(Integer)
+    stock = Column(Integer, index=True)  # DELETE /products/out-of-stock
     price = Column(Integer)
     image_filename = Column(String(200), nullable=True)
 
 class OrderDB(Base):
     __tablename__ = "orders"
     id = Column(Integer, primary_key=True, index=True)
-    client_id = Column(Integer, ForeignKey("users.id"))
-    status = Column(String(20), default="pending")
+    client_id = Column(Integer, ForeignKey("users.id"), index=True)
+    status = Column(String(20), default="pending", index=True)
     total = Column(Float, default=0.0)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    stripe_payment_intent_id = Column(String(100), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+    stripe_payment_intent_id = Column(String(100), nullable=True, index=True)  # webhooks de Stripe
     payment_status = Column(String(20), default="unpaid")
     
     client = relationship("UserDB")
@@ -129,7 +545,7 @@ class OrderDB(Base):
 class OrderItemDB(Base):
     __tablename__ = "order_items"
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
     product_id = Column(Integer, ForeignKey("products.id"))
     quantity = Column(Integer)
     
@@ -140,16 +556,16 @@ class OrderItemDB(Base):
 class FinancialMovementDB(Base):
     __tablename__ = "financial_movements"
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id"))
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     amount = Column(Float)
     description = Column(String(255))
 
 class StockMovementDB(Base):
     __tablename__ = "stock_movements"
     id = Column(Integer, primary_key=True, index=True)
-    product_id = Column(Integer, ForeignKey("products.id"))
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    product_id = Column(Integer, ForeignKey("products.id"), index=True)
+    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
     change = Column(Integer)  # negativo para disminución, positivo para aumento
     description = Column(String(255))
 
@@ -161,8 +577,67 @@ class ExternalPrice(Base):
     url = Column(String(2083), nullable=False)
     updated_at = Column(DateTime, default=datetime.utcnow)
 
-# Crear todas las tablas
-Base.metadata.create_all(bind=engine)
+    # Precio más reciente de un producto: WHERE product_id = ? ORDER BY updated_at DESC
+    __table_args__ = (Index("ix_external_prices_product_updated", "product_id", "updated_at"),)
+
+# Agregados diarios/mensuales de los movimientos, mantenidos al confirmar órdenes
+class FinancialRollupDB(Base):
+    __tablename__ = "financial_rollups"
+    period = Column(String(5), primary_key=True)  # "day" o "month"
+    period_start = Column(Date, primary_key=True)
+    amount = Column(Float, default=0.0)
+    movements = Column(Integer, default=0)
+
+class StockRollupDB(Base):
+    __tablename__ = "stock_rollups"
+    period = Column(String(5), primary_key=True)  # "day" o "month"
+    period_start = Column(Date, primary_key=True)
+    product_id = Column(Integer, primary_key=True)
+    net_change = Column(Integer, default=0)
+    movements = Column(Integer, default=0)
+
+# Checkpoints de stock por producto: stock físico (disponible + reservado por órdenes
+# pendientes, que aún no salen en el ledger) + posición del ledger en ese momento
+class StockSnapshotDB(Base):
+    __tablename__ = "stock_snapshots"
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(Integer, nullable=False)
+    taken_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+    stock = Column(Integer, nullable=False)
+    last_movement_id = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (Index("ix_stock_snapshots_product_taken", "product_id", "taken_at"),)
+
+class PriceComparisonJobDB(Base):
+    __tablename__ = "price_comparison_jobs"
+    id = Column(Integer, primary_key=True, index=True)
+    status = Column(String(20), default="running")  # running, completed, interrupted, failed
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+    last_product_id = Column(Integer, default=0)  # progreso para reanudar
+    processed = Column(Integer, default=0)
+    failed = Column(Integer, default=0)
+    error = Column(String(255), nullable=True)
+
+class JobLockDB(Base):
+    """Lease de un job en segundo plano: solo un worker lo ejecuta a la vez."""
+    __tablename__ = "job_locks"
+    name = Column(String(50), primary_key=True)
+    owner = Column(String(64), nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class StripeEventDB(Base):
+    __tablename__ = "stripe_events"
+    id = Column(String(255), primary_key=True)  # id del evento en Stripe, deduplica reintentos
+    type = Column(String(100))
+    payload = Column(Text)
+    received_at = Column(DateTime, default=datetime.utcnow)
+    processed_at = Column(DateTime, nullable=True)
+    attempts = Column(Integer, default=0)
+    error = Column(String(255), nullable=True)
+
+    # Eventos pendientes en orden de llegada (reencolado al arrancar el worker)
+    __table_args__ = (Index("ix_stripe_events_pending", "processed_at", "received_at"),)
 
 # -----------------------------
 # Modelos Pydantic
@@ -180,28 +655,143 @@ class ProductCreate(BaseModel):
 # -----------------------------
 # Utilidades y funciones auxiliares
 # -----------------------------
-def get_db() -> Session:
-    db = SessionLocal()
+async def get_db() -> AsyncSession:
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Read-your-writes sin estado en el servidor: tras una escritura la respuesta
+# lleva X-Last-Write (epoch en segundos) y el frontend la reenvía en cada
+# petición; así cualquier worker sabe que ese cliente escribió hace poco.
+LAST_WRITE_HEADER = "X-Last-Write"
+
+def wrote_recently(request: Request) -> bool:
     try:
+        last_write = float(request.headers.get(LAST_WRITE_HEADER, ""))
+    except ValueError:
+        return False
+    return time.time() - last_write < READ_YOUR_WRITES_SECONDS
+
+class ReplicaSession(AsyncSession):
+    """Sesión sobre una réplica: si la réplica falla, la saca de rotación y repite la consulta en el primario."""
+
+    async def _with_fallback(self, method, *args, **kwargs):
+        try:
+            return await method(*args, **kwargs)
+        except OperationalError:
+            if self.bind is async_engine:
+                raise
+            replicas.mark_down(self.bind)
+            await self.rollback()
+            self.bind = async_engine
+            self.sync_session.bind = async_engine.sync_engine
+            return await method(*args, **kwargs)
+
+    async def execute(self, *args, **kwargs):
+        return await self._with_fallback(super().execute, *args, **kwargs)
+
+    async def get(self, *args, **kwargs):
+        return await self._with_fallback(super().get, *args, **kwargs)
+
+async def get_read_db(request: Request) -> AsyncSession:
+    """Sesión para endpoints de solo lectura: una réplica sana si hay.
+
+    Lee del primario si no hay réplicas sanas, si el cliente escribió hace poco
+    (X-Last-Write, read-your-writes) o si pide X-Read-Consistency: strong.
+    """
+    replica = None
+    if request.headers.get("x-read-consistency") != "strong" and not wrote_recently(request):
+        replica = replicas.pick()
+    if replica is None:
+        async with AsyncSessionLocal() as db:
+            yield db
+        return
+    async with ReplicaSession(bind=replica, autoflush=False, expire_on_commit=False) as db:
         yield db
-    finally:
-        db.close()
 
-def get_user(db: Session, username: str) -> UserDB:
-    return db.query(UserDB).filter(UserDB.username == username).first()
+async def read_or_primary(db: AsyncSession, load):
+    """Ejecuta `load(sesión)`; si la réplica no encuentra el objeto (aún no replicado), reintenta en el primario."""
+    obj = await load(db)
+    if obj is None and db.bind is not async_engine:
+        async with AsyncSessionLocal() as primary:
+            obj = await load(primary)
+    return obj
 
-def authenticate_user(db: Session, username: str, password: str) -> UserDB:
-    user = get_user(db, username)
-    if not user or not verify_password(password, user.hashed_password):
+async def get_user(db: AsyncSession, username: str) -> UserDB:
+    result = await db.execute(
+        select(UserDB).options(joinedload(UserDB.role)).where(UserDB.username == username)
+    )
+    return result.scalars().first()
+
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> UserDB:
+    user = await get_user(db, username)
+    if not user or not await verify_password_async(password, user.hashed_password):
         return None
+    # Tras rotar FERNET_KEYS los hashes se migran a la clave nueva al iniciar sesión
+    rotated = rotate_password_token(user.hashed_password)
+    if rotated is not None:
+        user.hashed_password = rotated
+        await db.commit()
     return user
 
-def get_object_or_404(db: Session, model, obj_id: int):
-    obj = db.query(model).filter(model.id == obj_id).first()
+async def get_object_or_404(db: AsyncSession, model, obj_id: int):
+    obj = await db.get(model, obj_id)
     if not obj:
         raise HTTPException(status_code=404, detail=f"{model.__name__} no encontrado")
     return obj
 
+# Paginación keyset: ?limit=N&after=<último id recibido>
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "500"))
+
+def pagination_params(
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE),
+    after: Optional[int] = Query(None, ge=0),
+) -> dict:
+    return {"limit": limit, "after": after}
+
+async def paginate(db: AsyncSession, stmt, model, limit: Optional[int], after: Optional[int]):
+    """Aplica keyset sobre model.id; devuelve (filas, next_cursor).
+
+    Sin limit se devuelven todas las filas, como antes de paginar.
+    """
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    stmt = stmt.order_by(model.id)
+    if limit is None:
+        return (await db.execute(stmt)).unique().scalars().all(), None
+    rows = (await db.execute(stmt.limit(limit + 1))).unique().scalars().all()
+    next_cursor = rows[limit - 1].id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def page_response(rows, next_cursor, page: dict):
+    """Lista simple sin limit (compatibilidad); sobre {items, next_cursor} con limit."""
+    if page["limit"] is None:
+        return rows
+    return {"items": rows, "next_cursor": next_cursor}
+
+async def paginate_rows(db: AsyncSession, stmt, model, limit: Optional[int], after: Optional[int]):
+    """Como paginate, pero con filas (dicts) en vez de objetos ORM.
+
+    stmt debe seleccionar columnas, p. ej. select(*Model.__table__.columns).
+    """
+    if after is not None:
+        stmt = stmt.where(model.id > after)
+    stmt = stmt.order_by(model.id)
+    if limit is not None:
+        stmt = stmt.limit(limit + 1)
+    rows = [dict(row) for row in (await db.execute(stmt)).mappings()]
+    if limit is None:
+        return rows, None
+    next_cursor = rows[limit - 1]["id"] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def rows_response(rows, next_cursor, page: dict) -> ORJSONResponse:
+    """Serializa las filas directamente con orjson.
+
+    El response_model del endpoint queda para la documentación: devolver un
+    Response evita la validación Pydantic objeto por objeto en listados grandes.
+    """
+    return ORJSONResponse(page_response(rows, next_cursor, page))
+
 # Función para crear JWT
 def create_access_token(data: dict, expires_delta: timedelta = None):
     to_encode = data.copy()
@@ -209,31 +799,138 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+    to_encode.update({"exp": expire, "iat": datetime.utcnow()})
+    encoded_jwt = jwt.encode(
+        to_encode, JWT_KEYS[JWT_ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": JWT_ACTIVE_KID}
+    )
     return encoded_jwt
 
+def decode_access_token(token: str) -> dict:
+    # El kid elige la clave; los tokens sin kid se validan con la activa
+    kid = jwt.get_unverified_header(token).get("kid") or JWT_ACTIVE_KID
+    if kid not in JWT_KEYS:
+        raise jwt.InvalidKeyError(f"kid desconocido: {kid}")
+    return jwt.decode(token, JWT_KEYS[kid], algorithms=[ALGORITHM])
+
+# -----------------------------
+# Caché de identidades autenticadas
+# -----------------------------
+# Evita consultar usuario y rol en cada petición autenticada. Con
+# AUTH_TRUST_ROLE_CLAIM=true se confía en los claims firmados del JWT
+# (uid, role, ver); solo se consulta la versión de tokens del usuario
+# (token_versions), cacheada PRINCIPAL_CACHE_TTL segundos. Una revocación
+# es inmediata en el worker que la hace y llega a los demás dentro de ese TTL.
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "1024"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+AUTH_TRUST_ROLE_CLAIM = os.getenv("AUTH_TRUST_ROLE_CLAIM", "false").lower() == "true"
+
+class PrincipalRole(NamedTuple):
+    name: str
+
+class Principal(NamedTuple):
+    """Usuario autenticado desacoplado de la sesión de base de datos."""
+    id: int
+    username: str
+    disabled: bool
+    role: PrincipalRole
+
+    @classmethod
+    def from_user(cls, user: UserDB) -> "Principal":
+        return cls(user.id, user.username, user.disabled, PrincipalRole(user.role.name))
+
+class PrincipalCache:
+    """Caché LRU con TTL de identidades, indexada por username."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()  # user_id -> (versión de tokens, expira)
+
+    def get(self, username: str) -> Optional[Principal]:
+        entry = self._entries.get(username)
+        if entry is None:
+            return None
+        principal, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[username]
+            return None
+        self._entries.move_to_end(username)
+        return principal
+
+    def set(self, principal: Principal):
+        self._entries[principal.username] = (principal, time.monotonic() + self.ttl)
+        self._entries.move_to_end(principal.username)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def get_version(self, user_id: int) -> Optional[int]:
+        entry = self._versions.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            self._versions.pop(user_id, None)
+            return None
+        return entry[0]
+
+    def set_version(self, user_id: int, version: int):
+        self._versions[user_id] = (version, time.monotonic() + self.ttl)
+        self._versions.move_to_end(user_id)
+        while len(self._versions) > self.maxsize:
+            self._versions.popitem(last=False)
+
+    def invalidate(self, username: str, user_id: Optional[int] = None):
+        """Descarta la identidad y la versión de tokens cacheadas."""
+        self._entries.pop(username, None)
+        if user_id is not None:
+            self._versions.pop(user_id, None)
+
+principal_cache = PrincipalCache(PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL)
+
+async def get_token_version(db: AsyncSession, user_id: int) -> int:
+    result = await db.execute(select(TokenVersionDB.version).where(TokenVersionDB.user_id == user_id))
+    return result.scalar() or 0
+
+async def revoke_tokens(db: AsyncSession, user_id: int):
+    """Invalida los tokens ya emitidos del usuario (se confirma con la transacción del llamador)."""
+    result = await db.execute(
+        update(TokenVersionDB).where(TokenVersionDB.user_id == user_id)
+        .values(version=TokenVersionDB.version + 1)
+    )
+    if result.rowcount == 0:
+        db.add(TokenVersionDB(user_id=user_id, version=1))
+
 # Actualización de get_current_user para usar JWT
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> UserDB:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Credenciales de autenticación inválidas",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = decode_access_token(token)
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
     except jwt.PyJWTError:
         raise credentials_exception
-    user = get_user(db, username)
-    if user is None:
-        raise credentials_exception
-    return user
+    if AUTH_TRUST_ROLE_CLAIM and payload.get("uid") is not None and payload.get("role"):
+        version = principal_cache.get_version(payload["uid"])
+        if version is None:
+            version = await get_token_version(db, payload["uid"])
+            principal_cache.set_version(payload["uid"], version)
+        if payload.get("ver", 0) < version:
+            raise credentials_exception
+        return Principal(payload["uid"], username, False, PrincipalRole(payload["role"]))
+    principal = principal_cache.get(username)
+    if principal is None:
+        user = await get_user(db, username)
+        if user is None:
+            raise credentials_exception
+        principal = Principal.from_user(user)
+        principal_cache.set(principal)
+    return principal
 
 def verify_role(required_roles: List[str]):
-    def role_checker(current_user: UserDB = Depends(get_current_user)) -> UserDB:
+    def role_checker(current_user: Principal = Depends(get_current_user)) -> Principal:
         if current_user.role.name not in required_roles:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
@@ -265,6 +962,25 @@ class ProductCreate(BaseModel):
     price: int
     image_filename: Optional[str] = None
 
+class ProductOut(BaseModel):
+    id: int
+    name: str
+    stock: int
+    price: int
+    image_filename: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+class ProductPage(BaseModel):
+    items: List[ProductOut]
+    next_cursor: Optional[int] = None
+
+class UserDetail(BaseModel):
+    username: str
+    disabled: bool = False
+    role: str
+
 class OrderItemCreate(BaseModel):
     product_id: int
     quantity: int
@@ -272,6 +988,48 @@ class OrderItemCreate(BaseModel):
 class OrderCreateRequest(BaseModel):
     items: List[OrderItemCreate]
 
+# Esquemas de respuesta de órdenes
+class OrderItemProduct(BaseModel):
+    id: int
+    name: str
+    price: int
+    image_filename: Optional[str] = None
+
+    class Config:
+        from_attributes = True
+
+class OrderItemOut(BaseModel):
+    id: int
+    product_id: int
+    quantity: int
+    product: Optional[OrderItemProduct] = None
+
+    class Config:
+        from_attributes = True
+
+class OrderOut(BaseModel):
+    id: int
+    client_id: int
+    status: str
+    total: float
+    created_at: datetime
+    stripe_payment_intent_id: Optional[str] = None
+    payment_status: str
+
+    class Config:
+        from_attributes = True
+
+class OrderWithItems(OrderOut):
+    items: List[OrderItemOut]
+
+class OrderPage(BaseModel):
+    items: List[OrderOut]
+    next_cursor: Optional[int] = None
+
+class OrderWithItemsPage(BaseModel):
+    items: List[OrderWithItems]
+    next_cursor: Optional[int] = None
+
 # Esquemas para movimientos (opcionalmente se pueden crear schemas de respuesta)
 class FinancialMovement(BaseModel):
     id: int
@@ -293,6 +1051,18 @@ class StockMovement(BaseModel):
     class Config:
         from_attributes = True
 
+class UserPage(BaseModel):
+    items: List[User]
+    next_cursor: Optional[int] = None
+
+class FinancialMovementPage(BaseModel):
+    items: List[FinancialMovement]
+    next_cursor: Optional[int] = None
+
+class StockMovementPage(BaseModel):
+    items: List[StockMovement]
+    next_cursor: Optional[int] = None
+
 # Esquema para respuesta de token JWT
 class Token(BaseModel):
     access_token: str
@@ -332,14 +1102,106 @@ def init_db():
         )
         db.add(admin_user)
         db.commit()
+    backfill_rollups(db)
     db.close()
 
-init_db()
+def rollup_periods(when) -> list:
+    """Inicio del día y del mes al que pertenece un instante."""
+    day = when.date() if isinstance(when, datetime) else when
+    return [("day", day), ("month", day.replace(day=1))]
+
+def backfill_rollups(db):
+    """Construye los agregados una sola vez si hay historial previo sin agregar."""
+    if db.query(FinancialRollupDB).first() is None:
+        totals = defaultdict(lambda: [0.0, 0])
+        for timestamp, amount in db.query(FinancialMovementDB.timestamp, FinancialMovementDB.amount).yield_per(1000):
+            for key in rollup_periods(timestamp):
+                totals[key][0] += amount or 0
+                totals[key][1] += 1
+        db.add_all(
+            FinancialRollupDB(period=period, period_start=start, amount=amount, movements=count)
+            for (period, start), (amount, count) in totals.items()
+        )
+    if db.query(StockRollupDB).first() is None:
+        totals = defaultdict(lambda: [0, 0])
+        query = db.query(StockMovementDB.timestamp, StockMovementDB.product_id, StockMovementDB.change)
+        for timestamp, product_id, change in query.yield_per(1000):
+            for period, start in rollup_periods(timestamp):
+                totals[(period, start, product_id)][0] += change or 0
+                totals[(period, start, product_id)][1] += 1
+        db.add_all(
+            StockRollupDB(period=period, period_start=start, product_id=product_id, net_change=change, movements=count)
+            for (period, start, product_id), (change, count) in totals.items()
+        )
+    db.commit()
+
+def create_missing_indexes(bind) -> List[str]:
+    """Migración de índices: crea los declarados en los modelos que falten en la base.
+
+    create_all solo crea índices junto con tablas nuevas; en una base existente
+    los índices agregados después a los modelos se crean aquí (idempotente).
+    """
+    inspector = inspect(bind)
+    existing_tables = set(inspector.get_table_names())
+    created = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {index["name"] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            if index.name not in existing:
+                index.create(bind=bind)
+                created.append(index.name)
+    if created:
+        logging.info("Índices creados: %s", ", ".join(created))
+    return created
+
+def init_database():
+    """Crea las tablas, los índices faltantes y los datos iniciales (idempotente)."""
+    Base.metadata.create_all(bind=engine)
+    create_missing_indexes(engine)
+    init_db()
+
+async def cancel_task(task: asyncio.Task):
+    task.cancel()
+    try:
+        await task
+    except (asyncio.CancelledError, Exception):
+        pass
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Arranque y apagado del worker: tareas en segundo plano y recursos compartidos."""
+    # Por si uvicorn configuró su logging después de importar este módulo (uvicorn.run(app))
+    route_uvicorn_logs()
+    if DB_INIT_ON_STARTUP:
+        await run_in_threadpool(init_database)
+    tasks = [asyncio.create_task(stripe_event_worker())]
+    if replicas.engines:
+        tasks.append(asyncio.create_task(replica_health_checker(REPLICA_HEALTH_INTERVAL)))
+    if STOCK_SNAPSHOT_INTERVAL > 0:
+        tasks.append(asyncio.create_task(stock_snapshot_scheduler(STOCK_SNAPSHOT_INTERVAL)))
+    if PRICE_JOB_INTERVAL > 0:
+        # Cada worker programa el job; el lease deja correr una sola ejecución
+        price_comparison_job._scheduler = asyncio.create_task(price_comparison_job.schedule(PRICE_JOB_INTERVAL))
+    try:
+        yield
+    finally:
+        await price_comparison_job.stop()
+        for task in tasks:
+            await cancel_task(task)
+        password_hasher.shutdown()
+        await lambda_validator.close()
+        await run_in_threadpool(webdriver_pool.close)
+        image_pipeline.shutdown()
+        await async_engine.dispose()
+        await replicas.dispose()
 
 # -----------------------------
 # Instancia de FastAPI
 # -----------------------------
-app = FastAPI()
+# orjson serializa datetime, float y UTF-8 sin pasar por json del stdlib
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # -----------------------------
 # Cross-Origin Resource Sharing
@@ -354,24 +1216,485 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[LAST_WRITE_HEADER],  # el frontend la lee para reenviarla
 )
 
-#Configuración para acceso a S3
-s3 = boto3.client("s3", region_name="us-east-1")
+# -----------------------------
+# Instrumentación por petición
+# -----------------------------
+# Registrado antes que record_request_metrics: corre dentro de él y ve sus RequestStats
+@app.middleware("http")
+async def track_client_writes(request: Request, call_next):
+    response = await call_next(request)
+    # Solo cuenta si la petición escribió en la base (POST /token o /imagenes/urls no lo hacen);
+    # el cliente reenvía la marca y sus próximas lecturas van al primario
+    stats = request_stats.get()
+    if stats is not None and stats.writes and response.status_code < 400:
+        response.headers[LAST_WRITE_HEADER] = f"{time.time():.3f}"
+    return response
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    stats = RequestStats()
+    token = request_stats.set(stats)
+    start = time.perf_counter()
+    status_code = 500
+    try:
+        response = await call_next(request)
+        status_code = response.status_code
+        return response
+    finally:
+        request_stats.reset(token)
+        # Plantilla de la ruta (/orders/{id}), no la URL, para acotar las series
+        route = getattr(request.scope.get("route"), "path", "sin_ruta")
+        HTTP_REQUEST_SECONDS.labels(request.method, route, str(status_code)).observe(time.perf_counter() - start)
+        DB_QUERIES_PER_REQUEST.labels(route).observe(stats.queries)
+        repeated = [(sql, n) for sql, n in stats.statements.items() if n >= N_PLUS_ONE_THRESHOLD]
+        if repeated:
+            N_PLUS_ONE_TOTAL.labels(route).inc()
+            for sql, n in repeated:
+                logging.warning("Posible N+1 en %s %s: %d ejecuciones de %s", request.method, route, n, " ".join(sql.split())[:200])
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,128}$")
+
+class RequestIdMiddleware:
+    """Asigna X-Request-ID. ASGI puro: el id sigue puesto mientras se envía la
+    respuesta, que es cuando uvicorn escribe la línea del access log."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = Headers(scope=scope).get("x-request-id", "")
+        if not REQUEST_ID_PATTERN.match(request_id):
+            request_id = uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            request_id_var.reset(token)
+
+# Registrado al final: es el middleware externo y cubre los logs de los demás
+app.add_middleware(RequestIdMiddleware)
+
+async def replica_health_checker(interval: float):
+    while True:
+        try:
+            await replicas.check()
+        except Exception:
+            logging.exception("Fallo el chequeo de réplicas")
+        await asyncio.sleep(interval)
+
+#Configuración para acceso a S3 (S3_ENDPOINT_URL permite usar un S3 local, p. ej. moto o MinIO)
+s3_client = None
+s3_client_lock = threading.Lock()
+
+def get_s3():
+    """Cliente S3 creado en el primer uso; boto3 es caro de importar."""
+    global s3_client
+    if s3_client is None:
+        with s3_client_lock:
+            if s3_client is None:
+                import boto3
+                s3_client = boto3.client("s3", region_name="us-east-1", endpoint_url=os.getenv("S3_ENDPOINT_URL"))
+    return s3_client
+
 BUCKET_NAME = os.getenv("BUCKET_NAME", "imagenes-productos-farmacia")
+IMAGE_URL_EXPIRES = int(os.getenv("IMAGE_URL_EXPIRES", "300"))
+IMAGE_URL_REFRESH_MARGIN = int(os.getenv("IMAGE_URL_REFRESH_MARGIN", "60"))
+IMAGE_URL_CACHE_SIZE = int(os.getenv("IMAGE_URL_CACHE_SIZE", "4096"))
+MAX_IMAGE_BATCH = 500
+
+# Derivados de imagen: miniatura y tamaño medio en WebP (y AVIF si Pillow lo soporta)
+IMAGE_DERIVATIVE_SIZES = {"thumb": 200, "medium": 600}
+IMAGE_DERIVATIVE_FORMATS = os.getenv("IMAGE_DERIVATIVE_FORMATS", "webp").split(",")
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_MAX_PENDING = int(os.getenv("IMAGE_MAX_PENDING", "100"))
+IMAGE_FALLBACK_URL_TTL = 30  # mientras no exista el derivado se sirve el original por poco tiempo
+
+def derived_image_key(filename: str, size: str, fmt: str) -> str:
+    return f"derivados/{size}/{filename}.{fmt}"
+
+class ImageDerivativePipeline:
+    """Genera los derivados de una imagen subida en un pool acotado de hilos."""
+
+    def __init__(self, workers: int, max_pending: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="imagenes")
+        self.max_pending = max_pending
+        self._pending = set()
+        self._derived = set()  # claves de derivados que ya existen en S3 (son inmutables)
+        self._lock = threading.Lock()
+
+    def is_pending(self, filename: str) -> bool:
+        with self._lock:
+            return filename in self._pending
+
+    def mark_derived(self, key: str):
+        with self._lock:
+            self._derived.add(key)
+
+    def is_derived(self, key: str) -> bool:
+        with self._lock:
+            return key in self._derived
+
+    def submit(self, filename: str) -> bool:
+        """Encola el procesamiento; devuelve False si la cola está llena."""
+        with self._lock:
+            if filename in self._pending:
+                return True
+            if len(self._pending) >= self.max_pending:
+                return False
+            self._pending.add(filename)
+        self.executor.submit(self._run, filename)
+        return True
+
+    def _run(self, filename: str):
+        try:
+            self.process(filename)
+        except Exception:
+            logging.exception("No se pudieron generar los derivados de %s", filename)
+        finally:
+            with self._lock:
+                self._pending.discard(filename)
+
+    def process(self, filename: str):
+        from PIL import Image, features
+
+        formats = [fmt for fmt in IMAGE_DERIVATIVE_FORMATS if fmt in ("webp", "avif") and features.check(fmt)]
+        with external_call("s3"):
+            original = get_s3().get_object(Bucket=BUCKET_NAME, Key=filename)["Body"].read()
+        with Image.open(io.BytesIO(original)) as img:
+            img.load()
+            if img.mode not in ("RGB", "RGBA"):
+                img = img.convert("RGBA" if "transparency" in img.info or "A" in img.getbands() else "RGB")
+            for size, width in IMAGE_DERIVATIVE_SIZES.items():
+                variant = img.copy()
+                variant.thumbnail((width, width))
+                for fmt in formats:
+                    buffer = io.BytesIO()
+                    variant.save(buffer, format=fmt.upper(), quality=80)
+                    key = derived_image_key(filename, size, fmt)
+                    with external_call("s3"):
+                        get_s3().put_object(
+                            Bucket=BUCKET_NAME,
+                            Key=key,
+                            Body=buffer.getvalue(),
+                            ContentType=f"image/{fmt}",
+                            CacheControl="public, max-age=31536000, immutable",
+                        )
+                    self.mark_derived(key)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+image_pipeline = ImageDerivativePipeline(IMAGE_WORKERS, IMAGE_MAX_PENDING)
+
+class ImageUrlCache:
+    """URLs firmadas de lectura reutilizadas hasta poco antes de expirar."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()  # los endpoints de imágenes corren en el threadpool
+
+    def _sign(self, key: str) -> str:
+        with external_call("s3"):
+            return get_s3().generate_presigned_url(
+                ClientMethod="get_object",
+                Params={
+                    "Bucket": BUCKET_NAME,
+                    "Key": key,
+                },
+                ExpiresIn=IMAGE_URL_EXPIRES
+            )
+
+    def _derived_exists(self, filename: str, key: str) -> bool:
+        # Solo se consulta S3 una vez por derivado: el pipeline registra los que genera
+        # y un HEAD positivo queda anotado para siempre
+        if image_pipeline.is_derived(key):
+            return True
+        if image_pipeline.is_pending(filename):
+            return False
+        # Un 404 es una respuesta normal aquí, no un fallo de la llamada
+        with external_call("s3"):
+            try:
+                get_s3().head_object(Bucket=BUCKET_NAME, Key=key)
+            except Exception:
+                return False
+        image_pipeline.mark_derived(key)
+        return True
+
+    def get(self, filename: str, size: Optional[str] = None, fmt: str = "webp") -> str:
+        cache_key = (filename, size, fmt if size else None)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry and entry[1] - IMAGE_URL_REFRESH_MARGIN > now:
+                self._entries.move_to_end(cache_key)
+                return entry[0]
+        expires_at = now + IMAGE_URL_EXPIRES
+        if size is None:
+            url = self._sign(filename)
+        else:
+            key = derived_image_key(filename, size, fmt)
+            if self._derived_exists(filename, key):
+                url = self._sign(key)
+            else:
+                # Aún no hay derivado: se encola y se entrega el original de momento
+                image_pipeline.submit(filename)
+                url = self._sign(filename)
+                expires_at = now + IMAGE_URL_REFRESH_MARGIN + IMAGE_FALLBACK_URL_TTL
+        with self._lock:
+            self._entries[cache_key] = (url, expires_at)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return url
+
+image_url_cache = ImageUrlCache(IMAGE_URL_CACHE_SIZE)
 
 #Remote WebDriver Selenium
 SELENIUM_HOST = os.getenv("SELENIUM_HOST", "localhost")
 SELENIUM_PORT = os.getenv("SELENIUM_PORT", "4444")
+SCRAPER_POOL_SIZE = int(os.getenv("SCRAPER_POOL_SIZE", "2"))
+SCRAPER_ACQUIRE_TIMEOUT = float(os.getenv("SCRAPER_ACQUIRE_TIMEOUT", "30"))
+SCRAPER_WAIT_TIMEOUT = float(os.getenv("SCRAPER_WAIT_TIMEOUT", "10"))
+# Vigencia de los precios guardados en external_prices (segundos)
+EXTERNAL_PRICE_TTL = float(os.getenv("EXTERNAL_PRICE_TTL", "3600"))
+REBAJA_PRICE_CLASS = "vtex-product-price-1-x-sellingPriceValue"
+# Plantilla de búsqueda; se puede apuntar a un HTML estático local para pruebas
+REBAJA_SEARCH_URL = os.getenv("REBAJA_SEARCH_URL", "https://www.larebajavirtual.com/{query}?_q={query}&map=ft")
+
+class WebDriverPool:
+    """Pool acotado de sesiones Remote WebDriver reutilizables (uso desde hilos)."""
+
+    def __init__(self, size: int):
+        self.size = size
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    def _create(self):
+        from selenium.webdriver import Remote
+        from selenium.webdriver.firefox.options import Options as FirefoxOptions
+
+        options = FirefoxOptions()
+        options.add_argument("-headless")
+        return Remote(
+            command_executor=f"http://{SELENIUM_HOST}:{SELENIUM_PORT}/wd/hub",
+            options=options
+        )
+
+    @staticmethod
+    def _healthy(driver) -> bool:
+        try:
+            driver.current_url  # ida y vuelta barata contra el grid
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _quit(driver):
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    @contextmanager
+    def session(self):
+        if not self._slots.acquire(timeout=SCRAPER_ACQUIRE_TIMEOUT):
+            raise HTTPException(503, "No hay navegadores disponibles para scrapear, intenta de nuevo")
+        driver = None
+        try:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                driver = None
+            if driver is not None and not self._healthy(driver):
+                self._quit(driver)
+                driver = None
+            if driver is None:
+                driver = self._create()
+            yield driver
+        except Exception:
+            # Un fallo de la página no invalida la sesión; una sesión caída sí
+            if driver is not None and not self._healthy(driver):
+                self._quit(driver)
+                driver = None
+            raise
+        finally:
+            if driver is not None:
+                self._idle.put(driver)
+            self._slots.release()
+
+    def close(self):
+        while True:
+            try:
+                self._quit(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+webdriver_pool = WebDriverPool(SCRAPER_POOL_SIZE)
 
 #Puerto de Stripe
-stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+def get_stripe():
+    """Importa y configura el SDK de Stripe en el primer pago."""
+    import stripe
+
+    if stripe.api_key is None:
+        stripe.api_key = os.getenv("STRIPE_SECRET_KEY")
+        # Permite apuntar a stripe-mock u otro servidor local
+        if os.getenv("STRIPE_API_BASE"):
+            stripe.api_base = os.getenv("STRIPE_API_BASE")
+    return stripe
+
+STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+STRIPE_EVENT_MAX_ATTEMPTS = int(os.getenv("STRIPE_EVENT_MAX_ATTEMPTS", "5"))
 
 # -----------------------------
 # Configuración Lambda URLs
 # -----------------------------
-LAMBDA_URL_PRODUCTO = "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-product"
-LAMBDA_URL_USERNAME = "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-username"
+LAMBDA_URL_PRODUCTO = os.getenv(
+    "LAMBDA_URL_PRODUCTO", "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-product"
+)
+LAMBDA_URL_USERNAME = os.getenv(
+    "LAMBDA_URL_USERNAME", "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/prod/validate-username"
+)
+LAMBDA_TIMEOUT = float(os.getenv("LAMBDA_TIMEOUT", "3"))
+LAMBDA_RETRIES = int(os.getenv("LAMBDA_RETRIES", "2"))
+LAMBDA_CACHE_SIZE = int(os.getenv("LAMBDA_CACHE_SIZE", "1024"))
+LAMBDA_CACHE_TTL = float(os.getenv("LAMBDA_CACHE_TTL", "300"))
+LAMBDA_CIRCUIT_THRESHOLD = int(os.getenv("LAMBDA_CIRCUIT_THRESHOLD", "5"))
+LAMBDA_CIRCUIT_RESET = float(os.getenv("LAMBDA_CIRCUIT_RESET", "30"))
+# "local": si la Lambda no responde se aplican reglas locales; "error": se responde 503
+LAMBDA_FALLBACK = os.getenv("LAMBDA_FALLBACK", "local")
+
+USERNAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]{3,50}$")
+
+class CircuitBreaker:
+    """Corta las llamadas tras N fallos seguidos y reintenta una sola tras el enfriamiento."""
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            # semiabierto: se deja pasar una llamada de prueba
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+class LambdaUnavailable(Exception):
+    pass
+
+class LambdaValidator:
+    """Cliente HTTP asíncrono compartido (keep-alive) para las Lambdas de validación."""
+
+    def __init__(self):
+        self._client = None
+        self._cache = OrderedDict()
+        self.breakers = {}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(LAMBDA_TIMEOUT),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            )
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _breaker(self, url: str) -> CircuitBreaker:
+        if url not in self.breakers:
+            self.breakers[url] = CircuitBreaker(LAMBDA_CIRCUIT_THRESHOLD, LAMBDA_CIRCUIT_RESET)
+        return self.breakers[url]
+
+    async def post(self, url: str, payload: dict):
+        """Devuelve (status_code, cuerpo JSON); cachea solo respuestas definitivas (200/400)."""
+        key = (url, json.dumps(payload, sort_keys=True))
+        cached = self._cache.get(key)
+        if cached and cached[2] > time.monotonic():
+            self._cache.move_to_end(key)
+            return cached[0], cached[1]
+
+        breaker = self._breaker(url)
+        if not breaker.allow():
+            raise LambdaUnavailable("circuito abierto")
+        last_error = None
+        for attempt in range(LAMBDA_RETRIES + 1):
+            try:
+                with external_call("lambda"):
+                    response = await self.client.post(url, json=payload)
+                if response.status_code < 500:
+                    breaker.record_success()
+                    body = response.json()
+                    if response.status_code in (200, 400):
+                        self._cache[key] = (response.status_code, body, time.monotonic() + LAMBDA_CACHE_TTL)
+                        while len(self._cache) > LAMBDA_CACHE_SIZE:
+                            self._cache.popitem(last=False)
+                    return response.status_code, body
+                last_error = f"HTTP {response.status_code}"
+            except (httpx.TransportError, ValueError) as e:
+                last_error = str(e) or e.__class__.__name__
+            if attempt < LAMBDA_RETRIES:
+                await asyncio.sleep(random.uniform(0, 0.1 * 2 ** attempt))
+        breaker.record_failure()
+        raise LambdaUnavailable(last_error)
+
+lambda_validator = LambdaValidator()
+
+def validate_username_locally(username: str):
+    """Reglas locales equivalentes a la Lambda de username (modo degradado)."""
+    if not USERNAME_PATTERN.match(username):
+        return 400, {"error": "El username debe tener 3-50 caracteres alfanuméricos, '.', '_' o '-'"}
+    return 200, {"data": {"username": username}}
+
+def validate_product_locally(precio: int, stock: int):
+    """Reglas locales equivalentes a la Lambda de producto (modo degradado)."""
+    errores = []
+    if precio <= 0:
+        errores.append("El precio debe ser mayor que cero")
+    if stock < 0:
+        errores.append("El stock no puede ser negativo")
+    if errores:
+        return 400, {"body": json.dumps({"errores": errores})}
+    return 200, {}
+
+async def call_validator(url: str, payload: dict, local_rule):
+    try:
+        return await lambda_validator.post(url, payload)
+    except LambdaUnavailable as e:
+        if LAMBDA_FALLBACK == "local":
+            logging.warning("Lambda %s no disponible (%s); se aplican reglas locales", url, e)
+            return local_rule()
+        raise HTTPException(status_code=503, detail=f"Servicio de validación no disponible: {e}")
 
 # -----------------------------
 # Endpoints de Autenticación y Usuarios
@@ -380,54 +1703,57 @@ LAMBDA_URL_USERNAME = "https://fnoo5iqzzf.execute-api.us-east-1.amazonaws.com/pr
 MAX_PAYLOAD_SIZE = 1 * 1024 * 1024  # Límite de 1MB
 
 @app.post("/register", dependencies=[Depends(verify_role(["admin"]))])
-async def register(user: UserCreate, db: Session = Depends(get_db)):
+async def register(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Registrar un nuevo usuario (solo admin)."""
 
     # 1) Validar formato del username con Lambda
     try:
-        lambda_response = requests.post(
+        status_code, body = await call_validator(
             LAMBDA_URL_USERNAME,  # URL para validar el username
-            json={"username": user.username},  # Solo validación del username
-            headers={"Content-Type": "application/json"}
+            {"username": user.username},  # Solo validación del username
+            lambda: validate_username_locally(user.username),
         )
 
-        if lambda_response.status_code != 200:
-            body = lambda_response.json()
+        if status_code != 200:
             error_msg = body.get("error", "Error desconocido en validación de username")
-            raise HTTPException(status_code=lambda_response.status_code, detail=error_msg)
-        
+            raise HTTPException(status_code=status_code, detail=error_msg)
+
         # Usar username validado o el original si no viene
-        validated_username = lambda_response.json().get("data", {}).get("username", user.username)
-        
+        validated_username = body.get("data", {}).get("username", user.username)
+
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en validación de username vía Lambda: {str(e)}")
 
     # 2) Verificar si el username ya existe en la base de datos
-    existing_user = db.query(UserDB).filter(UserDB.username == validated_username).first()
+    result = await db.execute(select(UserDB).where(UserDB.username == validated_username))
+    existing_user = result.scalars().first()
     if existing_user:
         raise HTTPException(status_code=400, detail="El usuario ya existe")
 
     # 3) Verificar que el rol sea válido
-    role = db.query(RoleDB).filter(RoleDB.name == user.role).first()
+    result = await db.execute(select(RoleDB).where(RoleDB.name == user.role))
+    role = result.scalars().first()
     if not role:
         raise HTTPException(status_code=400, detail="Rol inválido")
 
     # 4) Crear el nuevo usuario
     new_user = UserDB(
         username=user.username,
-        hashed_password=get_password_hash(user.password),
+        hashed_password=await get_password_hash_async(user.password),
         role_id=role.id
     )
     db.add(new_user)
-    db.commit()
+    await db.commit()
 
     return {"message": "Usuario registrado exitosamente"}
 
 
 @app.post("/token", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_db)):
     """Generar token para autenticación."""
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -435,67 +1761,230 @@ async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session =
         )
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username, "role": user.role.name}, expires_delta=access_token_expires
+        data={"sub": user.username, "uid": user.id, "role": user.role.name, "ver": await get_token_version(db, user.id)},
+        expires_delta=access_token_expires,
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.get("/users/", response_model=List[User])
-async def list_users(db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
-    """Listar todos los usuarios (solo admin)."""
-    users = db.query(UserDB).all()
-    result = []
-    for user in users:
-        user_data = {
-            "id": user.id,  # Agregado el campo id
-            "username": user.username,
-            "disabled": user.disabled,
-            "role": user.role.name,
-        }
-        result.append(user_data)
-    return result
+class PasswordHashingMetrics(BaseModel):
+    executor: str
+    workers: int
+    max_pending: int
+    queue_depth: int
+    completed: int
+    rejected: int
+    avg_latency_ms: float
+    max_latency_ms: float
+
+@app.get("/metrics/password-hashing", response_model=PasswordHashingMetrics)
+async def password_hashing_metrics(current_user: Principal = Depends(verify_role(["admin"]))):
+    """Métricas del pool de hashing: profundidad de cola, latencia y rechazos."""
+    return password_hasher.metrics()
+
+class RuntimeCollector:
+    """Expone en /metrics el estado del pool de hashing y del pool de conexiones."""
+
+    def collect(self):
+        hashing = password_hasher.metrics()
+        yield GaugeMetricFamily("password_hash_queue_depth", "Tareas de hashing en curso", value=hashing["queue_depth"])
+        yield CounterMetricFamily("password_hash_completed", "Tareas de hashing completadas", value=hashing["completed"])
+        yield CounterMetricFamily("password_hash_rejected", "Tareas de hashing rechazadas (503)", value=hashing["rejected"])
+        pool = async_engine.sync_engine.pool
+        if hasattr(pool, "checkedout"):
+            yield GaugeMetricFamily("db_pool_checked_out", "Conexiones del pool en uso", value=pool.checkedout())
+        if replicas.engines:
+            yield GaugeMetricFamily("db_replicas_healthy", "Réplicas de lectura en rotación", value=len(replicas.healthy))
+
+prom.REGISTRY.register(RuntimeCollector())
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.get("/metrics")
+def prometheus_metrics(request: Request):
+    """Métricas en formato Prometheus (latencias, consultas SQL, llamadas externas)."""
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="No autorizado")
+    registry = prom.REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = prom.CollectorRegistry()
+        prom_multiprocess.MultiProcessCollector(registry)
+    return Response(prom.generate_latest(registry), media_type=prom.CONTENT_TYPE_LATEST)
+
+@app.get("/users/", response_model=Union[List[User], UserPage])
+async def list_users(page: dict = Depends(pagination_params), db: AsyncSession = Depends(get_db),
+                     current_user: Principal = Depends(verify_role(["admin"]))):
+    """Listar usuarios (solo admin), paginado con limit/after."""
+    stmt = (
+        select(UserDB.id, UserDB.username, UserDB.disabled, RoleDB.name.label("role"))
+        .outerjoin(RoleDB, UserDB.role_id == RoleDB.id)
+    )
+    users, next_cursor = await paginate_rows(db, stmt, UserDB, page["limit"], page["after"])
+    return rows_response(users, next_cursor, page)
 
-@app.get("/users/{id}")
-async def get_user_by_id(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+@app.get("/users/{id}", response_model=UserDetail)
+async def get_user_by_id(id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Obtener detalles de un usuario por ID (solo admin)."""
-    user = db.query(UserDB).filter(UserDB.id == id).first()
+    user = await db.get(UserDB, id, options=[joinedload(UserDB.role)])
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
     data = {"username": user.username, "disabled": user.disabled, "role": user.role.name}
     return data
 
 @app.put("/users/{id}")
-async def update_user(id: int, user_data: UserCreate, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def update_user(id: int, user_data: UserCreate, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Actualizar datos de un usuario (solo admin)."""
-    user = db.query(UserDB).filter(UserDB.id == id).first()
+    user = await db.get(UserDB, id, options=[joinedload(UserDB.role)])
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
+    previous_username = user.username
     user.username = user_data.username
-    user.hashed_password = get_password_hash(user_data.password)
-    db.commit()
+    user.hashed_password = await get_password_hash_async(user_data.password)
+    await revoke_tokens(db, user.id)
+    await db.commit()
+    principal_cache.invalidate(previous_username, user.id)
+    principal_cache.invalidate(user.username, user.id)
     return {"message": "Usuario actualizado exitosamente"}
 
 @app.delete("/users/{id}")
-async def delete_user(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin"]))):
+async def delete_user(id: int, db: AsyncSession = Depends(get_db), current_user: Principal = Depends(verify_role(["admin"]))):
     """Eliminar un usuario (solo admin)."""
-    user = db.query(UserDB).filter(UserDB.id == id).first()
+    user = await db.get(UserDB, id, options=[joinedload(UserDB.role)])
     if not user:
         raise HTTPException(status_code=404, detail="Usuario no encontrado")
-    db.delete(user)
-    db.commit()
+    await revoke_tokens(db, user.id)
+    await db.delete(user)
+    await db.commit()
+    principal_cache.invalidate(user.username, user.id)
     return {"message": "Usuario eliminado exitosamente"}
 
 # -----------------------------
 # Endpoints de Productos
 # -----------------------------
 
-# Configura el logging en el backend
-logging.basicConfig(level=logging.DEBUG)
+# Snapshot versionado del catálogo: se sirve como JSON ya codificado con
+# ETag fuerte. Toda escritura sobre productos incrementa la versión.
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "30"))
+
+class CatalogCache:
+    """Catálogo de productos en memoria, invalidado por versión (write-through)."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.version = 0
+        self._snapshot = None  # (versión, instante de construcción, cuerpo, etag)
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.version += 1
+
+    def _fresh(self):
+        snapshot = self._snapshot
+        if snapshot and snapshot[0] == self.version and time.monotonic() - snapshot[1] < self.ttl:
+            return snapshot
+        return None
+
+    async def get(self, db: AsyncSession):
+        snapshot = self._fresh()
+        if snapshot:
+            return snapshot[2], snapshot[3]
+        async with self._lock:
+            snapshot = self._fresh()
+            if snapshot:
+                return snapshot[2], snapshot[3]
+            version = self.version
+            result = await db.execute(
+                select(ProductDB.id, ProductDB.name, ProductDB.stock, ProductDB.price, ProductDB.image_filename)
+                .order_by(ProductDB.id)
+            )
+            body = orjson.dumps([dict(row) for row in result.mappings()])
+            etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+            # Si hubo una escritura durante la reconstrucción, la versión ya no
+            # coincide y la siguiente lectura vuelve a construir el snapshot.
+            self._snapshot = (version, time.monotonic(), body, etag)
+            return body, etag
+
+catalog_cache = CatalogCache(CATALOG_CACHE_TTL)
+
+# Índice de nombres para detectar duplicados sin consultar toda la tabla:
+# los nombres normalizados se guardan en memoria y RapidFuzz los puntúa
+# todos en una sola llamada.
+PRODUCT_SIMILARITY_THRESHOLD = 70
+PRODUCT_SIMILARITY_TOP_K = int(os.getenv("PRODUCT_SIMILARITY_TOP_K", "5"))
+PRODUCT_INDEX_TTL = float(os.getenv("PRODUCT_INDEX_TTL", "300"))
+
+class ProductNameIndex:
+    """Índice en memoria de nombres de producto normalizados para detectar duplicados.
+
+    RapidFuzz puntúa la lista completa en C más rápido de lo que cualquier
+    prefiltro en Python la recorre; la búsqueda corre en el threadpool.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._names = {}      # id -> nombre normalizado
+        self._display = {}    # id -> nombre original
+        self._choices = None  # (ids, nombres): copia inmutable que se busca fuera del event loop
+        self._loaded_at = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def normalize(name: str) -> str:
+        text = unicodedata.normalize("NFKD", name.lower())
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return " ".join(text.split())
+
+    def add(self, product_id: int, name: str):
+        if self._loaded_at is None:
+            return  # se cargará completo en la próxima búsqueda
+        self._names[product_id] = self.normalize(name)
+        self._display[product_id] = name
+        self._choices = None
+
+    def remove(self, product_id: int):
+        self._names.pop(product_id, None)
+        self._display.pop(product_id, None)
+        self._choices = None
+
+    def reset(self):
+        self._names.clear()
+        self._display.clear()
+        self._choices = None
+        self._loaded_at = None
+
+    async def ensure_loaded(self, db: AsyncSession):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        async with self._lock:
+            if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+                return
+            result = await db.execute(select(ProductDB.id, ProductDB.name))
+            self.reset()
+            self._loaded_at = time.monotonic()
+            for product_id, name in result:
+                self.add(product_id, name)
+
+    def choices(self):
+        if self._choices is None:
+            self._choices = (list(self._names), list(self._names.values()))
+        return self._choices
+
+    async def similar(self, name: str, limit: int, score_cutoff: float) -> List[dict]:
+        ids, names = self.choices()
+        matches = await run_in_threadpool(
+            process.extract, self.normalize(name), names,
+            scorer=fuzz.ratio, limit=limit, score_cutoff=score_cutoff,
+        )
+        return [
+            {"id": ids[i], "nombre": self._display.get(ids[i], names[i]), "similitud": round(score, 1)}
+            for _, score, i in matches
+        ]
+
+product_name_index = ProductNameIndex(PRODUCT_INDEX_TTL)
 
 @app.post("/products/", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
 async def create_product(
     product: ProductCreate, 
     confirmado: Optional[bool] = Query(False),  # Confirmado como parámetro de consulta
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Crear un nuevo producto, permitiendo confirmación manual si hay ambigüedad en el nombre."""
 
@@ -506,37 +1995,39 @@ async def create_product(
 
     # 2) Validación del producto vía Lambda (solo precio y stock)
     try:
-        lambda_response = requests.post(
+        status_code, body = await call_validator(
             LAMBDA_URL_PRODUCTO,  # URL de la función Lambda para validar producto
-            json={
+            {
                 "precio": product.price,
                 "stock": product.stock
-            }
+            },
+            lambda: validate_product_locally(product.price, product.stock),
         )
-        if lambda_response.status_code == 400:
-            errores = json.loads(lambda_response.json()["body"])["errores"]
+        if status_code == 400:
+            errores = json.loads(body["body"])["errores"]
             raise HTTPException(status_code=400, detail=errores)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error en validación de producto: {str(e)}")
 
     # 3) Verificar similitudes con productos ya existentes usando RapidFuzz
-    productos = db.query(ProductDB).all()
-    for existente in productos:
-        similitud = fuzz.ratio(product.name.lower(), existente.name.lower())
-        logging.debug(f"Similitud con el producto '{existente.name}': {similitud}")
-
-        if similitud >= 70:
-            if not confirmado:
-                logging.debug(f"Similitud alta detectada: {existente.name}, se necesita confirmación.")
-                return JSONResponse(
-                    status_code=status.HTTP_409_CONFLICT,
-                    content={
-                        "mensaje": "Este producto es similar a uno ya existente.",
-                        "producto_similar": existente.name,
-                        "confirmacion_requerida": True
-                    }
-                )
-            break
+    if not confirmado:
+        await product_name_index.ensure_loaded(db)
+        similares = await product_name_index.similar(
+            product.name, PRODUCT_SIMILARITY_TOP_K, PRODUCT_SIMILARITY_THRESHOLD
+        )
+        if similares:
+            logging.debug("Similitud alta detectada: %s, se necesita confirmación.", similares[0]['nombre'])
+            return JSONResponse(
+                status_code=status.HTTP_409_CONFLICT,
+                content={
+                    "mensaje": "Este producto es similar a uno ya existente.",
+                    "producto_similar": similares[0]["nombre"],
+                    "productos_similares": similares,
+                    "confirmacion_requerida": True
+                }
+            )
 
     # 4) Sanitización para prevenir XSS
     def sanitize(val):
@@ -552,101 +2043,277 @@ async def create_product(
         image_filename=sanitized.get("image_filename", None)
     )
     db.add(new_product)
-    db.commit()
+    await db.flush()
+    if new_product.stock:
+        # Saldo inicial del ledger: sin él, stock-at y la conciliación no cuadran
+        await record_stock_adjustment(db, new_product.id, new_product.stock, "Stock inicial")
+    await db.commit()
+    catalog_cache.invalidate()
+    product_name_index.add(new_product.id, new_product.name)
+    if new_product.image_filename:
+        image_pipeline.submit(new_product.image_filename)
 
     logging.debug("Producto guardado exitosamente.")  # Debugging: Log de éxito
     return {"message": "Producto agregado exitosamente"}
 
-@app.get("/products/")
-async def list_products(db: Session = Depends(get_db)):
-    """Listar todos los productos."""
-    products = db.query(ProductDB).all()
-    return products
-
-@app.get("/products/{id}")
-async def get_product(id: int, db: Session = Depends(get_db)):
+@app.get("/products/", response_model=Union[List[ProductOut], ProductPage])
+async def list_products(request: Request, page: dict = Depends(pagination_params),
+                        db: AsyncSession = Depends(get_read_db)):
+    """Listar productos; sin paginar se sirve el snapshot con ETag / If-None-Match."""
+    if page["limit"] is not None or page["after"] is not None:
+        products, next_cursor = await paginate_rows(
+            db, select(*ProductDB.__table__.columns), ProductDB, page["limit"], page["after"]
+        )
+        return rows_response(products, next_cursor, page)
+    # El snapshot se reconstruye desde el primario: una réplica atrasada dejaría
+    # en caché el catálogo anterior a la escritura que lo invalidó
+    async with AsyncSessionLocal() as primary:
+        body, etag = await catalog_cache.get(primary)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*":
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+@app.get("/products/{id}", response_model=ProductOut)
+async def get_product(id: int, db: AsyncSession = Depends(get_read_db)):
     """Obtener detalles de un producto por ID."""
-    product = db.query(ProductDB).filter(ProductDB.id == id).first()
+    product = await read_or_primary(db, lambda session: session.get(ProductDB, id))
     if not product:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
     return product
 
 @app.put("/products/{id}", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
-async def update_product(id: int, product_data: Product, db: Session = Depends(get_db)):
+async def update_product(id: int, product_data: Product, db: AsyncSession = Depends(get_db)):
     """Actualizar un producto existente."""
-    product = db.query(ProductDB).filter(ProductDB.id == id).first()
+    product = await db.get(ProductDB, id)
     if not product:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
+    stock_change = product_data.stock - (product.stock or 0)
     product.name = product_data.name
     product.stock = product_data.stock
     product.price = product_data.price
+    if stock_change:
+        await record_stock_adjustment(db, product.id, stock_change, "Ajuste manual de stock")
+    image_changed = product.image_filename != product_data.image_filename
     product.image_filename = product_data.image_filename
-    db.commit()
+    await db.commit()
+    catalog_cache.invalidate()
+    product_name_index.add(product.id, product.name)
+    if image_changed and product.image_filename:
+        image_pipeline.submit(product.image_filename)
     return {"message": "Producto actualizado exitosamente"}
 
 @app.delete("/products/{id}", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
-async def delete_product(id: int, db: Session = Depends(get_db)):
+async def delete_product(id: int, db: AsyncSession = Depends(get_db)):
     """Eliminar un producto."""
-    product = db.query(ProductDB).filter(ProductDB.id == id).first()
+    product = await db.get(ProductDB, id)
     if not product:
         raise HTTPException(status_code=404, detail="Producto no encontrado")
-    db.delete(product)
-    db.commit()
+    await db.delete(product)
+    await db.commit()
+    catalog_cache.invalidate()
+    product_name_index.remove(product.id)
     return {"message": "Producto eliminado exitosamente"}
 
 @app.delete("/products/out-of-stock", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
-async def delete_out_of_stock_products(db: Session = Depends(get_db)):
+async def delete_out_of_stock_products(db: AsyncSession = Depends(get_db)):
     """Eliminar productos sin stock."""
-    db.query(ProductDB).filter(ProductDB.stock == 0).delete()
-    db.commit()
+    await db.execute(delete(ProductDB).where(ProductDB.stock == 0))
+    await db.commit()
+    catalog_cache.invalidate()
+    product_name_index.reset()
     return {"message": "Productos sin stock eliminados exitosamente"}
 
 # -----------------------------
 # Endpoints de Órdenes
 # -----------------------------
-def get_order(db: Session, order_id: int) -> OrderDB:
+# Reservas de stock optimistas: cada descuento es un compare-and-swap
+# (UPDATE ... WHERE stock >= :qty), sin bloquear filas durante la validación.
+STOCK_RESERVATION_RETRIES = int(os.getenv("STOCK_RESERVATION_RETRIES", "3"))
+
+async def reserve_stock(db: AsyncSession, requested: dict) -> Optional[int]:
+    """Descuenta las cantidades pedidas; devuelve el id del producto sin stock suficiente."""
+    for product_id, quantity in sorted(requested.items()):
+        result = await db.execute(
+            update(ProductDB)
+            .where(ProductDB.id == product_id, ProductDB.stock >= quantity)
+            .values(stock=ProductDB.stock - quantity)
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount != 1:
+            return product_id
+    return None
+
+async def release_stock(db: AsyncSession, items) -> None:
+    """Devuelve al inventario las cantidades reservadas por los ítems de una orden."""
+    released = Counter()
+    for item in items:
+        released[item.product_id] += item.quantity
+    for product_id, quantity in sorted(released.items()):
+        await db.execute(
+            update(ProductDB)
+            .where(ProductDB.id == product_id)
+            .values(stock=ProductDB.stock + quantity)
+            .execution_options(synchronize_session=False)
+        )
+
+def upsert_increment(db: AsyncSession, model, values: dict, increments: List[str]):
+    """INSERT que, si la clave ya existe, suma los valores a las columnas indicadas."""
+    if db.sync_session.get_bind().dialect.name == "mysql":
+        stmt = mysql_insert(model).values(**values)
+        return stmt.on_duplicate_key_update({col: getattr(model, col) + stmt.inserted[col] for col in increments})
+    stmt = sqlite_insert(model).values(**values)
+    return stmt.on_conflict_do_update(
+        index_elements=[col.name for col in model.__table__.primary_key],
+        set_={col: getattr(model, col) + stmt.excluded[col] for col in increments},
+    )
+
+async def record_rollups(db: AsyncSession, when: datetime, amount: float, stock_changes: dict):
+    """Suma un movimiento financiero y los cambios de stock a los agregados del día y del mes."""
+    for period, start in rollup_periods(when):
+        await db.execute(upsert_increment(
+            db, FinancialRollupDB,
+            {"period": period, "period_start": start, "amount": amount, "movements": 1},
+            ["amount", "movements"],
+        ))
+    await record_stock_rollups(db, when, stock_changes)
+
+async def record_stock_rollups(db: AsyncSession, when: datetime, stock_changes: dict):
+    for period, start in rollup_periods(when):
+        for product_id, (change, count) in sorted(stock_changes.items()):
+            await db.execute(upsert_increment(
+                db, StockRollupDB,
+                {"period": period, "period_start": start, "product_id": product_id,
+                 "net_change": change, "movements": count},
+                ["net_change", "movements"],
+            ))
+
+async def record_stock_adjustment(db: AsyncSession, product_id: int, change: int, description: str):
+    """Registra en el ledger un cambio de stock que no viene de una orden (alta o edición)."""
+    now = datetime.utcnow()
+    db.add(StockMovementDB(product_id=product_id, timestamp=now, change=change, description=description))
+    await record_stock_rollups(db, now, {product_id: (change, 1)})
+
+def pending_reservations():
+    """Unidades por producto reservadas por órdenes pendientes (ya descontadas de ProductDB.stock)."""
     return (
-        db.query(OrderDB)
+        select(OrderItemDB.product_id, func.sum(OrderItemDB.quantity).label("reserved"))
+        .join(OrderDB, OrderDB.id == OrderItemDB.order_id)
+        .where(OrderDB.status == "pending")
+        .group_by(OrderItemDB.product_id)
+        .subquery()
+    )
+
+async def get_order(db: AsyncSession, order_id: int) -> OrderDB:
+    result = await db.execute(
+        select(OrderDB)
         .options(joinedload(OrderDB.items).joinedload(OrderItemDB.product))
-        .filter(OrderDB.id == order_id)
-        .first()
+        .where(OrderDB.id == order_id)
     )
+    return result.unique().scalars().first()
 
 @app.post("/orders/")
-async def create_order(order: OrderCreateRequest, db: Session = Depends(get_db), 
-                       current_user: UserDB = Depends(verify_role(["cliente", "admin"]))):
+async def create_order(order: OrderCreateRequest, db: AsyncSession = Depends(get_db), 
+                       current_user: Principal = Depends(verify_role(["cliente", "admin"]))):
     """Crear una nueva orden vinculada al usuario autenticado."""
     if not order.items:
         raise HTTPException(status_code=400, detail="La orden debe contener al menos un producto")
-    
-    new_order = OrderDB(client_id=current_user.id, total=0)
-    db.add(new_order)
-    db.commit()
 
-    total_price = 0
+    # Cantidades totales por producto (un producto puede repetirse en la orden)
+    requested = Counter()
     for item in order.items:
-        product = db.query(ProductDB).filter(ProductDB.id == item.product_id).first()
-        if not product or product.stock < item.quantity:
+        if item.quantity <= 0:
+            raise HTTPException(status_code=400, detail="La cantidad debe ser mayor que cero")
+        requested[item.product_id] += item.quantity
+
+    # 1) Un solo SELECT ... IN (...) para precios y validación previa (sin bloqueos)
+    result = await db.execute(
+        select(ProductDB.id, ProductDB.name, ProductDB.price, ProductDB.stock)
+        .where(ProductDB.id.in_(list(requested)))
+    )
+    products = {row.id: row for row in result}
+
+    # 2) Validar todos los ítems antes de escribir nada
+    for product_id, quantity in requested.items():
+        product = products.get(product_id)
+        if not product:
+            raise HTTPException(status_code=404, detail=f"Producto {product_id} no encontrado")
+        if product.stock < quantity:
             raise HTTPException(status_code=400, detail=f"Stock insuficiente para el producto {product.name}")
-        total_price += product.price * item.quantity
-        product.stock -= item.quantity  # Actualizar stock
-        order_item = OrderItemDB(order_id=new_order.id, product_id=product.id, quantity=item.quantity)
-        db.add(order_item)
-    new_order.total = total_price
-    db.commit()
+
+    # 3) Reserva de stock (UPDATE condicional), orden e ítems en una única transacción.
+    #    Solo se reintenta ante deadlocks/timeouts de bloqueo, con espera aleatoria.
+    total_price = sum(products[item.product_id].price * item.quantity for item in order.items)
+    for attempt in range(STOCK_RESERVATION_RETRIES):
+        try:
+            sin_stock = await reserve_stock(db, requested)
+            if sin_stock is not None:
+                await db.rollback()
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Stock insuficiente para el producto {products[sin_stock].name}"
+                )
+            new_order = OrderDB(client_id=current_user.id, total=total_price)
+            db.add(new_order)
+            await db.flush()
+            await db.execute(
+                insert(OrderItemDB),
+                [
+                    {"order_id": new_order.id, "product_id": item.product_id, "quantity": item.quantity}
+                    for item in order.items
+                ],
+            )
+            await db.commit()
+            break
+        except OperationalError:
+            await db.rollback()
+            if attempt == STOCK_RESERVATION_RETRIES - 1:
+                raise HTTPException(status_code=503, detail="Alta concurrencia sobre el stock, intenta de nuevo")
+            await asyncio.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    catalog_cache.invalidate()
     return {"message": "Pedido creado exitosamente", "order_id": new_order.id}
 
-@app.get("/orders/")
-async def list_orders(db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
-    """Listar órdenes según rol del usuario."""
-    if current_user.role.name == "cliente":
-        return db.query(OrderDB).filter(OrderDB.client_id == current_user.id).all()
-    return db.query(OrderDB).all()
+@app.get(
+    "/orders/",
+    response_model=Union[List[OrderWithItems], OrderWithItemsPage, List[OrderOut], OrderPage],
+)
+async def list_orders(
+    page: dict = Depends(pagination_params),
+    order_status: Optional[str] = Query(None, alias="status"),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    include: Optional[str] = Query(None, pattern="^items$"),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"])),
+):
+    """Listar órdenes según rol del usuario, con filtros por estado y fecha.
 
-@app.get("/orders/{id}")
-async def get_order_details(id: int, db: Session = Depends(get_db), current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
+    Con include=items cada orden trae sus ítems y productos en una cantidad fija
+    de consultas (órdenes, ítems y productos por lotes), sin importar cuántas sean.
+    """
+    if include == "items":
+        stmt = select(OrderDB).options(selectinload(OrderDB.items).selectinload(OrderItemDB.product))
+    else:
+        stmt = select(*OrderDB.__table__.columns)
+    if current_user.role.name == "cliente":
+        stmt = stmt.where(OrderDB.client_id == current_user.id)
+    if order_status:
+        stmt = stmt.where(OrderDB.status == order_status)
+    if date_from:
+        stmt = stmt.where(OrderDB.created_at >= date_from)
+    if date_to:
+        stmt = stmt.where(OrderDB.created_at < date_to)
+    if include != "items":
+        orders, next_cursor = await paginate_rows(db, stmt, OrderDB, page["limit"], page["after"])
+        return rows_response(orders, next_cursor, page)
+    orders, next_cursor = await paginate(db, stmt, OrderDB, page["limit"], page["after"])
+    return rows_response([OrderWithItems.model_validate(o).model_dump() for o in orders], next_cursor, page)
+
+@app.get("/orders/{id}", response_model=OrderWithItems)
+async def get_order_details(id: int, db: AsyncSession = Depends(get_read_db), current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"]))):
     """Obtener detalles de una orden."""
-    order = get_order(db, id)
+    order = await read_or_primary(db, lambda session: get_order(session, id))
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
     if current_user.role.name == "cliente" and order.client_id != current_user.id:
@@ -654,167 +2321,982 @@ async def get_order_details(id: int, db: Session = Depends(get_db), current_user
     return order
 
 @app.put("/orders/{id}")
-async def update_order(id: int, order_data: OrderCreateRequest, db: Session = Depends(get_db),
-                       current_user: UserDB = Depends(verify_role(["admin", "almacenista", "cliente"]))):
+async def update_order(id: int, order_data: OrderCreateRequest, db: AsyncSession = Depends(get_db),
+                       current_user: Principal = Depends(verify_role(["admin", "almacenista", "cliente"]))):
     """
     Actualizar una orden.
     Nota: No se permite modificar el comprador; la lógica para actualizar items deberá definirse según el caso de uso.
     """
-    order = get_order(db, id)
+    order = await get_order(db, id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
     if current_user.role.name == "cliente" and order.client_id != current_user.id:
         raise HTTPException(status_code=403, detail="No tienes permiso para actualizar este pedido")
     # Se mantiene el cliente original y se omite la actualización de items en este ejemplo.
-    db.commit()
+    await db.commit()
     return {"message": "Pedido actualizado"}
 
 @app.delete("/orders/{id}")
-async def cancel_order(id: int, db: Session = Depends(get_db), 
-                       current_user: UserDB = Depends(verify_role(["admin", "cliente"]))):
+async def cancel_order(id: int, db: AsyncSession = Depends(get_db), 
+                       current_user: Principal = Depends(verify_role(["admin", "cliente"]))):
     """Cancelar una orden pendiente (se elimina si no está confirmada)."""
-    order = get_order(db, id)
+    order = await get_order(db, id)
     if not order or order.status != "pending":
         raise HTTPException(status_code=400, detail="El pedido no puede ser cancelado")
     if current_user.role.name == "cliente" and order.client_id != current_user.id:
         raise HTTPException(status_code=403, detail="No puedes cancelar este pedido")
-    db.delete(order)
-    db.commit()
+    # Transición condicional: solo una cancelación concurrente libera el stock
+    result = await db.execute(
+        update(OrderDB)
+        .where(OrderDB.id == order.id, OrderDB.status == "pending")
+        .values(status="cancelled")
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="El pedido no puede ser cancelado")
+    await release_stock(db, order.items)
+    for item in order.items:
+        await db.delete(item)
+    await db.delete(order)
+    await db.commit()
+    catalog_cache.invalidate()
     return {"message": "Pedido cancelado"}
 
 @app.post("/orders/{id}/confirm")
-async def confirm_order(id: int, db: Session = Depends(get_db),
-                        current_user: UserDB = Depends(verify_role(["admin", "almacenista"]))):
+async def confirm_order(id: int, db: AsyncSession = Depends(get_db),
+                        current_user: Principal = Depends(verify_role(["admin", "almacenista"]))):
     """Confirmar una orden y registrar los movimientos económicos correspondientes."""
-    order = get_order(db, id)
+    order = await get_order(db, id)
     if not order:
         raise HTTPException(status_code=404, detail="Pedido no encontrado")
-    order.status = "confirmed"
-    db.commit()
+    # Transición condicional: una orden se confirma (y se contabiliza) una sola vez
+    result = await db.execute(
+        update(OrderDB)
+        .where(OrderDB.id == order.id, OrderDB.status == "pending")
+        .values(status="confirmed")
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        await db.rollback()
+        raise HTTPException(status_code=400, detail="El pedido ya fue confirmado o no puede confirmarse")
+    now = datetime.utcnow()
     # Registrar movimiento financiero
     financial_movement = FinancialMovementDB(
         order_id=order.id,
+        timestamp=now,
         amount=order.total,
         description="Orden confirmada"
     )
     db.add(financial_movement)
     # Registrar movimientos de stock para cada ítem de la orden
+    stock_changes = defaultdict(lambda: [0, 0])
     for item in order.items:
         stock_movement = StockMovementDB(
             product_id=item.product_id,
+            timestamp=now,
             change=-item.quantity,
             description="Stock disminuido por orden confirmada"
         )
         db.add(stock_movement)
-    db.commit()
+        stock_changes[item.product_id][0] -= item.quantity
+        stock_changes[item.product_id][1] += 1
+    # Agregados en la misma transacción que los movimientos
+    await record_rollups(db, now, order.total, stock_changes)
+    await db.commit()
     return {"message": "Pedido confirmado"}
 
 # -----------------------------
 # Endpoints de Movimientos Económicos
 # -----------------------------
-@app.get("/financial_movements/", response_model=List[FinancialMovement])
-async def list_financial_movements(db: Session = Depends(get_db), 
-                                   current_user: UserDB = Depends(verify_role(["admin", "almacenista"]))):
-    """Listar movimientos financieros."""
-    movements = db.query(FinancialMovementDB).all()
-    return movements
-
-@app.get("/stock_movements/", response_model=List[StockMovement])
-async def list_stock_movements(db: Session = Depends(get_db), 
-                               current_user: UserDB = Depends(verify_role(["admin", "almacenista"]))):
-    """Listar movimientos de stock."""
-    movements = db.query(StockMovementDB).all()
-    return movements
-
-@app.get("/upload-url")
+@app.get("/financial_movements/", response_model=Union[List[FinancialMovement], FinancialMovementPage])
+async def list_financial_movements(
+    page: dict = Depends(pagination_params),
+    order_id: Optional[int] = Query(None),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"])),
+):
+    """Listar movimientos financieros, filtrando por orden y rango de fechas."""
+    stmt = select(*FinancialMovementDB.__table__.columns)
+    if order_id is not None:
+        stmt = stmt.where(FinancialMovementDB.order_id == order_id)
+    if date_from:
+        stmt = stmt.where(FinancialMovementDB.timestamp >= date_from)
+    if date_to:
+        stmt = stmt.where(FinancialMovementDB.timestamp < date_to)
+    movements, next_cursor = await paginate_rows(db, stmt, FinancialMovementDB, page["limit"], page["after"])
+    return rows_response(movements, next_cursor, page)
+
+@app.get("/stock_movements/", response_model=Union[List[StockMovement], StockMovementPage])
+async def list_stock_movements(
+    page: dict = Depends(pagination_params),
+    product_id: Optional[int] = Query(None),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"])),
+):
+    """Listar movimientos de stock, filtrando por producto y rango de fechas."""
+    stmt = select(*StockMovementDB.__table__.columns)
+    if product_id is not None:
+        stmt = stmt.where(StockMovementDB.product_id == product_id)
+    if date_from:
+        stmt = stmt.where(StockMovementDB.timestamp >= date_from)
+    if date_to:
+        stmt = stmt.where(StockMovementDB.timestamp < date_to)
+    movements, next_cursor = await paginate_rows(db, stmt, StockMovementDB, page["limit"], page["after"])
+    return rows_response(movements, next_cursor, page)
+
+class FinancialSummaryItem(BaseModel):
+    period_start: date
+    amount: float
+    movements: int
+
+class FinancialSummary(BaseModel):
+    granularity: str
+    total: float
+    items: List[FinancialSummaryItem]
+
+class StockSummaryItem(BaseModel):
+    period_start: date
+    product_id: int
+    net_change: int
+    movements: int
+
+class StockSummary(BaseModel):
+    granularity: str
+    items: List[StockSummaryItem]
+
+def next_month(day: date) -> date:
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def rollup_segments(granularity: str, date_from: Optional[date], date_to: Optional[date]) -> list:
+    """Tramos (period, desde, hasta) de agregados que cubren [date_from, date_to).
+
+    Los meses que el rango cubre solo en parte se suman desde los agregados
+    diarios, así el primer y el último mes no incluyen días fuera del rango.
+    """
+    if granularity == "day":
+        return [("day", date_from, date_to)]
+    full_from = date_from if date_from is None or date_from.day == 1 else next_month(date_from)
+    full_to = date_to.replace(day=1) if date_to else None
+    if full_from and full_to and full_from >= full_to:  # ningún mes completo dentro del rango
+        return [("day", date_from, date_to)]
+    segments = [("month", full_from, full_to)]
+    if date_from != full_from:
+        segments.append(("day", date_from, full_from))
+    if date_to != full_to:
+        segments.append(("day", full_to, date_to))
+    return segments
+
+async def summarize_rollups(db: AsyncSession, model, granularity: str, date_from: Optional[date],
+                            date_to: Optional[date], keys: List[str], values: List[str], *filters) -> List[dict]:
+    """Suma los agregados de `model` por periodo (y `keys`) dentro de [date_from, date_to)."""
+    buckets = {}
+    for period, start, end in rollup_segments(granularity, date_from, date_to):
+        stmt = select(model).where(model.period == period, *filters)
+        if start:
+            stmt = stmt.where(model.period_start >= start)
+        if end:
+            stmt = stmt.where(model.period_start < end)
+        for row in (await db.execute(stmt)).scalars():
+            period_start = row.period_start.replace(day=1) if granularity == "month" else row.period_start
+            key = (period_start, *(getattr(row, name) for name in keys))
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = {"period_start": period_start, **{name: getattr(row, name) for name in keys},
+                                         **{name: 0 for name in values}}
+            for name in values:
+                bucket[name] += getattr(row, name)
+    return [buckets[key] for key in sorted(buckets)]
+
+@app.get("/financial_movements/summary", response_model=FinancialSummary)
+async def financial_movements_summary(
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    granularity: str = Query("day", pattern="^(day|month)$"),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"])),
+):
+    """Ingresos por día o por mes en [date_from, date_to), leídos de los agregados (sin recorrer el historial)."""
+    items = await summarize_rollups(db, FinancialRollupDB, granularity, date_from, date_to, [], ["amount", "movements"])
+    return {"granularity": granularity, "total": sum(item["amount"] for item in items), "items": items}
+
+@app.get("/stock_movements/summary", response_model=StockSummary)
+async def stock_movements_summary(
+    product_id: Optional[int] = Query(None),
+    date_from: Optional[date] = Query(None),
+    date_to: Optional[date] = Query(None),
+    granularity: str = Query("day", pattern="^(day|month)$"),
+    db: AsyncSession = Depends(get_db),
+    current_user: Principal = Depends(verify_role(["admin", "almacenista"])),
+):
+    """Cambio neto de stock por producto y día/mes en [date_from, date_to), leído de los agregados."""
+    filters = [StockRollupDB.product_id == product_id] if product_id is not None else []
+    items = await summarize_rollups(db, StockRollupDB, granularity, date_from, date_to,
+                                    ["product_id"], ["net_change", "movements"], *filters)
+    return {"granularity": granularity, "items": items}
+
+# -----------------------------
+# Stock en el tiempo: snapshots + delta del ledger
+# -----------------------------
+STOCK_SNAPSHOT_INTERVAL = float(os.getenv("STOCK_SNAPSHOT_INTERVAL", "0"))  # segundos; 0 = sin programación
+RECONCILIATION_CHUNK = int(os.getenv("RECONCILIATION_CHUNK", "5000"))
+
+async def take_stock_snapshots(db: AsyncSession) -> dict:
+    """Guarda el stock físico de todos los productos junto al último id del ledger.
+
+    Las reservas de órdenes pendientes ya salieron de ProductDB.stock pero solo
+    entran al ledger al confirmar, así que se suman de vuelta. Stock, reservas
+    y posición del ledger se leen en una sola sentencia para que sean coherentes.
+    """
+    now = datetime.utcnow()
+    reserved = pending_reservations()
+    last_movement_id = select(func.coalesce(func.max(StockMovementDB.id), 0)).scalar_subquery()
+    result = await db.execute(
+        insert(StockSnapshotDB).from_select(
+            ["product_id", "taken_at", "stock", "last_movement_id"],
+            select(
+                ProductDB.id,
+                literal(now),
+                func.coalesce(ProductDB.stock, 0) + func.coalesce(reserved.c.reserved, 0),
+                last_movement_id,
+            ).outerjoin(reserved, reserved.c.product_id == ProductDB.id),
+        )
+    )
+    last_movement_id = (await db.execute(
+        select(func.max(StockSnapshotDB.last_movement_id)).where(StockSnapshotDB.taken_at == now)
+    )).scalar() or 0
+    await db.commit()
+    return {"taken_at": now, "last_movement_id": last_movement_id, "products": result.rowcount}
+
+async def stock_snapshot_scheduler(interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with AsyncSessionLocal() as db:
+                await take_stock_snapshots(db)
+        except Exception:
+            logging.exception("No se pudieron tomar los snapshots de stock")
+
+@app.post("/stock_snapshots", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def create_stock_snapshots(db: AsyncSession = Depends(get_db)):
+    """Tomar un checkpoint de stock de todo el catálogo."""
+    return await take_stock_snapshots(db)
+
+class StockAt(BaseModel):
+    product_id: int
+    at: datetime
+    stock: int  # físico: incluye lo reservado por órdenes pendientes
+    snapshot_id: Optional[int] = None
+    movements_applied: int
+
+class StockDrift(BaseModel):
+    product_id: int
+    producto: str
+    stock: int
+    reservado: int
+    esperado: int
+    diferencia: int
+
+class StockReconciliation(BaseModel):
+    productos_revisados: int
+    sin_snapshot: int
+    movimientos_leidos: int
+    desfases: List[StockDrift]
+
+@app.get("/products/{id}/stock-at", response_model=StockAt,
+         dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def get_stock_at(id: int, at: datetime = Query(...), db: AsyncSession = Depends(get_db)):
+    """Stock físico de un producto en un instante: snapshot más cercano + movimientos intermedios."""
+    await get_object_or_404(db, ProductDB, id)
+    movements = select(func.coalesce(func.sum(StockMovementDB.change), 0), func.count(StockMovementDB.id)).where(
+        StockMovementDB.product_id == id
+    )
+    result = await db.execute(
+        select(StockSnapshotDB)
+        .where(StockSnapshotDB.product_id == id, StockSnapshotDB.taken_at <= at)
+        .order_by(StockSnapshotDB.taken_at.desc())
+        .limit(1)
+    )
+    snapshot = result.scalars().first()
+    if snapshot is not None:
+        # Hacia adelante: movimientos posteriores al snapshot hasta el instante pedido
+        delta, applied = (await db.execute(movements.where(
+            StockMovementDB.id > snapshot.last_movement_id, StockMovementDB.timestamp <= at
+        ))).one()
+        stock = snapshot.stock + delta
+    else:
+        result = await db.execute(
+            select(StockSnapshotDB)
+            .where(StockSnapshotDB.product_id == id, StockSnapshotDB.taken_at > at)
+            .order_by(StockSnapshotDB.taken_at)
+            .limit(1)
+        )
+        snapshot = result.scalars().first()
+        if snapshot is not None:
+            # Hacia atrás: se deshacen los movimientos entre el instante y el snapshot
+            delta, applied = (await db.execute(movements.where(
+                StockMovementDB.id <= snapshot.last_movement_id, StockMovementDB.timestamp > at
+            ))).one()
+            stock = snapshot.stock - delta
+        else:
+            # El ledger no tiene saldo inicial para productos anteriores a él:
+            # sin un snapshot de referencia no hay un número confiable
+            raise HTTPException(status_code=422, detail="El producto no tiene snapshots de stock; toma uno con POST /stock_snapshots")
+    return {
+        "product_id": id,
+        "at": at,
+        "stock": stock,
+        "snapshot_id": snapshot.id if snapshot else None,
+        "movements_applied": applied,
+    }
+
+@app.get("/stock_movements/reconciliation", response_model=StockReconciliation,
+         dependencies=[Depends(verify_role(["admin"]))])
+async def reconcile_stock(db: AsyncSession = Depends(get_db)):
+    """Compara el stock físico (ProductDB.stock + reservas pendientes) con el último
+    snapshot + ledger posterior, leyendo el ledger por lotes. Los productos sin
+    snapshot no tienen punto de partida y solo se cuentan en sin_snapshot."""
+    latest = (
+        select(StockSnapshotDB.product_id, func.max(StockSnapshotDB.id).label("snapshot_id"))
+        .group_by(StockSnapshotDB.product_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(StockSnapshotDB.product_id, StockSnapshotDB.stock, StockSnapshotDB.last_movement_id)
+        .join(latest, StockSnapshotDB.id == latest.c.snapshot_id)
+    )
+    baselines = {product_id: (stock, last_id) for product_id, stock, last_id in result}
+
+    reserved = pending_reservations()
+    result = await db.execute(
+        select(ProductDB.id, ProductDB.name, ProductDB.stock, func.coalesce(reserved.c.reserved, 0))
+        .outerjoin(reserved, reserved.c.product_id == ProductDB.id)
+    )
+    products = {product_id: (name, stock or 0, held) for product_id, name, stock, held in result}
+    expected = {pid: baselines[pid][0] for pid in products if pid in baselines}
+    boundary = {pid: baselines[pid][1] for pid in expected}
+
+    # Solo hace falta recorrer el ledger desde el snapshot más antiguo vigente
+    cursor = min(boundary.values(), default=0)
+    scanned = 0
+    while expected:
+        result = await db.execute(
+            select(StockMovementDB.id, StockMovementDB.product_id, StockMovementDB.change)
+            .where(StockMovementDB.id > cursor)
+            .order_by(StockMovementDB.id)
+            .limit(RECONCILIATION_CHUNK)
+        )
+        chunk = result.all()
+        if not chunk:
+            break
+        for movement_id, product_id, change in chunk:
+            if product_id in expected and movement_id > boundary[product_id]:
+                expected[product_id] += change or 0
+        scanned += len(chunk)
+        cursor = chunk[-1].id
+
+    drift = [
+        {"product_id": pid, "producto": name, "stock": stock, "reservado": held, "esperado": expected[pid],
+         "diferencia": stock + held - expected[pid]}
+        for pid, (name, stock, held) in products.items()
+        if pid in expected and stock + held != expected[pid]
+    ]
+    return {
+        "productos_revisados": len(expected),
+        "sin_snapshot": len(products) - len(expected),
+        "movimientos_leidos": scanned,
+        "desfases": drift,
+    }
+
+class UploadUrl(BaseModel):
+    upload_url: str
+
+class ImageUrl(BaseModel):
+    image_url: str
+
+@app.get("/upload-url", response_model=UploadUrl)
 def generate_upload_url(
     filename: str = Query(...),
     content_type: str = Query("application/octet-stream")
 ):
     try:
-        presigned_url = s3.generate_presigned_url(
-            ClientMethod="put_object",
-            Params={
-                "Bucket": BUCKET_NAME,
-                "Key": filename,
-                "ContentType": content_type,
-            },
-            ExpiresIn=600,
-        )
+        with external_call("s3"):
+            presigned_url = get_s3().generate_presigned_url(
+                ClientMethod="put_object",
+                Params={
+                    "Bucket": BUCKET_NAME,
+                    "Key": filename,
+                    "ContentType": content_type,
+                },
+                ExpiresIn=600,
+            )
         return {"upload_url": presigned_url}
     except Exception as e:
-        print(f"\n🚨 ERROR EN /upload-url 🚨\n{e}\n")
+        logging.exception("Error al generar la URL de subida para %s", filename)
         raise HTTPException(status_code=500, detail=f"Error al generar URL: {str(e)}")
 
-@app.get("/imagen/{filename}")
-def get_image_url(filename: str, token: str = Depends(oauth2_scheme)):
+IMAGE_SIZE_PATTERN = "^(thumb|medium)$"
+IMAGE_FORMAT_PATTERN = "^(webp|avif)$"
+
+@app.get("/imagen/{filename}", response_model=ImageUrl)
+def get_image_url(
+    filename: str,
+    size: Optional[str] = Query(None, pattern=IMAGE_SIZE_PATTERN),
+    fmt: str = Query("webp", pattern=IMAGE_FORMAT_PATTERN),
+    token: str = Depends(oauth2_scheme),
+):
     try:
-        url = s3.generate_presigned_url(
-            ClientMethod="get_object",
-            Params={
-                "Bucket": BUCKET_NAME,
-                "Key": filename,
-            },
-            ExpiresIn=300
-        )
-        return {"image_url": url}
+        return {"image_url": image_url_cache.get(filename, size, fmt)}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error al generar URL de imagen: {str(e)}")
-    
+
+class ImageUrlBatch(BaseModel):
+    filenames: List[str]
+    size: Optional[str] = Field(None, pattern=IMAGE_SIZE_PATTERN)
+    fmt: str = Field("webp", pattern=IMAGE_FORMAT_PATTERN)
+
+@app.post("/imagenes/urls")
+def get_image_urls(batch: ImageUrlBatch, token: str = Depends(oauth2_scheme)):
+    """URLs firmadas para varias imágenes en una sola petición.
+
+    Una imagen que falla va a "errores" sin tumbar al resto del lote.
+    """
+    filenames = list(dict.fromkeys(f for f in batch.filenames if f))
+    if len(filenames) > MAX_IMAGE_BATCH:
+        raise HTTPException(status_code=400, detail=f"Máximo {MAX_IMAGE_BATCH} imágenes por petición")
+    urls, errores = {}, {}
+    for filename in filenames:
+        try:
+            urls[filename] = image_url_cache.get(filename, batch.size, batch.fmt)
+        except Exception as e:
+            errores[filename] = f"Error al generar URL de imagen: {str(e)}"
+    return {"urls": urls, "errores": errores}
+
+@app.post("/imagenes/{filename}/derivados", status_code=status.HTTP_202_ACCEPTED,
+          dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+def process_image(filename: str):
+    """Encolar la generación de miniatura y tamaño medio de una imagen ya subida."""
+    if not image_pipeline.submit(filename):
+        raise HTTPException(status_code=503, detail="Cola de procesamiento de imágenes llena, intenta de nuevo")
+    return {"message": "Procesamiento de imagen encolado"}
+
+class ScrapedPrice(BaseModel):
+    producto: str
+    precio_interno: int
+    precio_rebaja: str
+    url: str
+    actualizado_en: datetime
+
 @app.get(
     "/products/{product_id}/scrape-price",
+    response_model=ScrapedPrice,
     dependencies=[Depends(verify_role(["admin", "almacenista"]))]
 )
-def compare_price_scraping(product_id: int, db: Session = Depends(get_db)):
-    product = get_object_or_404(db, ProductDB, product_id)
-    query = urllib.parse.quote(product.name.lower())
-    url = f"https://www.larebajavirtual.com/{query}?_q={query}&map=ft"
+async def compare_price_scraping(product_id: int, refresh: bool = Query(False),
+                                 db: AsyncSession = Depends(get_db)):
+    product = await get_object_or_404(db, ProductDB, product_id)
+    url = rebaja_search_url(product.name)
+
+    # Precio guardado y vigente: se responde sin abrir el navegador
+    result = await db.execute(
+        select(ExternalPrice)
+        .where(ExternalPrice.product_id == product.id)
+        .order_by(ExternalPrice.updated_at.desc())
+    )
+    external = result.scalars().first()
+    fresh_since = datetime.utcnow() - timedelta(seconds=EXTERNAL_PRICE_TTL)
+    if external and not refresh and external.updated_at >= fresh_since:
+        return {
+            "producto": product.name,
+            "precio_interno": product.price,
+            "precio_rebaja": external.price,
+            "url": external.url,
+            "actualizado_en": external.updated_at,
+        }
 
-    options = FirefoxOptions()
-    options.headless = True
+    # Selenium es bloqueante: se ejecuta en el threadpool
+    precio_rebaja = await run_in_threadpool(scrape_rebaja_price, url)
+    external = await upsert_external_price(db, product.id, precio_rebaja, url)
+    await db.commit()
+
+    return {
+        "producto": product.name,
+        "precio_interno": product.price,
+        "precio_rebaja": precio_rebaja,
+        "url": url,
+        "actualizado_en": external.updated_at,
+    }
 
-    driver = Remote(
-        command_executor=f"http://{SELENIUM_HOST}:{SELENIUM_PORT}/wd/hub",
-        options=options
+def rebaja_search_url(product_name: str) -> str:
+    query = urllib.parse.quote(product_name.lower())
+    return REBAJA_SEARCH_URL.format(query=query)
+
+async def upsert_external_price(db: AsyncSession, product_id: int, price: str, url: str) -> ExternalPrice:
+    result = await db.execute(
+        select(ExternalPrice)
+        .where(ExternalPrice.product_id == product_id)
+        .order_by(ExternalPrice.updated_at.desc())
     )
+    external = result.scalars().first()
+    if external is None:
+        external = ExternalPrice(product_id=product_id)
+        db.add(external)
+    external.price = price
+    external.url = url
+    external.updated_at = datetime.utcnow()
+    return external
+
+def scrape_rebaja_price(url: str) -> str:
+    from selenium.common.exceptions import TimeoutException
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.webdriver.support.ui import WebDriverWait
 
     try:
-        driver.get(url)
-        time.sleep(5)
-        price_elem = driver.find_element(By.CLASS_NAME, "vtex-product-price-1-x-sellingPriceValue")
-        precio_rebaja = price_elem.text
+        with webdriver_pool.session() as driver, external_call("selenium"):
+            driver.get(url)
+            price_elem = WebDriverWait(driver, SCRAPER_WAIT_TIMEOUT).until(
+                EC.visibility_of_element_located((By.CLASS_NAME, REBAJA_PRICE_CLASS))
+            )
+            return price_elem.text
+    except HTTPException:
+        raise
+    except TimeoutException:
+        raise HTTPException(503, "Error al scrapear La Rebaja: no se encontró el precio a tiempo")
     except Exception as e:
-        driver.quit()
         raise HTTPException(503, f"Error al scrapear La Rebaja: {e}")
-    driver.quit()
 
+# -----------------------------
+# Comparación masiva de precios (job en segundo plano)
+# -----------------------------
+PRICE_JOB_INTERVAL = float(os.getenv("PRICE_JOB_INTERVAL", "0"))  # segundos; 0 = sin programación
+# El job deja siempre una sesión del pool para /products/{id}/scrape-price;
+# con SCRAPER_POOL_SIZE=1 no hay cómo reservarla y comparten la única sesión
+PRICE_JOB_MAX_CONCURRENCY = max(1, SCRAPER_POOL_SIZE - 1)
+PRICE_JOB_CONCURRENCY = min(
+    int(os.getenv("PRICE_JOB_CONCURRENCY", str(PRICE_JOB_MAX_CONCURRENCY))), PRICE_JOB_MAX_CONCURRENCY
+)
+PRICE_JOB_RATE = float(os.getenv("PRICE_JOB_RATE", "1"))  # páginas por segundo hacia el retailer
+PRICE_JOB_CHUNK = int(os.getenv("PRICE_JOB_CHUNK", "20"))
+# Vigencia del lease del job (segundos); se renueva tras cada lote, así que debe
+# superar lo que tarda un lote. Si el worker muere, otro lo retoma al expirar.
+PRICE_JOB_LEASE = float(os.getenv("PRICE_JOB_LEASE", "300"))
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+async def acquire_job_lock(name: str, owner: str, lease: float) -> bool:
+    """Toma o renueva el lease `name`; False si otro worker lo tiene vigente."""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=lease)
+    async with AsyncSessionLocal() as db:
+        result = await db.execute(
+            update(JobLockDB)
+            .where(JobLockDB.name == name, or_(JobLockDB.owner == owner, JobLockDB.expires_at < now))
+            .values(owner=owner, expires_at=expires_at)
+        )
+        if result.rowcount:
+            await db.commit()
+            return True
+        db.add(JobLockDB(name=name, owner=owner, expires_at=expires_at))
+        try:
+            await db.commit()
+            return True
+        except IntegrityError:
+            return False
+
+async def release_job_lock(name: str, owner: str):
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(JobLockDB).where(JobLockDB.name == name, JobLockDB.owner == owner))
+        await db.commit()
+
+class JobLockLost(Exception):
+    """El lease expiró y otro worker tomó el job."""
+
+def parse_price(text: Optional[str]) -> Optional[float]:
+    """Convierte '$ 12.345' o '$ 12.345,50' (formato colombiano) a número."""
+    if not text:
+        return None
+    cleaned = re.sub(r"[^0-9,.]", "", text).replace(".", "").replace(",", ".")
+    try:
+        return float(cleaned)
+    except ValueError:
+        return None
+
+class RateLimiter:
+    """Espaciado mínimo entre peticiones sucesivas (compartido entre tareas)."""
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+class PriceComparisonJob:
+    """Recorre el catálogo por lotes y actualiza external_prices; reanuda donde quedó.
+
+    Con varios workers (o réplicas) el lease en job_locks garantiza una sola
+    ejecución a la vez, tanto del programador como de POST /price-comparisons/jobs.
+    """
+
+    lock_name = "price_comparison"
+
+    def __init__(self):
+        self._task = None
+        self._scheduler = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    def start(self) -> bool:
+        if self.running:
+            return False
+        self._task = asyncio.create_task(self.run())
+        return True
+
+    async def _scrape(self, product_id: int, name: str, limiter: RateLimiter, slots: asyncio.Semaphore):
+        url = rebaja_search_url(name)
+        async with slots:
+            await limiter.wait()
+            try:
+                return product_id, await run_in_threadpool(scrape_rebaja_price, url), url
+            except HTTPException as e:
+                logging.warning("Comparación de precios: producto %s falló (%s)", product_id, e.detail)
+                return product_id, None, url
+
+    async def run(self):
+        if not await acquire_job_lock(self.lock_name, WORKER_ID, PRICE_JOB_LEASE):
+            logging.info("Comparación de precios: otro worker ya está ejecutando el job")
+            return
+        try:
+            await self._run()
+        finally:
+            await release_job_lock(self.lock_name, WORKER_ID)
+
+    async def _run(self):
+        limiter = RateLimiter(PRICE_JOB_RATE)
+        slots = asyncio.Semaphore(PRICE_JOB_CONCURRENCY)
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(PriceComparisonJobDB)
+                .where(PriceComparisonJobDB.status.in_(["running", "interrupted"]))
+                .order_by(PriceComparisonJobDB.id.desc())
+            )
+            job = result.scalars().first()
+            if job is None:
+                job = PriceComparisonJobDB(status="running", last_product_id=0, processed=0, failed=0)
+                db.add(job)
+            job.status = "running"
+            await db.commit()
+            try:
+                while True:
+                    result = await db.execute(
+                        select(ProductDB.id, ProductDB.name)
+                        .where(ProductDB.id > job.last_product_id)
+                        .order_by(ProductDB.id)
+                        .limit(PRICE_JOB_CHUNK)
+                    )
+                    chunk = result.all()
+                    if not chunk:
+                        break
+                    outcomes = await asyncio.gather(
+                        *(self._scrape(pid, name, limiter, slots) for pid, name in chunk)
+                    )
+                    for product_id, price, url in outcomes:
+                        if price is None:
+                            job.failed += 1
+                        else:
+                            await upsert_external_price(db, product_id, price, url)
+                            job.processed += 1
+                    job.last_product_id = chunk[-1].id
+                    await db.commit()  # progreso persistido por lote
+                    if not await acquire_job_lock(self.lock_name, WORKER_ID, PRICE_JOB_LEASE):
+                        raise JobLockLost()
+                job.status = "completed"
+                job.finished_at = datetime.utcnow()
+                await db.commit()
+            except asyncio.CancelledError:
+                await db.rollback()
+                job.status = "interrupted"
+                await db.commit()
+                raise
+            except JobLockLost:
+                # El progreso ya está guardado; el worker que tomó el lease sigue desde ahí
+                logging.warning("Comparación de precios: se perdió el lease, otro worker continúa el job")
+            except Exception as e:
+                await db.rollback()
+                job.status = "failed"
+                job.error = str(e)[:255]
+                job.finished_at = datetime.utcnow()
+                await db.commit()
+                logging.exception("Comparación de precios: el job falló")
+
+    async def schedule(self, interval: float):
+        while True:
+            if self.start():
+                await self._task
+            await asyncio.sleep(interval)
+
+    async def stop(self):
+        for task in (self._scheduler, self._task):
+            if task is not None and not task.done():
+                task.cancel()
+                try:
+                    await task
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+price_comparison_job = PriceComparisonJob()
+
+class PriceJobStatus(BaseModel):
+    id: Optional[int] = None
+    status: str
+    running: bool
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    last_product_id: Optional[int] = None
+    processed: Optional[int] = None
+    failed: Optional[int] = None
+    error: Optional[str] = None
+
+class PriceComparison(BaseModel):
+    product_id: int
+    producto: str
+    precio_interno: int
+    precio_rebaja: Optional[float] = None
+    diferencia: Optional[float] = None
+    diferencia_pct: Optional[float] = None
+    url: str
+    actualizado_en: datetime
+
+class PriceComparisonPage(BaseModel):
+    items: List[PriceComparison]
+    next_cursor: Optional[int] = None
+
+def price_job_status(job: Optional[PriceComparisonJobDB]) -> dict:
+    if job is None:
+        running = price_comparison_job.running
+        return {"status": "starting" if running else "never_run", "running": running}
     return {
-        "producto": product.name,
-        "precio_interno": product.price,
-        "precio_rebaja": precio_rebaja,
-        "url": url
+        "id": job.id,
+        "status": job.status,
+        "running": price_comparison_job.running,
+        "started_at": job.started_at,
+        "finished_at": job.finished_at,
+        "last_product_id": job.last_product_id,
+        "processed": job.processed,
+        "failed": job.failed,
+        "error": job.error,
     }
 
+@app.post("/price-comparisons/jobs", dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def start_price_comparison_job(db: AsyncSession = Depends(get_db)):
+    """Lanzar la comparación de precios de todo el catálogo en segundo plano."""
+    started = price_comparison_job.start()
+    result = await db.execute(select(PriceComparisonJobDB).order_by(PriceComparisonJobDB.id.desc()))
+    return {"iniciado": started, **price_job_status(result.scalars().first())}
+
+@app.get("/price-comparisons/jobs/latest", response_model=PriceJobStatus, response_model_exclude_unset=True,
+         dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def get_price_comparison_job(db: AsyncSession = Depends(get_db)):
+    """Estado del último job de comparación de precios."""
+    result = await db.execute(select(PriceComparisonJobDB).order_by(PriceComparisonJobDB.id.desc()))
+    return price_job_status(result.scalars().first())
+
+@app.get("/price-comparisons", response_model=Union[List[PriceComparison], PriceComparisonPage],
+         dependencies=[Depends(verify_role(["admin", "almacenista"]))])
+async def list_price_comparisons(page: dict = Depends(pagination_params), db: AsyncSession = Depends(get_db)):
+    """Diferencias precalculadas entre el precio interno y el de La Rebaja."""
+    stmt = (
+        select(ProductDB.id, ProductDB.name, ProductDB.price, ExternalPrice.price, ExternalPrice.url,
+               ExternalPrice.updated_at)
+        .join(ExternalPrice, ExternalPrice.product_id == ProductDB.id)
+        .order_by(ProductDB.id)
+    )
+    if page["after"] is not None:
+        stmt = stmt.where(ProductDB.id > page["after"])
+    if page["limit"] is not None:
+        stmt = stmt.limit(page["limit"] + 1)
+    rows = (await db.execute(stmt)).all()
+    next_cursor = None
+    if page["limit"] is not None and len(rows) > page["limit"]:
+        rows = rows[:page["limit"]]
+        next_cursor = rows[-1][0]
+    comparisons = []
+    for product_id, name, internal, external_text, url, updated_at in rows:
+        external = parse_price(external_text)
+        comparisons.append({
+            "product_id": product_id,
+            "producto": name,
+            "precio_interno": internal,
+            "precio_rebaja": external,
+            "diferencia": internal - external if external is not None else None,
+            "diferencia_pct": round((internal - external) / external * 100, 2) if external else None,
+            "url": url,
+            "actualizado_en": updated_at,
+        })
+    return rows_response(comparisons, next_cursor, page)
+
+# -----------------------------
+# Pagos con Stripe
+# -----------------------------
+# Estados en los que el PaymentIntent existente todavía puede pagarse
+REUSABLE_INTENT_STATUSES = {"requires_payment_method", "requires_confirmation", "requires_action", "processing"}
+MODIFIABLE_INTENT_STATUSES = {"requires_payment_method", "requires_confirmation", "requires_action"}
+
+async def retrieve_payment_intent(intent_id: str):
+    stripe = get_stripe()
+    try:
+        with external_call("stripe"):
+            return await run_in_threadpool(stripe.PaymentIntent.retrieve, intent_id)
+    except stripe.InvalidRequestError:
+        # El intent ya no existe (p. ej. se cambió de cuenta o de modo)
+        return None
+
 @app.post("/create-payment-intent")
-def create_payment_intent(data: CreatePayment, db: Session = Depends(get_db),
-                          current_user: UserDB = Depends(verify_role(["cliente", "admin"]))):
+async def create_payment_intent(data: CreatePayment, db: AsyncSession = Depends(get_db),
+                          current_user: Principal = Depends(verify_role(["cliente", "admin"]))):
     # 1) Carga la orden
-    order = db.query(OrderDB).filter(OrderDB.id == data.order_id).first()
+    order = await db.get(OrderDB, data.order_id)
     if not order or (current_user.role.name == "cliente" and order.client_id != current_user.id):
         raise HTTPException(404, "Orden no encontrada")
     if order.payment_status == "paid":
         raise HTTPException(400, "Orden ya pagada")
 
-    # 2) Crea un PaymentIntent en Stripe
-    intent = stripe.PaymentIntent.create(
-        amount=int(order.total * 100),  # Stripe trabaja en centavos
-        currency="cop",
-        metadata={"order_id": order.id},
-    )
+    stripe = get_stripe()
+    amount = int(order.total * 100)  # Stripe trabaja en centavos
+    previous_id = order.stripe_payment_intent_id
+    try:
+        # 2) Reutiliza el PaymentIntent de la orden si sigue vigente
+        if previous_id:
+            intent = await retrieve_payment_intent(previous_id)
+            if intent is not None and intent.status == "succeeded":
+                # El webhook aún no llegó: sincroniza el estado y corta
+                order.payment_status = "paid"
+                await db.commit()
+                raise HTTPException(400, "Orden ya pagada")
+            if intent is not None and intent.status in REUSABLE_INTENT_STATUSES:
+                if intent.amount != amount and intent.status in MODIFIABLE_INTENT_STATUSES:
+                    with external_call("stripe"):
+                        intent = await run_in_threadpool(stripe.PaymentIntent.modify, intent.id, amount=amount)
+                return {"clientSecret": intent.client_secret}
+
+        # 3) Crea uno nuevo; la clave de idempotencia hace que reintentos
+        #    concurrentes de la misma orden reciban el mismo intent
+        with external_call("stripe"):
+            intent = await run_in_threadpool(
+                stripe.PaymentIntent.create,
+                amount=amount,
+                currency="cop",
+                metadata={"order_id": order.id},
+                idempotency_key=f"order-{order.id}-{amount}-{previous_id or 'inicial'}",
+            )
+    except stripe.StripeError:
+        logging.exception("Error de Stripe con la orden %s", order.id)
+        raise HTTPException(502, "No se pudo contactar al proveedor de pagos")
 
-    # 3) Guarda el ID en tu base
+    # 4) Guarda el ID en tu base
     order.stripe_payment_intent_id = intent.id
-    db.commit()
+    await db.commit()
 
-    # 4) Devuelve al frontend el client_secret
+    # 5) Devuelve al frontend el client_secret
     return {"clientSecret": intent.client_secret}
+
+# Los eventos se guardan antes de responder a Stripe y se procesan fuera
+# de la petición; si el proceso cae, los pendientes se retoman al arrancar
+stripe_event_queue: "asyncio.Queue[str]" = asyncio.Queue()
+
+PAYMENT_STATUS_BY_EVENT = {
+    "payment_intent.succeeded": "paid",
+    "payment_intent.processing": "processing",
+    "payment_intent.payment_failed": "failed",
+    "payment_intent.canceled": "unpaid",
+}
+
+async def apply_stripe_event(db: AsyncSession, event: dict):
+    payment_status = PAYMENT_STATUS_BY_EVENT.get(event.get("type"))
+    if payment_status is None:
+        return
+    intent = event["data"]["object"]
+    order_id = (intent.get("metadata") or {}).get("order_id")
+    stmt = update(OrderDB).where(OrderDB.payment_status != "paid")  # nunca retrocede una orden pagada
+    if order_id:
+        stmt = stmt.where(OrderDB.id == int(order_id))
+    else:
+        stmt = stmt.where(OrderDB.stripe_payment_intent_id == intent["id"])
+    if payment_status != "paid":
+        # Eventos de un intent reemplazado no afectan a la orden
+        stmt = stmt.where(OrderDB.stripe_payment_intent_id == intent["id"])
+    values = {"payment_status": payment_status}
+    if payment_status == "paid":
+        values["stripe_payment_intent_id"] = intent["id"]
+    await db.execute(stmt.values(**values))
+
+async def process_stripe_event(event_id: str):
+    async with AsyncSessionLocal() as db:
+        row = await db.get(StripeEventDB, event_id)
+        if row is None or row.processed_at is not None:
+            return
+        try:
+            await apply_stripe_event(db, json.loads(row.payload))
+            row.processed_at = datetime.utcnow()
+            row.error = None
+        except Exception as exc:
+            await db.rollback()
+            row = await db.get(StripeEventDB, event_id)
+            row.error = str(exc)[:255]
+            logging.exception("No se pudo procesar el evento de Stripe %s", event_id)
+        row.attempts = (row.attempts or 0) + 1
+        await db.commit()
+        if row.processed_at is None and row.attempts < STRIPE_EVENT_MAX_ATTEMPTS:
+            asyncio.get_running_loop().call_later(2 ** row.attempts, stripe_event_queue.put_nowait, event_id)
+
+async def stripe_event_worker():
+    async with AsyncSessionLocal() as db:
+        pending = (await db.execute(
+            select(StripeEventDB.id)
+            .where(StripeEventDB.processed_at.is_(None), StripeEventDB.attempts < STRIPE_EVENT_MAX_ATTEMPTS)
+            .order_by(StripeEventDB.received_at)
+        )).scalars().all()
+    for event_id in pending:
+        stripe_event_queue.put_nowait(event_id)
+    while True:
+        event_id = await stripe_event_queue.get()
+        try:
+            await process_stripe_event(event_id)
+        except Exception:
+            logging.exception("Fallo el worker de eventos de Stripe")
+        finally:
+            stripe_event_queue.task_done()
+
+@app.post("/stripe/webhook")
+async def stripe_webhook(request: Request, db: AsyncSession = Depends(get_db)):
+    """Recibir eventos de Stripe y encolarlos para procesarlos aparte."""
+    if not STRIPE_WEBHOOK_SECRET:
+        raise HTTPException(503, "Webhook de Stripe no configurado")
+    payload = await request.body()
+    stripe = get_stripe()
+    try:
+        event = stripe.Webhook.construct_event(payload, request.headers.get("stripe-signature", ""), STRIPE_WEBHOOK_SECRET)
+    except (ValueError, stripe.SignatureVerificationError):
+        raise HTTPException(400, "Firma o payload inválido")
+
+    db.add(StripeEventDB(id=event.id, type=event.type, payload=payload.decode("utf-8")))
+    try:
+        await db.commit()
+    except IntegrityError:
+        # Stripe reintenta entregas: el evento ya está registrado
+        await db.rollback()
+        return {"received": True, "duplicate": True}
+    stripe_event_queue.put_nowait(event.id)
+    return {"received": True}
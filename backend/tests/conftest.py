@@ -0,0 +1,96 @@
+"""
+Fixtures compartidas: farmacia contra una base SQLite temporal, sin servicios externos.
+
+    cd backend && python -m pytest tests
+"""
+import itertools
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+os.environ["DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/tests.db"
+os.environ.setdefault("LOG_FORMAT", "text")
+
+import httpx  # noqa: E402
+
+import farmacia  # noqa: E402
+
+ADMIN = {"username": "admin", "password": "fasapisecrets"}
+product_numbers = itertools.count(1)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    farmacia.init_database()
+    yield
+    farmacia.engine.dispose()
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture
+async def client():
+    transport = httpx.ASGITransport(app=farmacia.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as c:
+        yield c
+
+
+@pytest.fixture
+async def admin_headers(client):
+    r = await client.post("/token", data=ADMIN)
+    r.raise_for_status()
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+@pytest.fixture
+async def db():
+    async with farmacia.AsyncSessionLocal() as session:
+        yield session
+
+
+@pytest.fixture
+async def make_product(client, admin_headers):
+    """Crea un producto con nombre único y devuelve su id."""
+    async def make(stock=10, price=1000):
+        name = f"Producto prueba {next(product_numbers)}"
+        r = await client.post("/products/", params={"confirmado": True},
+                              json={"name": name, "stock": stock, "price": price}, headers=admin_headers)
+        assert r.status_code == 200, r.text
+        async with farmacia.AsyncSessionLocal() as session:
+            return (await session.execute(
+                farmacia.select(farmacia.ProductDB.id).where(farmacia.ProductDB.name == name)
+            )).scalar_one()
+
+    return make
+
+
+@pytest.fixture
+async def make_order(client, admin_headers, make_product):
+    """Crea una orden pendiente de un producto y devuelve (order_id, product_id)."""
+
+    async def make(quantity=1, stock=10):
+        product_id = await make_product(stock=stock)
+        r = await client.post("/orders/", json={"items": [{"product_id": product_id, "quantity": quantity}]},
+                              headers=admin_headers)
+        assert r.status_code == 200, r.text
+        return r.json()["order_id"], product_id
+
+    return make
+
+
+@pytest.fixture(autouse=True)
+def local_validators(monkeypatch):
+    """Sin red: las Lambdas de validación se reemplazan por las reglas locales."""
+
+    async def post(url, payload):
+        raise farmacia.LambdaUnavailable("pruebas sin red")
+
+    monkeypatch.setattr(farmacia.lambda_validator, "post", post)
+    monkeypatch.setattr(farmacia, "LAMBDA_FALLBACK", "local")
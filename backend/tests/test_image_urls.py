@@ -0,0 +1,84 @@
+"""URLs de imágenes: límite por lote, errores por imagen y consultas a S3 por derivado."""
+import io
+
+import pytest
+from PIL import Image
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_one_broken_image_does_not_fail_the_batch(client, admin_headers, monkeypatch):
+    def get(filename, size=None, fmt="webp"):
+        if filename == "rota.png":
+            raise RuntimeError("sin acceso")
+        return f"https://s3.test/{size}/{filename}"
+
+    monkeypatch.setattr(farmacia.image_url_cache, "get", get)
+    r = await client.post("/imagenes/urls", json={"filenames": ["a.png", "rota.png", "a.png"], "size": "thumb"},
+                          headers=admin_headers)
+    assert r.status_code == 200
+    assert r.json()["urls"] == {"a.png": "https://s3.test/thumb/a.png"}
+    assert list(r.json()["errores"]) == ["rota.png"]
+
+
+async def test_batch_limit(client, admin_headers, monkeypatch):
+    monkeypatch.setattr(farmacia.image_url_cache, "get", lambda filename, size=None, fmt="webp": filename)
+    names = [f"{n}.png" for n in range(farmacia.MAX_IMAGE_BATCH + 1)]
+    r = await client.post("/imagenes/urls", json={"filenames": names[:-1]}, headers=admin_headers)
+    assert len(r.json()["urls"]) == farmacia.MAX_IMAGE_BATCH
+    r = await client.post("/imagenes/urls", json={"filenames": names}, headers=admin_headers)
+    assert r.status_code == 400
+
+
+class FakeS3:
+    """Bucket en memoria que cuenta los HEAD."""
+
+    def __init__(self):
+        buffer = io.BytesIO()
+        Image.new("RGB", (800, 800)).save(buffer, format="PNG")
+        self.objects = {"foto.png": buffer.getvalue()}
+        self.heads = []
+
+    def get_object(self, Bucket, Key):
+        return {"Body": io.BytesIO(self.objects[Key])}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body
+
+    def head_object(self, Bucket, Key):
+        self.heads.append(Key)
+        if Key not in self.objects:
+            raise KeyError(Key)
+
+    def generate_presigned_url(self, ClientMethod, Params, ExpiresIn):
+        return f"https://s3.test/{Params['Key']}"
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    fake = FakeS3()
+    monkeypatch.setattr(farmacia, "s3_client", fake)
+    monkeypatch.setattr(farmacia, "image_pipeline", farmacia.ImageDerivativePipeline(1, 10))
+    return fake
+
+
+def test_existing_derivative_is_checked_once(s3):
+    key = farmacia.derived_image_key("foto.png", "thumb", "webp")
+    s3.objects[key] = b"webp"
+    for _ in range(3):
+        # Caché de URLs nueva en cada vuelta: como si la URL firmada hubiera expirado
+        assert farmacia.ImageUrlCache(10).get("foto.png", "thumb") == f"https://s3.test/{key}"
+    assert s3.heads == [key]
+
+
+def test_pipeline_records_what_it_generates(s3):
+    url = farmacia.ImageUrlCache(10).get("foto.png", "thumb")
+    assert url == "https://s3.test/foto.png"  # aún sin derivado: el original
+    farmacia.image_pipeline.executor.shutdown(wait=True)
+
+    key = farmacia.derived_image_key("foto.png", "medium", "webp")
+    assert key in s3.objects
+    assert farmacia.ImageUrlCache(10).get("foto.png", "medium") == f"https://s3.test/{key}"
+    assert s3.heads == [farmacia.derived_image_key("foto.png", "thumb", "webp")]
@@ -0,0 +1,40 @@
+"""Claves temporales de Fernet/JWT: solo con un único proceso de desarrollo."""
+import pytest
+
+import farmacia
+
+
+@pytest.fixture
+def no_keys(monkeypatch):
+    for name in ("FERNET_KEYS", "FERNET_KEY", "JWT_KEYS", "SECRET_KEY"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setattr(farmacia, "IS_PRODUCTION", False)
+    monkeypatch.setattr(farmacia, "WEB_CONCURRENCY", 1)
+    monkeypatch.setattr(farmacia, "DB_INIT_ON_STARTUP", True)
+    return monkeypatch
+
+
+def test_single_dev_process_gets_temporary_keys(no_keys):
+    assert len(farmacia.load_fernet_keys()) == 1
+    assert list(farmacia.load_jwt_keys()) == ["dev"]
+
+
+@pytest.mark.parametrize("setting, value, reason", [
+    ("WEB_CONCURRENCY", 2, "WEB_CONCURRENCY=2"),
+    ("DB_INIT_ON_STARTUP", False, "DB_INIT_ON_STARTUP=false"),
+    ("IS_PRODUCTION", True, "ENV=production"),
+])
+def test_shared_keys_are_required(no_keys, setting, value, reason):
+    no_keys.setattr(farmacia, setting, value)
+    with pytest.raises(RuntimeError, match=f"FERNET_KEYS no configurada; es obligatoria con {reason}"):
+        farmacia.load_fernet_keys()
+    with pytest.raises(RuntimeError, match=f"JWT_KEYS no configurada; es obligatoria con {reason}"):
+        farmacia.load_jwt_keys()
+
+
+def test_configured_keys_work_with_several_workers(no_keys):
+    no_keys.setattr(farmacia, "WEB_CONCURRENCY", 4)
+    no_keys.setenv("FERNET_KEYS", "clave-nueva,clave-vieja")
+    no_keys.setenv("JWT_KEYS", "k2:secreto2,k1:secreto1")
+    assert farmacia.load_fernet_keys() == [b"clave-nueva", b"clave-vieja"]
+    assert list(farmacia.load_jwt_keys()) == ["k2", "k1"]
@@ -0,0 +1,151 @@
+"""LambdaValidator y CircuitBreaker contra un servidor falso (httpx.MockTransport)."""
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+URL = "https://lambda.test/validate"
+
+
+@pytest.fixture(autouse=True)
+def fast_settings(monkeypatch):
+    monkeypatch.setattr(farmacia, "LAMBDA_RETRIES", 2)
+    monkeypatch.setattr(farmacia, "LAMBDA_CIRCUIT_THRESHOLD", 2)
+    monkeypatch.setattr(farmacia, "LAMBDA_CIRCUIT_RESET", 0.05)
+    monkeypatch.setattr(farmacia.random, "uniform", lambda a, b: 0)  # sin espera entre reintentos
+
+
+def make_validator(*responses):
+    """Validador cuyo servidor responde en orden `responses` (status, excepción o callable)."""
+    requests = []
+    pending = list(responses)
+
+    def handler(request):
+        requests.append(request)
+        response = pending.pop(0) if len(pending) > 1 else pending[0]
+        if isinstance(response, Exception):
+            raise response
+        if isinstance(response, int):
+            return httpx.Response(response, json={"status": response})
+        return response(request)
+
+    validator = farmacia.LambdaValidator()
+    validator._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return validator, requests
+
+
+async def test_caches_final_responses():
+    validator, requests = make_validator(200)
+    assert await validator.post(URL, {"precio": 1}) == (200, {"status": 200})
+    assert await validator.post(URL, {"precio": 1}) == (200, {"status": 200})
+    assert len(requests) == 1
+    await validator.post(URL, {"precio": 2})
+    assert len(requests) == 2
+
+
+async def test_bad_request_is_cached_but_other_4xx_are_not():
+    validator, requests = make_validator(400)
+    await validator.post(URL, {"stock": -1})
+    await validator.post(URL, {"stock": -1})
+    assert len(requests) == 1
+
+    validator, requests = make_validator(404)
+    assert (await validator.post(URL, {"stock": -1}))[0] == 404
+    await validator.post(URL, {"stock": -1})
+    assert len(requests) == 2
+
+
+async def test_cache_expires(monkeypatch):
+    monkeypatch.setattr(farmacia, "LAMBDA_CACHE_TTL", 0)
+    validator, requests = make_validator(200)
+    await validator.post(URL, {"precio": 1})
+    await validator.post(URL, {"precio": 1})
+    assert len(requests) == 2
+
+
+async def test_retries_server_errors():
+    validator, requests = make_validator(503, 502, 200)
+    assert (await validator.post(URL, {}))[0] == 200
+    assert len(requests) == 3
+    assert validator._breaker(URL).failures == 0
+
+
+async def test_timeout_exhausts_retries():
+    validator, requests = make_validator(httpx.ReadTimeout("lento"))
+    with pytest.raises(farmacia.LambdaUnavailable, match="lento"):
+        await validator.post(URL, {})
+    assert len(requests) == farmacia.LAMBDA_RETRIES + 1
+    assert validator._breaker(URL).failures == 1
+
+
+async def test_invalid_json_counts_as_failure():
+    validator, _ = make_validator(lambda request: httpx.Response(200, content=b"<html>"))
+    with pytest.raises(farmacia.LambdaUnavailable):
+        await validator.post(URL, {})
+
+
+async def test_circuit_opens_then_half_open_probe_closes_it():
+    server = {"status": 503}
+    validator, requests = make_validator(lambda request: httpx.Response(server["status"], json={}))
+    for _ in range(farmacia.LAMBDA_CIRCUIT_THRESHOLD):
+        with pytest.raises(farmacia.LambdaUnavailable):
+            await validator.post(URL, {})
+    sent = len(requests)
+
+    # Abierto: falla sin llamar a la Lambda
+    with pytest.raises(farmacia.LambdaUnavailable, match="circuito abierto"):
+        await validator.post(URL, {})
+    assert len(requests) == sent
+
+    # Semiabierto: pasa una sola llamada de prueba; si responde, el circuito se cierra
+    await asyncio.sleep(farmacia.LAMBDA_CIRCUIT_RESET)
+    server["status"] = 200
+    assert (await validator.post(URL, {"n": 1}))[0] == 200
+    assert (await validator.post(URL, {"n": 2}))[0] == 200
+    assert validator._breaker(URL).opened_at is None
+
+
+async def test_failed_half_open_probe_reopens_circuit():
+    validator, requests = make_validator(503)
+    for _ in range(farmacia.LAMBDA_CIRCUIT_THRESHOLD):
+        with pytest.raises(farmacia.LambdaUnavailable):
+            await validator.post(URL, {})
+    await asyncio.sleep(farmacia.LAMBDA_CIRCUIT_RESET)
+    sent = len(requests)
+    with pytest.raises(farmacia.LambdaUnavailable, match="HTTP 503"):
+        await validator.post(URL, {})
+    assert len(requests) == sent + farmacia.LAMBDA_RETRIES + 1
+    with pytest.raises(farmacia.LambdaUnavailable, match="circuito abierto"):
+        await validator.post(URL, {})
+
+
+def test_half_open_lets_a_single_call_through():
+    breaker = farmacia.CircuitBreaker(threshold=1, reset_timeout=60)
+    breaker.record_failure()
+    breaker.opened_at -= 60  # enfriamiento cumplido
+    assert breaker.allow() is True
+    assert breaker.allow() is False
+
+
+async def test_fallback_local_applies_local_rules():
+    # conftest deja la Lambda global sin red
+    status_code, body = await farmacia.call_validator(
+        URL, {"username": "x"}, lambda: farmacia.validate_username_locally("x")
+    )
+    assert status_code == 400 and "3-50" in body["error"]
+
+
+async def test_fallback_error_returns_503(monkeypatch, client, admin_headers):
+    monkeypatch.setattr(farmacia, "LAMBDA_FALLBACK", "error")
+    with pytest.raises(HTTPException) as error:
+        await farmacia.call_validator(URL, {}, lambda: (200, {}))
+    assert error.value.status_code == 503
+
+    r = await client.post("/register", json={"username": "nuevo_usuario", "password": "Clave123!", "role": "cliente"},
+                          headers=admin_headers)
+    assert r.status_code == 503
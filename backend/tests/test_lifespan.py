@@ -0,0 +1,30 @@
+"""El lifespan arranca y detiene las tareas en segundo plano del worker."""
+import asyncio
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_background_tasks_start_and_stop(monkeypatch):
+    # Los pools compartidos siguen vivos para el resto de las pruebas
+    for obj, name in [(farmacia.password_hasher, "shutdown"), (farmacia.image_pipeline, "shutdown"),
+                      (farmacia.webdriver_pool, "close")]:
+        monkeypatch.setattr(obj, name, lambda: None)
+
+    async def close():
+        pass
+
+    monkeypatch.setattr(farmacia.lambda_validator, "close", close)
+    monkeypatch.setattr(farmacia, "DB_INIT_ON_STARTUP", False)
+    monkeypatch.setattr(farmacia, "STOCK_SNAPSHOT_INTERVAL", 3600)
+    monkeypatch.setattr(farmacia, "stripe_event_queue", asyncio.Queue())
+
+    assert farmacia.app.router.on_startup == [] and farmacia.app.router.on_shutdown == []
+    before = asyncio.all_tasks()
+    async with farmacia.lifespan(farmacia.app):
+        started = asyncio.all_tasks() - before
+        assert {task.get_coro().__name__ for task in started} == {"stripe_event_worker", "stock_snapshot_scheduler"}
+    assert all(task.done() for task in started)
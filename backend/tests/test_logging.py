@@ -0,0 +1,63 @@
+"""Los logs de uvicorn, incluido el access log, pasan por la cola con el request_id."""
+import logging
+import logging.config
+
+import httpx
+import pytest
+from uvicorn.config import LOGGING_CONFIG
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+UVICORN_LOGGERS = ("uvicorn", "uvicorn.error", "uvicorn.access")
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+        self.addFilter(farmacia.RequestContextFilter())
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+@pytest.fixture
+def captured():
+    handler = ListHandler()
+    root = logging.getLogger()
+    root.addHandler(handler)
+    yield handler.records
+    root.removeHandler(handler)
+
+
+def test_uvicorn_loggers_propagate_to_root():
+    # Lo que hace uvicorn al arrancar: StreamHandlers propios y propagate=False
+    logging.config.dictConfig(LOGGING_CONFIG)
+    assert logging.getLogger("uvicorn.access").handlers
+    farmacia.route_uvicorn_logs()
+    for name in UVICORN_LOGGERS:
+        logger = logging.getLogger(name)
+        assert logger.handlers == [] and logger.propagate
+
+
+async def test_access_log_has_request_id(captured):
+    access_logger = logging.getLogger("uvicorn.access")
+    access_logger.setLevel(logging.INFO)  # nivel que le da uvicorn
+
+    async def server(scope, receive, send):
+        # Como uvicorn: la línea del access log se escribe al enviar el inicio de la respuesta
+        async def send_and_log(message):
+            if message["type"] == "http.response.start":
+                access_logger.info('"%s %s" %d', scope["method"], scope["path"], message["status"])
+            await send(message)
+
+        await farmacia.app(scope, receive, send_and_log)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=server), base_url="http://test") as client:
+        r = await client.get("/metrics", headers={"X-Request-ID": "abc-123"})
+    assert r.headers["X-Request-ID"] == "abc-123"
+    access = [record for record in captured if record.name == "uvicorn.access"]
+    assert [record.request_id for record in access] == ["abc-123"]
+    assert farmacia.request_id_var.get() is None
@@ -0,0 +1,49 @@
+"""GET /orders/?include=items hace las mismas consultas con 1 orden por página que con 50."""
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+STATUS = "prueba_n1"  # solo las órdenes de esta prueba
+
+
+@pytest.fixture
+async def orders():
+    async with farmacia.AsyncSessionLocal() as session:
+        for n in range(50):
+            product = farmacia.ProductDB(name=f"Producto N+1 {n}", stock=10, price=100)
+            order = farmacia.OrderDB(client_id=1, status=STATUS, total=200)
+            order.items = [farmacia.OrderItemDB(product=product, quantity=1),
+                           farmacia.OrderItemDB(product=product, quantity=1)]
+            session.add(order)
+        await session.commit()
+
+
+@pytest.fixture
+def request_stats(monkeypatch):
+    """RequestStats de cada petición (las crea el middleware de métricas)."""
+    created = []
+
+    class RecordedStats(farmacia.RequestStats):
+        __slots__ = ()
+
+        def __init__(self):
+            super().__init__()
+            created.append(self)
+
+    monkeypatch.setattr(farmacia, "RequestStats", RecordedStats)
+    return created
+
+
+async def test_query_count_does_not_depend_on_page_size(client, admin_headers, orders, request_stats):
+    async def queries(limit):
+        r = await client.get("/orders/", params={"include": "items", "status": STATUS, "limit": limit},
+                             headers=admin_headers)
+        assert r.status_code == 200, r.text
+        page = r.json()["items"]
+        assert len(page) == limit and all(len(order["items"]) == 2 for order in page)
+        return request_stats[-1].queries
+
+    await queries(1)  # identidad del admin ya en caché para las dos mediciones
+    assert await queries(1) == await queries(50) <= 3
@@ -0,0 +1,126 @@
+"""Job de comparación de precios: reanudación, sesión libre para consultas interactivas y lease."""
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+class FakeDriver:
+    """Sesión WebDriver que "carga" la página en `delay` segundos y siempre encuentra el precio."""
+
+    current_url = "about:blank"
+
+    def __init__(self, browser):
+        self.browser = browser
+
+    def get(self, url):
+        self.browser.visited.append(url)
+        gate = self.browser.gates.get(url)
+        if gate is not None:
+            self.browser.blocked.set()
+            gate.wait(5)
+        time.sleep(self.browser.delay)
+
+    def find_element(self, by, value):
+        return SimpleNamespace(text="$ 1.000", is_displayed=lambda: True)
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+async def browser(monkeypatch):
+    fake = SimpleNamespace(visited=[], gates={}, blocked=threading.Event(), delay=0)
+    pool = farmacia.WebDriverPool(farmacia.SCRAPER_POOL_SIZE)
+    monkeypatch.setattr(pool, "_create", lambda: FakeDriver(fake))
+    monkeypatch.setattr(farmacia, "webdriver_pool", pool)
+    monkeypatch.setattr(farmacia, "PRICE_JOB_RATE", 0)
+    monkeypatch.setattr(farmacia, "SCRAPER_ACQUIRE_TIMEOUT", 0.2)
+    async with farmacia.AsyncSessionLocal() as session:
+        await session.execute(farmacia.delete(farmacia.PriceComparisonJobDB))
+        await session.execute(farmacia.delete(farmacia.JobLockDB))
+        await session.commit()
+    return fake
+
+
+async def products_from_here(make_product, count):
+    """Crea `count` productos y deja un job interrumpido justo antes del primero."""
+    ids = [await make_product() for _ in range(count)]
+    async with farmacia.AsyncSessionLocal() as session:
+        session.add(farmacia.PriceComparisonJobDB(status="interrupted", last_product_id=ids[0] - 1))
+        await session.commit()
+    return ids
+
+
+async def latest_job():
+    async with farmacia.AsyncSessionLocal() as session:
+        return (await session.execute(
+            farmacia.select(farmacia.PriceComparisonJobDB).order_by(farmacia.PriceComparisonJobDB.id.desc())
+        )).scalars().first()
+
+
+async def product_url(product_id):
+    async with farmacia.AsyncSessionLocal() as session:
+        return farmacia.rebaja_search_url((await session.get(farmacia.ProductDB, product_id)).name)
+
+
+async def test_resumes_where_the_interrupted_run_stopped(browser, make_product, monkeypatch):
+    monkeypatch.setattr(farmacia, "PRICE_JOB_CHUNK", 1)
+    ids = await products_from_here(make_product, 3)
+    browser.gates[await product_url(ids[1])] = gate = threading.Event()
+
+    task = asyncio.create_task(farmacia.price_comparison_job.run())
+    while not browser.blocked.is_set():
+        await asyncio.sleep(0.01)
+    task.cancel()
+    gate.set()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    job = await latest_job()
+    assert (job.status, job.last_product_id, job.processed) == ("interrupted", ids[0], 1)
+
+    browser.visited.clear()
+    browser.gates.clear()
+    await farmacia.price_comparison_job.run()
+    job = await latest_job()
+    assert (job.status, job.last_product_id, job.processed) == ("completed", ids[-1], 3)
+    assert browser.visited == [await product_url(i) for i in ids[1:]]
+
+
+async def test_interactive_lookup_gets_a_session_while_the_job_runs(browser, make_product, client, admin_headers):
+    browser.delay = 0.4  # más que SCRAPER_ACQUIRE_TIMEOUT: sin sesión libre sería un 503
+    ids = await products_from_here(make_product, 3)
+    task = asyncio.create_task(farmacia.price_comparison_job.run())
+    await asyncio.sleep(0.1)
+
+    r = await client.get(f"/products/{ids[0]}/scrape-price", params={"refresh": True}, headers=admin_headers)
+    assert r.status_code == 200, r.text
+    assert not task.done()
+    await task
+    assert (await latest_job()).status == "completed"
+
+
+async def test_only_one_worker_runs_the_job(browser, make_product):
+    await products_from_here(make_product, 1)
+    assert await farmacia.acquire_job_lock("price_comparison", "otro-worker", 60)
+
+    await farmacia.price_comparison_job.run()
+    assert browser.visited == []
+    assert (await latest_job()).status == "interrupted"
+
+    # El otro worker murió: al vencer su lease el job se retoma
+    async with farmacia.AsyncSessionLocal() as session:
+        lock = await session.get(farmacia.JobLockDB, "price_comparison")
+        lock.expires_at = datetime.utcnow() - timedelta(seconds=1)
+        await session.commit()
+    await farmacia.price_comparison_job.run()
+    assert (await latest_job()).status == "completed"
+    async with farmacia.AsyncSessionLocal() as session:
+        assert await session.get(farmacia.JobLockDB, "price_comparison") is None
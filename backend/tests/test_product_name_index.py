@@ -0,0 +1,20 @@
+"""Detección de nombres de producto parecidos (ProductNameIndex)."""
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+async def test_similar_scores_every_name():
+    index = farmacia.ProductNameIndex(ttl=300)
+    index._loaded_at = 0  # cargado a mano, sin base de datos
+    for n in range(5000):
+        index.add(n, f"Paracetamol 500 mg #{n}")
+    index.add(9999, "Ibuprofeno 400 mg tabletas")
+
+    matches = await index.similar("IBUPROFENO 400mg Tabletas", limit=3, score_cutoff=70)
+    assert matches[0]["id"] == 9999 and matches[0]["nombre"] == "Ibuprofeno 400 mg tabletas"
+
+    index.remove(9999)
+    assert all(m["id"] != 9999 for m in await index.similar("Ibuprofeno 400 mg tabletas", 3, 70))
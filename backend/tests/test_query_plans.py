@@ -0,0 +1,31 @@
+"""Las consultas calientes usan índices: un recorrido completo de tabla hace fallar la suite.
+
+Usa las consultas y el análisis de EXPLAIN de benchmarks/check_query_plans.py
+sobre la base de pruebas. Sin ANALYZE, SQLite elige un índice siempre que
+haya uno aplicable, así que la prueba falla solo si falta el índice. Para
+revisar los planes con datos sembrados o en MySQL está el script.
+"""
+import os
+import sys
+
+import pytest
+
+import farmacia
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks"))
+import check_query_plans  # noqa: E402
+
+CONSULTAS = check_query_plans.consultas_calientes()
+
+
+@pytest.mark.parametrize("stmt", [stmt for _, stmt in CONSULTAS], ids=[nombre for nombre, _ in CONSULTAS])
+def test_hot_query_uses_an_index(stmt):
+    with farmacia.engine.connect() as conn:
+        lineas, completos = check_query_plans.explicar(conn, stmt)
+    assert not completos, "\n".join(lineas)
+
+
+def test_full_scan_is_detected():
+    with farmacia.engine.connect() as conn:
+        _, completos = check_query_plans.explicar(conn, farmacia.select(farmacia.OrderDB).where(farmacia.OrderDB.total == 1))
+    assert completos
@@ -0,0 +1,96 @@
+"""Réplicas de lectura sobre dos archivos SQLite vacíos (sin replicación: lo escrito solo está en el primario)."""
+import os
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.fixture
+def replica_files(tmp_path):
+    paths = []
+    for name in ("replica1", "replica2"):
+        directory = tmp_path / name
+        directory.mkdir()
+        path = directory / "replica.db"
+        engine = farmacia.create_engine(f"sqlite:///{path}")
+        farmacia.Base.metadata.create_all(bind=engine)
+        engine.dispose()
+        paths.append(path)
+    return paths
+
+
+@pytest.fixture
+async def pool(replica_files, monkeypatch):
+    pool = farmacia.ReplicaPool([f"sqlite:///{path}" for path in replica_files])
+    monkeypatch.setattr(farmacia, "replicas", pool)
+    yield pool
+    await pool.dispose()
+
+
+def break_replica(path):
+    """Renombra el directorio de la réplica: SQLite ya no puede abrir el archivo."""
+    os.rename(path.parent, f"{path.parent}.caida")
+
+
+def restore_replica(path):
+    os.rename(f"{path.parent}.caida", path.parent)
+
+
+async def test_round_robin(pool):
+    first, second = pool.engines
+    assert [pool.pick() for _ in range(4)] == [first, second, first, second]
+
+
+async def test_health_check_removes_and_readmits(pool, replica_files):
+    first, second = pool.engines
+    break_replica(replica_files[0])
+    await pool.check()
+    assert pool.healthy == [second]
+    assert {pool.pick() for _ in range(3)} == {second}
+
+    restore_replica(replica_files[0])
+    await pool.check()
+    assert pool.healthy == [first, second]
+
+
+async def test_reads_go_to_replicas(client, admin_headers, make_product, pool):
+    product_id = await make_product()
+    r = await client.get("/stock_movements/", params={"product_id": product_id}, headers=admin_headers)
+    assert r.status_code == 200
+    assert r.json() == []  # la réplica vacía no tiene el alta
+
+
+async def test_last_write_reads_from_primary(client, admin_headers, pool):
+    r = await client.post("/products/", params={"confirmado": True},
+                          json={"name": "Producto réplica lectura", "stock": 3, "price": 1000},
+                          headers=admin_headers)
+    assert r.status_code == 200, r.text
+    headers = {**admin_headers, farmacia.LAST_WRITE_HEADER: r.headers[farmacia.LAST_WRITE_HEADER]}
+    async with farmacia.AsyncSessionLocal() as session:
+        product_id = (await session.execute(
+            farmacia.select(farmacia.ProductDB.id).where(farmacia.ProductDB.name == "Producto réplica lectura")
+        )).scalar_one()
+
+    r = await client.get("/stock_movements/", params={"product_id": product_id}, headers=headers)
+    assert r.status_code == 200
+    assert [m["change"] for m in r.json()] == [3]
+
+
+async def test_broken_replica_falls_back_to_primary(client, admin_headers, make_product, pool, replica_files):
+    product_id = await make_product(stock=4)
+    for path in replica_files:
+        break_replica(path)
+    # Ambas siguen "sanas" hasta el próximo chequeo: la lectura falla en la réplica y se repite en el primario
+    r = await client.get("/stock_movements/", params={"product_id": product_id}, headers=admin_headers)
+    assert r.status_code == 200
+    assert [m["change"] for m in r.json()] == [4]
+    r = await client.get(f"/products/{product_id}", headers=admin_headers)
+    assert r.status_code == 200
+    assert r.json()["stock"] == 4
+    assert pool.healthy == []
+
+    for path in replica_files:
+        restore_replica(path)
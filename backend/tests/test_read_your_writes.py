@@ -0,0 +1,44 @@
+"""Read-your-writes: solo las peticiones que escriben devuelven X-Last-Write."""
+import time
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+def request_with(headers):
+    scope = {"type": "http", "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()]}
+    return farmacia.Request(scope)
+
+
+async def test_login_is_not_a_write(client, admin_headers):
+    r = await client.post("/token", data={"username": "admin", "password": "fasapisecrets"}, headers=admin_headers)
+    assert r.status_code == 200
+    assert farmacia.LAST_WRITE_HEADER not in r.headers
+    r = await client.post("/imagenes/urls", json={"filenames": []}, headers=admin_headers)
+    assert r.status_code == 200
+    assert farmacia.LAST_WRITE_HEADER not in r.headers
+
+
+async def test_write_returns_the_marker(client, admin_headers):
+    r = await client.post("/products/", params={"confirmado": True},
+                          json={"name": "Producto marca de escritura", "stock": 1, "price": 1000},
+                          headers=admin_headers)
+    assert r.status_code == 200, r.text
+    marker = r.headers[farmacia.LAST_WRITE_HEADER]
+    assert farmacia.wrote_recently(request_with({farmacia.LAST_WRITE_HEADER: marker}))
+
+
+async def test_rejected_write_has_no_marker(client, admin_headers):
+    r = await client.post("/orders/", json={"items": [{"product_id": 10**9, "quantity": 1}]}, headers=admin_headers)
+    assert r.status_code >= 400
+    assert farmacia.LAST_WRITE_HEADER not in r.headers
+
+
+def test_marker_expires():
+    stale = time.time() - farmacia.READ_YOUR_WRITES_SECONDS - 1
+    assert not farmacia.wrote_recently(request_with({farmacia.LAST_WRITE_HEADER: f"{stale:.3f}"}))
+    assert not farmacia.wrote_recently(request_with({farmacia.LAST_WRITE_HEADER: "basura"}))
+    assert not farmacia.wrote_recently(request_with({}))
@@ -0,0 +1,80 @@
+"""Resúmenes por día/mes sobre los agregados: rango [date_from, date_to) y meses parciales."""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+PRODUCT_ID = 10**6  # sin movimientos de otras pruebas
+MOVEMENTS = [  # (instante, monto, cambio de stock)
+    (datetime(2031, 1, 5, 10), 1.0, -1),
+    (datetime(2031, 1, 20, 23, 59), 2.0, -2),
+    (datetime(2031, 2, 3, 8), 4.0, -4),
+    (datetime(2031, 3, 15, 12), 8.0, -8),
+]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def rollups(database):
+    async def record():
+        async with farmacia.AsyncSessionLocal() as session:
+            for when, amount, change in MOVEMENTS:
+                await farmacia.record_rollups(session, when, amount, {PRODUCT_ID: (change, 1)})
+            await session.commit()
+
+    asyncio.run(record())
+
+
+async def financial(client, headers, **params):
+    r = await client.get("/financial_movements/summary", params=params, headers=headers)
+    assert r.status_code == 200, r.text
+    return r.json()
+
+
+async def stock(client, headers, **params):
+    r = await client.get("/stock_movements/summary", params={"product_id": PRODUCT_ID, **params}, headers=headers)
+    assert r.status_code == 200, r.text
+    return [(item["period_start"], item["net_change"], item["movements"]) for item in r.json()["items"]]
+
+
+async def test_date_to_is_exclusive(client, admin_headers):
+    summary = await financial(client, admin_headers, date_from="2031-01-05", date_to="2031-01-20")
+    assert [(i["period_start"], i["amount"]) for i in summary["items"]] == [("2031-01-05", 1.0)]
+    assert await stock(client, admin_headers, date_from="2031-01-05", date_to="2031-01-21") == [
+        ("2031-01-05", -1, 1), ("2031-01-20", -2, 1),
+    ]
+
+
+async def test_whole_months(client, admin_headers):
+    summary = await financial(client, admin_headers, granularity="month", date_from="2031-01-01", date_to="2031-04-01")
+    assert [(i["period_start"], i["amount"], i["movements"]) for i in summary["items"]] == [
+        ("2031-01-01", 3.0, 2), ("2031-02-01", 4.0, 1), ("2031-03-01", 8.0, 1),
+    ]
+    assert summary["total"] == 15.0
+
+
+async def test_partial_first_and_last_month(client, admin_headers):
+    summary = await financial(client, admin_headers, granularity="month", date_from="2031-01-15", date_to="2031-03-10")
+    assert [(i["period_start"], i["amount"]) for i in summary["items"]] == [("2031-01-01", 2.0), ("2031-02-01", 4.0)]
+    assert await stock(client, admin_headers, granularity="month", date_from="2031-01-15", date_to="2031-03-20") == [
+        ("2031-01-01", -2, 1), ("2031-02-01", -4, 1), ("2031-03-01", -8, 1),
+    ]
+
+
+async def test_range_inside_one_month(client, admin_headers):
+    assert await stock(client, admin_headers, granularity="month", date_from="2031-01-06", date_to="2031-01-25") == [
+        ("2031-01-01", -2, 1),
+    ]
+    assert await stock(client, admin_headers, granularity="month", date_from="2031-01-15", date_to="2031-02-10") == [
+        ("2031-01-01", -2, 1), ("2031-02-01", -4, 1),
+    ]
+
+
+async def test_open_ended_ranges(client, admin_headers):
+    assert await stock(client, admin_headers, granularity="month", date_from="2031-02-02") == [
+        ("2031-02-01", -4, 1), ("2031-03-01", -8, 1),
+    ]
+    assert await stock(client, admin_headers, granularity="month", date_to="2031-01-10") == [("2031-01-01", -1, 1)]
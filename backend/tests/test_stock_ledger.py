@@ -0,0 +1,73 @@
+"""Snapshots de stock, stock-at y conciliación frente a reservas, cancelaciones y ajustes."""
+from datetime import datetime
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+async def stock_at(client, headers, product_id, at=None):
+    at = at or datetime.utcnow()
+    return await client.get(f"/products/{product_id}/stock-at", params={"at": at.isoformat()}, headers=headers)
+
+
+async def drift_for(client, headers, product_id):
+    r = await client.get("/stock_movements/reconciliation", headers=headers)
+    assert r.status_code == 200, r.text
+    return [d for d in r.json()["desfases"] if d["product_id"] == product_id]
+
+
+async def snapshot(client, headers):
+    r = await client.post("/stock_snapshots", headers=headers)
+    assert r.status_code == 200, r.text
+
+
+async def test_pending_order_is_not_counted_twice(client, admin_headers, make_order):
+    order_id, product_id = await make_order(quantity=2, stock=10)
+    await snapshot(client, admin_headers)
+    assert (await client.post(f"/orders/{order_id}/confirm", headers=admin_headers)).status_code == 200
+
+    r = await stock_at(client, admin_headers, product_id)
+    assert r.json()["stock"] == 8
+    assert await drift_for(client, admin_headers, product_id) == []
+
+
+async def test_cancelled_reservation_returns_to_stock(client, admin_headers, make_order):
+    order_id, product_id = await make_order(quantity=3, stock=10)
+    await snapshot(client, admin_headers)
+    assert (await client.delete(f"/orders/{order_id}", headers=admin_headers)).status_code == 200
+
+    assert (await stock_at(client, admin_headers, product_id)).json()["stock"] == 10
+    assert await drift_for(client, admin_headers, product_id) == []
+
+
+async def test_manual_edit_is_written_to_the_ledger(client, admin_headers, make_product):
+    product_id = await make_product(stock=10)
+    await snapshot(client, admin_headers)
+    r = await client.put(f"/products/{product_id}", json={"name": f"Editado {product_id}", "stock": 15, "price": 1000},
+                         headers=admin_headers)
+    assert r.status_code == 200
+
+    movements = (await client.get("/stock_movements/", params={"product_id": product_id}, headers=admin_headers)).json()
+    assert [m["change"] for m in movements] == [10, 5]
+    assert (await stock_at(client, admin_headers, product_id)).json()["stock"] == 15
+    assert await drift_for(client, admin_headers, product_id) == []
+
+
+async def test_past_instant_before_a_later_snapshot(client, admin_headers, make_order):
+    order_id, product_id = await make_order(quantity=2, stock=10)
+    before_confirm = datetime.utcnow()
+    await client.post(f"/orders/{order_id}/confirm", headers=admin_headers)
+    await snapshot(client, admin_headers)
+
+    # Hacia atrás desde el snapshot: la venta confirmada después se deshace
+    assert (await stock_at(client, admin_headers, product_id, before_confirm)).json()["stock"] == 10
+
+
+async def test_without_snapshot_there_is_no_made_up_number(client, admin_headers, make_product):
+    product_id = await make_product(stock=10)
+    r = await stock_at(client, admin_headers, product_id)
+    assert r.status_code == 422
+    assert await drift_for(client, admin_headers, product_id) == []
+    r = await client.get("/stock_movements/reconciliation", headers=admin_headers)
+    assert r.json()["sin_snapshot"] >= 1
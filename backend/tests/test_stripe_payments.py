@@ -0,0 +1,217 @@
+"""PaymentIntents reutilizables y webhooks de Stripe contra un SDK falso en memoria."""
+import itertools
+import json
+from types import SimpleNamespace
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+
+
+class StripeError(Exception):
+    pass
+
+
+class InvalidRequestError(StripeError):
+    pass
+
+
+class SignatureVerificationError(StripeError):
+    pass
+
+
+class FakePaymentIntent:
+    """PaymentIntent con la semántica de idempotencia de Stripe."""
+
+    def __init__(self):
+        self.ids = itertools.count(1)
+        self.intents = {}
+        self.by_key = {}
+        self.calls = []
+
+    def create(self, amount, currency, metadata, idempotency_key=None):
+        self.calls.append(("create", idempotency_key))
+        if idempotency_key in self.by_key:
+            return self.by_key[idempotency_key]
+        n = next(self.ids)
+        intent = SimpleNamespace(id=f"pi_test_{n}", status="requires_payment_method", amount=amount,
+                                 client_secret=f"pi_test_{n}_secret", metadata=metadata)
+        self.intents[intent.id] = self.by_key[idempotency_key] = intent
+        return intent
+
+    def retrieve(self, intent_id):
+        self.calls.append(("retrieve", intent_id))
+        if intent_id not in self.intents:
+            raise InvalidRequestError(intent_id)
+        return self.intents[intent_id]
+
+    def modify(self, intent_id, amount):
+        self.calls.append(("modify", intent_id))
+        intent = self.retrieve(intent_id)
+        intent.amount = amount
+        return intent
+
+
+class FakeWebhook:
+    @staticmethod
+    def construct_event(payload, signature, secret):
+        if signature != f"firma-{secret}":
+            raise SignatureVerificationError("firma inválida")
+        data = json.loads(payload)
+        return SimpleNamespace(id=data["id"], type=data["type"])
+
+
+@pytest.fixture
+def stripe(monkeypatch):
+    fake = SimpleNamespace(
+        PaymentIntent=FakePaymentIntent(),
+        Webhook=FakeWebhook,
+        StripeError=StripeError,
+        InvalidRequestError=InvalidRequestError,
+        SignatureVerificationError=SignatureVerificationError,
+    )
+    monkeypatch.setattr(farmacia, "get_stripe", lambda: fake)
+    monkeypatch.setattr(farmacia, "STRIPE_WEBHOOK_SECRET", "whsec_test")
+    # Cola propia por prueba: cada prueba corre en su propio event loop
+    monkeypatch.setattr(farmacia, "stripe_event_queue", farmacia.asyncio.Queue())
+    return fake
+
+
+async def get_order(order_id):
+    async with farmacia.AsyncSessionLocal() as session:
+        return await session.get(farmacia.OrderDB, order_id)
+
+
+async def pay(client, headers, order_id):
+    return await client.post("/create-payment-intent", json={"order_id": order_id}, headers=headers)
+
+
+async def send_event(client, event_id, event_type, intent_id, order_id=None, secret="whsec_test"):
+    metadata = {"order_id": str(order_id)} if order_id else {}
+    payload = json.dumps({"id": event_id, "type": event_type,
+                          "data": {"object": {"id": intent_id, "metadata": metadata}}})
+    return await client.post("/stripe/webhook", content=payload, headers={"stripe-signature": f"firma-{secret}"})
+
+
+async def test_reuses_open_intent(client, admin_headers, make_order, stripe):
+    order_id, _ = await make_order()
+    first = await pay(client, admin_headers, order_id)
+    second = await pay(client, admin_headers, order_id)
+    assert first.status_code == second.status_code == 200
+    assert first.json() == second.json()
+    assert [c for c in stripe.PaymentIntent.calls if c[0] == "create"] == [("create", f"order-{order_id}-100000-inicial")]
+
+
+async def test_modifies_amount_when_total_changes(client, admin_headers, make_order, stripe):
+    order_id, _ = await make_order()
+    await pay(client, admin_headers, order_id)
+    async with farmacia.AsyncSessionLocal() as session:
+        order = await session.get(farmacia.OrderDB, order_id)
+        order.total = 2500
+        intent_id = order.stripe_payment_intent_id
+        await session.commit()
+    r = await pay(client, admin_headers, order_id)
+    assert r.status_code == 200
+    assert ("modify", intent_id) in stripe.PaymentIntent.calls
+    assert stripe.PaymentIntent.intents[intent_id].amount == 250000
+
+
+async def test_replaces_canceled_intent(client, admin_headers, make_order, stripe):
+    order_id, _ = await make_order()
+    await pay(client, admin_headers, order_id)
+    old_id = (await get_order(order_id)).stripe_payment_intent_id
+    stripe.PaymentIntent.intents[old_id].status = "canceled"
+    r = await pay(client, admin_headers, order_id)
+    assert r.status_code == 200
+    new_id = (await get_order(order_id)).stripe_payment_intent_id
+    assert new_id != old_id
+    assert ("create", f"order-{order_id}-100000-{old_id}") in stripe.PaymentIntent.calls
+
+
+async def test_succeeded_intent_marks_order_paid(client, admin_headers, make_order, stripe):
+    order_id, _ = await make_order()
+    await pay(client, admin_headers, order_id)
+    intent_id = (await get_order(order_id)).stripe_payment_intent_id
+    stripe.PaymentIntent.intents[intent_id].status = "succeeded"
+    r = await pay(client, admin_headers, order_id)
+    assert r.status_code == 400
+    assert (await get_order(order_id)).payment_status == "paid"
+
+
+async def test_stripe_error_is_502(client, admin_headers, make_order, stripe, monkeypatch):
+    def fail(**kwargs):
+        raise StripeError("caído")
+
+    monkeypatch.setattr(stripe.PaymentIntent, "create", fail)
+    order_id, _ = await make_order()
+    assert (await pay(client, admin_headers, order_id)).status_code == 502
+
+
+async def test_webhook_rejects_bad_signature_and_missing_secret(client, stripe, monkeypatch):
+    r = await send_event(client, "evt_firma", "payment_intent.succeeded", "pi_x", secret="otra")
+    assert r.status_code == 400
+    monkeypatch.setattr(farmacia, "STRIPE_WEBHOOK_SECRET", None)
+    r = await send_event(client, "evt_firma", "payment_intent.succeeded", "pi_x")
+    assert r.status_code == 503
+
+
+async def test_webhook_deduplicates_event_ids(client, stripe):
+    first = await send_event(client, "evt_dup", "payment_intent.processing", "pi_dup")
+    second = await send_event(client, "evt_dup", "payment_intent.processing", "pi_dup")
+    assert first.json() == {"received": True}
+    assert second.json() == {"received": True, "duplicate": True}
+    assert farmacia.stripe_event_queue.qsize() == 1
+
+
+async def test_payment_status_transitions(client, admin_headers, make_order, stripe):
+    order_id, _ = await make_order()
+    await pay(client, admin_headers, order_id)
+    intent_id = (await get_order(order_id)).stripe_payment_intent_id
+
+    steps = [
+        ("payment_intent.processing", intent_id, "processing"),
+        ("payment_intent.payment_failed", intent_id, "failed"),
+        # Un intent reemplazado no cambia el estado de la orden
+        ("payment_intent.canceled", "pi_reemplazado", "failed"),
+        ("payment_intent.succeeded", intent_id, "paid"),
+        # Una orden pagada nunca retrocede
+        ("payment_intent.payment_failed", intent_id, "paid"),
+    ]
+    for n, (event_type, event_intent, expected) in enumerate(steps):
+        event_id = f"evt_{order_id}_{n}"
+        assert (await send_event(client, event_id, event_type, event_intent, order_id)).status_code == 200
+        await farmacia.process_stripe_event(event_id)
+        assert (await get_order(order_id)).payment_status == expected, event_type
+
+
+async def test_failed_event_is_retried(client, admin_headers, make_order, stripe, monkeypatch):
+    order_id, _ = await make_order()
+    original = farmacia.apply_stripe_event
+    failures = iter([RuntimeError("base caída")])
+
+    async def flaky(db, event):
+        error = next(failures, None)
+        if error:
+            raise error
+        await original(db, event)
+
+    monkeypatch.setattr(farmacia, "apply_stripe_event", flaky)
+    await send_event(client, "evt_retry", "payment_intent.succeeded", "pi_retry", order_id)
+
+    await farmacia.process_stripe_event("evt_retry")
+    async with farmacia.AsyncSessionLocal() as session:
+        row = await session.get(farmacia.StripeEventDB, "evt_retry")
+        assert (row.attempts, row.processed_at, row.error) == (1, None, "base caída")
+    assert (await get_order(order_id)).payment_status == "unpaid"
+
+    await farmacia.process_stripe_event("evt_retry")
+    async with farmacia.AsyncSessionLocal() as session:
+        row = await session.get(farmacia.StripeEventDB, "evt_retry")
+        assert row.attempts == 2 and row.processed_at is not None and row.error is None
+    assert (await get_order(order_id)).payment_status == "paid"
+    # Ya procesado: una entrega más no lo vuelve a aplicar
+    await farmacia.process_stripe_event("evt_retry")
+    async with farmacia.AsyncSessionLocal() as session:
+        assert (await session.get(farmacia.StripeEventDB, "evt_retry")).attempts == 2
@@ -0,0 +1,63 @@
+"""Revocación de tokens con AUTH_TRUST_ROLE_CLAIM: versión por usuario guardada en la base."""
+import itertools
+
+import pytest
+
+import farmacia
+
+pytestmark = pytest.mark.anyio
+user_numbers = itertools.count(1)
+
+
+@pytest.fixture(autouse=True)
+def trust_role_claim(monkeypatch):
+    monkeypatch.setattr(farmacia, "AUTH_TRUST_ROLE_CLAIM", True)
+    monkeypatch.setattr(farmacia, "principal_cache", farmacia.PrincipalCache(100, 60))
+
+
+@pytest.fixture
+async def almacenista(client, admin_headers):
+    """Crea un almacenista y devuelve (id, credenciales)."""
+    credentials = {"username": f"almacenista_{next(user_numbers)}", "password": "Clave123!"}
+    r = await client.post("/register", json={**credentials, "role": "almacenista"}, headers=admin_headers)
+    assert r.status_code == 200, r.text
+    users = (await client.get("/users/", headers=admin_headers)).json()
+    return next(u["id"] for u in users if u["username"] == credentials["username"]), credentials
+
+
+async def login(client, credentials):
+    r = await client.post("/token", data=credentials)
+    assert r.status_code == 200, r.text
+    return {"Authorization": f"Bearer {r.json()['access_token']}"}
+
+
+async def stock_movements(client, headers):
+    return (await client.get("/stock_movements/", headers=headers)).status_code
+
+
+def restart_worker(monkeypatch):
+    """Otro worker, o el mismo tras reiniciar: sin nada en memoria."""
+    monkeypatch.setattr(farmacia, "principal_cache", farmacia.PrincipalCache(100, 60))
+
+
+async def test_deleted_user_is_rejected_on_every_worker(client, admin_headers, almacenista, monkeypatch):
+    user_id, credentials = almacenista
+    headers = await login(client, credentials)
+    assert await stock_movements(client, headers) == 200
+
+    assert (await client.delete(f"/users/{user_id}", headers=admin_headers)).status_code == 200
+    assert await stock_movements(client, headers) == 401
+    restart_worker(monkeypatch)
+    assert await stock_movements(client, headers) == 401
+
+
+async def test_token_issued_in_the_same_second_as_the_revocation(client, admin_headers, almacenista, monkeypatch):
+    user_id, credentials = almacenista
+    old = await login(client, credentials)
+    r = await client.put(f"/users/{user_id}", json={**credentials, "role": "almacenista"}, headers=admin_headers)
+    assert r.status_code == 200
+    new = await login(client, credentials)
+
+    restart_worker(monkeypatch)
+    assert await stock_movements(client, old) == 401
+    assert await stock_movements(client, new) == 200
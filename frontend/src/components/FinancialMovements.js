@@ -2,24 +2,31 @@ import React, { useEffect, useState, useContext } from 'react';
 import api from '../services/api';
 import { AuthContext } from '../context/AuthContext';
 
+const PAGE_SIZE = 100;
+
 const FinancialMovements = () => {
   const [movements, setMovements] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [error, setError] = useState('');
   const { user } = useContext(AuthContext);
 
-  useEffect(() => {
-    const fetchMovements = async () => {
-      try {
-        const response = await api.get('/financial_movements/');
-        setMovements(response.data);
-      } catch (err) {
-        console.error(err);
-        setError('Error al obtener los movimientos financieros.');
-      }
-    };
+  // Carga una página de movimientos (paginación por cursor)
+  const fetchPage = async (after = null) => {
+    try {
+      const params = { limit: PAGE_SIZE };
+      if (after !== null) params.after = after;
+      const response = await api.get('/financial_movements/', { params });
+      setMovements(prev => (after === null ? response.data.items : [...prev, ...response.data.items]));
+      setNextCursor(response.data.next_cursor);
+    } catch (err) {
+      console.error(err);
+      setError('Error al obtener los movimientos financieros.');
+    }
+  };
 
+  useEffect(() => {
     if (user && user.role === 'admin') {
-      fetchMovements();
+      fetchPage();
     }
   }, [user]);
 
@@ -55,6 +62,17 @@ const FinancialMovements = () => {
           </tbody>
         </table>
       </div>
+
+      {nextCursor !== null && (
+        <div className="text-center mt-4">
+          <button
+            onClick={() => fetchPage(nextCursor)}
+            className="bg-violet-600 hover:bg-violet-700 text-white py-2 px-4 rounded"
+          >
+            Cargar más
+          </button>
+        </div>
+      )}
     </div>
   );
 };
@@ -14,7 +14,8 @@ const Orders = () => {
   const fetchOrders = async () => {
     setLoading(true);
     try {
-      const response = await api.get('/orders/');
+      // include=items trae ítems y productos en la misma respuesta
+      const response = await api.get('/orders/', { params: { include: 'items' } });
       setOrders(response.data);
       setError('');
     } catch (err) {
@@ -82,6 +83,7 @@ const Orders = () => {
             <tr>
               <th className="py-3 px-4 text-left">ID</th>
               <th className="py-3 px-4 text-left">Cliente</th>
+              <th className="py-3 px-4 text-left">Productos</th>
               <th className="py-3 px-4 text-left">Total</th>
               <th className="py-3 px-4 text-left">Status</th>
               <th className="py-3 px-4 text-left">Fecha de Creación</th>
@@ -93,6 +95,13 @@ const Orders = () => {
               <tr key={order.id} className="hover:bg-gray-50">
                 <td className="py-3 px-4">{order.id}</td>
                 <td className="py-3 px-4">{order.client_id}</td>
+                <td className="py-3 px-4">
+                  {order.items.map((item) => (
+                    <div key={item.id} className="text-sm">
+                      {item.quantity} × {item.product ? item.product.name : `Producto ${item.product_id}`}
+                    </div>
+                  ))}
+                </td>
                 <td className="py-3 px-4">${order.total}</td>
                 <td className="py-3 px-4">{order.status}</td>
                 <td className="py-3 px-4">{new Date(order.created_at).toLocaleString()}</td>
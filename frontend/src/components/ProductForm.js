@@ -3,7 +3,7 @@
 import React, { useState, useEffect, useCallback } from 'react';
 import ReactDOM from 'react-dom';
 import { useNavigate, useParams } from 'react-router-dom';
-import api, { getUploadUrl } from '../services/api';
+import api, { getUploadUrl, processImage } from '../services/api';
 import axios from 'axios';
 
 const ConfirmationModal = ({ mensaje, producto_similar, onConfirm, onCancel }) => {
@@ -82,6 +82,8 @@ const ProductForm = () => {
         headers: { 'Content-Type': file.type },
       });
       setFormData(prev => ({ ...prev, image_filename: file.name }));
+      // Miniaturas WebP en segundo plano; si falla se sigue usando el original
+      processImage(file.name).catch(err => console.error('Error al procesar la imagen:', err));
     } catch {
       setError('Error al subir la imagen.');
     }
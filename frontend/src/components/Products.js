@@ -1,7 +1,7 @@
 // src/components/Products.js
 import React, { useState, useEffect, useContext } from 'react';
 import { Link } from 'react-router-dom';
-import api from '../services/api';
+import api, { getImageUrls } from '../services/api';
 import { AuthContext } from '../context/AuthContext';
 import { useCart } from '../context/CartContext';
 import GoToHomeButton from './GoToHomeButton'; 
@@ -22,20 +22,17 @@ function Products() {
       setLoading(true);
       try {
         const { data: rawProducts } = await api.get('/products/');
-        const productsWithImages = await Promise.all(
-          rawProducts.map(async (prod) => {
-            if (prod.image_filename) {
-              try {
-                const { data: imgData } = await api.get(`/imagen/${prod.image_filename}`);
-                return { ...prod, image_url: imgData.image_url };
-              } catch (err) {
-                console.error('Error al obtener imagen:', err);
-                return { ...prod, image_url: 'https://via.placeholder.com/200x150' };
-              }
-            }
-            return { ...prod, image_url: 'https://via.placeholder.com/200x150' };
-          })
-        );
+        // URLs de imagen en lotes (getImageUrls divide según el máximo del backend)
+        let imageUrls = {};
+        try {
+          imageUrls = await getImageUrls(rawProducts.map((prod) => prod.image_filename), 'thumb');
+        } catch (err) {
+          console.error('Error al obtener imágenes:', err);
+        }
+        const productsWithImages = rawProducts.map((prod) => ({
+          ...prod,
+          image_url: imageUrls[prod.image_filename] || 'https://via.placeholder.com/200x150',
+        }));
         setProducts(productsWithImages);
         setError('');
       } catch (err) {
@@ -13,11 +13,24 @@ api.interceptors.request.use(
   config => {
     const token = localStorage.getItem('token');
     if (token) config.headers['Authorization'] = `Bearer ${token}`;
+    // Read-your-writes: el backend lee del primario si escribimos hace poco
+    const lastWrite = localStorage.getItem('lastWrite');
+    if (lastWrite) config.headers['X-Last-Write'] = lastWrite;
     return config;
   },
   error => Promise.reject(error)
 );
 
+// Guarda la marca X-Last-Write que devuelve el backend tras cada escritura
+api.interceptors.response.use(
+  response => {
+    const lastWrite = response.headers['x-last-write'];
+    if (lastWrite) localStorage.setItem('lastWrite', lastWrite);
+    return response;
+  },
+  error => Promise.reject(error)
+);
+
 // Obtiene la URL prefirmada para subir un archivo a S3
 export const getUploadUrl = async (filename, contentType) => {
   const res = await api.get(
@@ -32,4 +45,32 @@ export const getImageUrl = async (filename) => {
   return res.data.image_url;
 };
 
+// Máximo de nombres por petición que acepta POST /imagenes/urls (MAX_IMAGE_BATCH)
+const IMAGE_BATCH_SIZE = 500;
+
+// Obtiene las URLs de varias imágenes en lotes de IMAGE_BATCH_SIZE ({ filename: url })
+// size: 'thumb' | 'medium' para los derivados WebP; sin size, el original
+// Un lote que falla solo deja sin URL a sus imágenes, no a todas
+export const getImageUrls = async (filenames, size = null) => {
+  const unique = [...new Set(filenames.filter(Boolean))];
+  const batches = [];
+  for (let i = 0; i < unique.length; i += IMAGE_BATCH_SIZE) {
+    batches.push(unique.slice(i, i + IMAGE_BATCH_SIZE));
+  }
+  const results = await Promise.allSettled(
+    batches.map((batch) => api.post('/imagenes/urls', { filenames: batch, size }))
+  );
+  const urls = {};
+  results.forEach((result) => {
+    if (result.status === 'fulfilled') Object.assign(urls, result.value.data.urls);
+    else console.error('Error al obtener un lote de imágenes:', result.reason);
+  });
+  return urls;
+};
+
+// Solicita al backend generar miniatura y tamaño medio de una imagen subida
+export const processImage = async (filename) => {
+  await api.post(`/imagenes/${encodeURIComponent(filename)}/derivados`);
+};
+
 export default api;